@@ -1,17 +1,108 @@
 """Подключение к базе данных"""
+from typing import Any, Dict
+from uuid import uuid4
+import time
+from sqlalchemy import inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util import queue as sqla_queue
+from utils.cache import TTLCache
 from config import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул соединений, который учитывает время ожидания свободного соединения
+
+    Ожидание учитывается, только если выдача соединения действительно
+    блокировалась (свободных соединений нет и overflow исчерпан). Время
+    открытия новых соединений учитывается отдельно (connect_*).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connect_count = 0
+        self.connect_total = 0.0
+        self.connect_max = 0.0
+
+        # QueuePool ждет на очереди (get с block=True) только когда overflow исчерпан
+        queue_get = self._pool.get
+
+        def timed_get(block=True, timeout=None):
+            if not block:
+                return queue_get(block, timeout)
+            try:
+                return queue_get(False)
+            except sqla_queue.Empty:
+                pass
+            started = time.perf_counter()
+            try:
+                return queue_get(block, timeout)
+            finally:
+                waited = time.perf_counter() - started
+                self.wait_count += 1
+                self.wait_total += waited
+                if waited > self.wait_max:
+                    self.wait_max = waited
+
+        self._pool.get = timed_get
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            elapsed = time.perf_counter() - started
+            self.connect_count += 1
+            self.connect_total += elapsed
+            if elapsed > self.connect_max:
+                self.connect_max = elapsed
+
+
+def _engine_options(url: str) -> Dict[str, Any]:
+    """Параметры движка БД из настроек"""
+    options: Dict[str, Any] = {"echo": False, "future": True}
+
+    # Параметры пула и кеша запросов имеют смысл только для PostgreSQL
+    if not url.startswith("postgresql"):
+        return options
+
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+
+    if "asyncpg" in url:
+        if settings.DB_PGBOUNCER_MODE:
+            # pgbouncer в режиме transaction отдает каждую транзакцию в произвольное
+            # серверное соединение, поэтому подготовленные запросы нельзя переиспользовать,
+            # а их имена должны быть уникальными
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+            }
+        else:
+            options["connect_args"] = {
+                "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+            }
+
+    return options
+
+
 # Создаем движок БД
-engine = create_async_engine(
-    settings.DATABASE_URL,
-    echo=False,
-    future=True
-)
+engine = create_async_engine(settings.DATABASE_URL, **_engine_options(settings.DATABASE_URL))
 
 # Создаем фабрику сессий
 async_session_maker = async_sessionmaker(
@@ -20,9 +111,124 @@ async_session_maker = async_sessionmaker(
     expire_on_commit=False
 )
 
+# Реплика для чтения (если не настроена - чтение идет с основной БД)
+replica_engine = None
+replica_session_maker = None
+if settings.DATABASE_REPLICA_URL:
+    replica_engine = create_async_engine(
+        settings.DATABASE_REPLICA_URL,
+        **_engine_options(settings.DATABASE_REPLICA_URL)
+    )
+    replica_session_maker = async_sessionmaker(
+        replica_engine,
+        class_=AsyncSession,
+        expire_on_commit=False
+    )
+
+# Пользователи, недавно записавшие данные в основную БД.
+# Пока запись не истекла, их чтение идет с основной БД, а не с реплики,
+# чтобы пользователь сразу видел результат своих действий.
+_recent_writers = TTLCache(maxsize=100000, ttl=settings.REPLICA_STALENESS_SECONDS)
+
+
+def mark_recent_write(telegram_id: int):
+    """Отметить, что пользователь только что изменил данные"""
+    if replica_session_maker is not None:
+        _recent_writers.set(telegram_id, True)
+
+
+def get_read_session_maker(telegram_id: int = None) -> async_sessionmaker:
+    """Фабрика сессий для чтения: реплика, если она настроена и данные пользователя не устарели"""
+    if replica_session_maker is None:
+        return async_session_maker
+    if telegram_id is not None and telegram_id in _recent_writers:
+        return async_session_maker
+    return replica_session_maker
+
+
 Base = declarative_base()
 
 
+def _add_missing_columns(connection):
+    """Добавить в существующие таблицы столбцы, появившиеся в моделях
+
+    create_all не изменяет существующие таблицы. Новый столбец должен быть
+    nullable или иметь server_default, иначе его нельзя добавить в таблицу
+    с данными - такой столбец пропускается с ошибкой в логе.
+    """
+    inspector = inspect(connection)
+    existing_tables = set(inspector.get_table_names())
+    preparer = connection.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable and column.server_default is None:
+                logger.error(f"Cannot add NOT NULL column {table.name}.{column.name} without server_default")
+                continue
+            ddl = CreateColumn(column).compile(dialect=connection.dialect)
+            try:
+                with connection.begin_nested():
+                    connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}"))
+                logger.info(f"Added column {table.name}.{column.name}")
+            except Exception as e:
+                logger.error(f"Could not add column {table.name}.{column.name}: {e}")
+
+
+def _create_missing_indexes(connection):
+    """Создать индексы, добавленные в модели после создания таблиц"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                # Уникальный индекс не создастся, если в таблице уже есть дубли -
+                # это не должно мешать запуску бота
+                with connection.begin_nested():
+                    index.create(connection, checkfirst=True)
+            except Exception as e:
+                logger.error(f"Could not create index {index.name} on {table.name}: {e}")
+
+
+def insert_ignore_duplicates(model, index_elements):
+    """INSERT ... ON CONFLICT DO NOTHING по уникальному индексу index_elements
+
+    Поддерживаются PostgreSQL и SQLite. Для других СУБД возвращает None -
+    вызывающий код должен сделать обычный INSERT и обработать IntegrityError.
+    """
+    stmt = _dialect_insert(model)
+    if stmt is None:
+        return None
+    return stmt.on_conflict_do_nothing(index_elements=index_elements)
+
+
+def upsert(model, index_elements, values: Dict[str, Any]):
+    """INSERT ... ON CONFLICT DO UPDATE: вставить строку или обновить ее поля
+
+    Поддерживаются PostgreSQL и SQLite, для других СУБД возвращает None.
+    """
+    stmt = _dialect_insert(model)
+    if stmt is None:
+        return None
+    stmt = stmt.values(**values)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={key: stmt.excluded[key] for key in values if key not in index_elements}
+    )
+
+
+def _dialect_insert(model):
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert(model)
+
+
 async def init_db():
     """Инициализация базы данных"""
     # Импортируем все модели, чтобы они зарегистрировались в Base.metadata
@@ -31,6 +237,9 @@ async def init_db():
         async with engine.begin() as conn:
             # checkfirst=True предотвращает ошибки при повторном создании
             await conn.run_sync(Base.metadata.create_all, checkfirst=True)
+            # create_all не добавляет новые столбцы и индексы в уже существующие таблицы
+            await conn.run_sync(_add_missing_columns)
+            await conn.run_sync(_create_missing_indexes)
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
@@ -45,3 +254,26 @@ async def get_session() -> AsyncSession:
         finally:
             await session.close()
 
+
+def _pool_stats(pool) -> Dict[str, Any]:
+    stats: Dict[str, Any] = {"pool": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            stats[name] = method()
+    if isinstance(pool, TimedQueuePool):
+        stats["wait_count"] = pool.wait_count
+        stats["wait_avg_ms"] = round(pool.wait_total / pool.wait_count * 1000, 2) if pool.wait_count else 0.0
+        stats["wait_max_ms"] = round(pool.wait_max * 1000, 2)
+        stats["connect_count"] = pool.connect_count
+        stats["connect_avg_ms"] = round(pool.connect_total / pool.connect_count * 1000, 2) if pool.connect_count else 0.0
+        stats["connect_max_ms"] = round(pool.connect_max * 1000, 2)
+    return stats
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Статистика пула соединений (для /health)"""
+    stats = _pool_stats(engine.pool)
+    if replica_engine is not None:
+        stats["replica"] = _pool_stats(replica_engine.pool)
+    return stats
@@ -0,0 +1,137 @@
+"""Хранилище FSM aiogram в основной базе данных
+
+MemoryStorage хранит состояния сценариев (оформление заказа, загрузка
+товаров в админке и т.д.) в памяти одного процесса. SQLStorage хранит их
+в таблице fsm_states, поэтому несколько процессов бота (например, webhook
+воркеров на одном порту с SO_REUSEPORT) видят одно и то же состояние.
+
+Состояние и данные ключа хранятся в одной строке и читаются одним запросом.
+Запись выполняется сразу в БД (write-through). Кеш живет только в пределах
+обработки одного обновления (update_cache_scope, FsmCacheMiddleware):
+повторные чтения в обработчике не ходят в БД, а следующее обновление
+пользователя - в этом или другом процессе - всегда читает состояние из БД.
+Кеш на время (между обновлениями) не используется: процесс не узнает, что
+другой процесс изменил состояние, и потерял бы шаг сценария.
+
+Строки без состояния и данных удаляются, остальные живут FSM_STATE_TTL_HOURS
+с последнего изменения; cleanup() удаляет их по расписанию
+(services/job_scheduler.py).
+"""
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Dict, Mapping, Optional, Tuple
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from sqlalchemy import select, delete
+from database.database import async_session_maker, upsert
+from database.models import FsmRecord
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value: Any) -> Any:
+    # datetime встречается в данных админских сценариев (фильтр заказов по датам)
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1 and "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+# Кеш записей (state, data) по ключу на время обработки текущего обновления
+_update_cache: ContextVar[Optional[Dict[str, Tuple[Optional[str], Dict[str, Any]]]]] = ContextVar(
+    "fsm_update_cache", default=None
+)
+
+
+@contextmanager
+def update_cache_scope():
+    """Кешировать состояния FSM до конца обработки текущего обновления"""
+    token = _update_cache.set({})
+    try:
+        yield
+    finally:
+        _update_cache.reset(token)
+
+
+class SQLStorage(BaseStorage):
+    """FSM storage на таблице fsm_states"""
+
+    def __init__(self, ttl_hours: float):
+        self.ttl = timedelta(hours=ttl_hours)
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        cache = _update_cache.get()
+        if cache is not None and key in cache:
+            return cache[key]
+
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(FsmRecord.state, FsmRecord.data).where(
+                    FsmRecord.key == key,
+                    FsmRecord.expires_at > datetime.now()
+                )
+            )
+            row = result.first()
+        record = (row.state, json.loads(row.data, object_hook=_decode) if row.data else {}) if row else (None, {})
+        if cache is not None:
+            cache[key] = record
+        return record
+
+    async def _save(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        async with async_session_maker() as session:
+            if state is None and not data:
+                await session.execute(delete(FsmRecord).where(FsmRecord.key == key))
+            else:
+                values = {
+                    "key": key,
+                    "state": state,
+                    "data": json.dumps(data, ensure_ascii=False, default=_encode) if data else None,
+                    "expires_at": datetime.now() + self.ttl,
+                }
+                stmt = upsert(FsmRecord, ["key"], values)
+                if stmt is not None:
+                    await session.execute(stmt)
+                else:
+                    await session.merge(FsmRecord(**values))
+            await session.commit()
+        cache = _update_cache.get()
+        if cache is not None:
+            cache[key] = (state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key_builder.build(key)
+        _, data = await self._load(storage_key)
+        await self._save(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self._key_builder.build(key)
+        state, _ = await self._load(storage_key)
+        await self._save(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key_builder.build(key))
+        # Копия, чтобы изменения словаря обработчиком не попадали в кеш
+        return dict(data)
+
+    async def cleanup(self) -> int:
+        """Удалить просроченные состояния, возвращает количество удаленных"""
+        async with async_session_maker() as session:
+            result = await session.execute(delete(FsmRecord).where(FsmRecord.expires_at <= datetime.now()))
+            await session.commit()
+        return result.rowcount or 0
+
+    async def close(self) -> None:
+        pass
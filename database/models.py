@@ -2,10 +2,10 @@
 from datetime import datetime
 from sqlalchemy import (
     Column, Integer, BigInteger, String, Float, Boolean, DateTime, Text, ForeignKey, 
-    Index, CheckConstraint
+    Index, CheckConstraint, UniqueConstraint
 )
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, true
 from database.database import Base
 
 
@@ -19,6 +19,9 @@ class User(Base):
     first_name = Column(String(255), nullable=True)
     balance = Column(Float, default=0.0, nullable=False)
     is_blocked = Column(Boolean, default=False, nullable=False)
+    # False - Telegram окончательно отказал в доставке (бот заблокирован, чат не найден);
+    # такие пользователи исключаются из рассылок, флаг снимается, когда пользователь пишет боту
+    is_reachable = Column(Boolean, default=True, server_default=true(), nullable=False)
     referral_code = Column(String(50), unique=True, nullable=True, index=True)
     referred_by = Column(Integer, ForeignKey("users.id"), nullable=True)
     role = Column(String(50), default="user", nullable=False)  # user, admin, developer
@@ -28,6 +31,12 @@ class User(Base):
     # Relationships
     orders = relationship("Order", back_populates="user")
     referrals = relationship("User", remote_side=[id], backref="referrer")
+    
+    __table_args__ = (
+        # Сегменты рассылок (services/audience.py): баланс больше суммы, пригласившие друзей
+        Index('idx_user_balance', 'balance'),
+        Index('idx_user_referred_by', 'referred_by'),
+    )
 
 
 class Category(Base):
@@ -69,6 +78,8 @@ class Product(Base):
     __table_args__ = (
         CheckConstraint('price >= 0', name='check_price_positive'),
         CheckConstraint('stock_count >= 0', name='check_stock_positive'),
+        # Keyset-пагинация списков товаров (ORDER BY name, id)
+        Index('idx_product_name', 'name', 'id'),
     )
 
 
@@ -125,6 +136,9 @@ class Order(Base):
         CheckConstraint('total_amount >= 0', name='check_amount_positive'),
         Index('idx_user_status', 'user_id', 'status'),
         Index('idx_status', 'status'),
+        # Сегменты рассылок: купившие товар/категорию, без заказов N дней
+        Index('idx_order_product_status_user', 'product_id', 'status', 'user_id'),
+        Index('idx_order_created_user', 'created_at', 'user_id'),
     )
 
 
@@ -143,6 +157,8 @@ class StockNotification(Base):
     
     __table_args__ = (
         Index('idx_user_product', 'user_id', 'product_id'),
+        # Неотправленные уведомления о товаре (и сегмент рассылки "ждут поступления")
+        Index('idx_stock_notified_product', 'is_notified', 'product_id', 'user_id'),
     )
 
 
@@ -155,14 +171,80 @@ class Payment(Base):
     amount = Column(Float, nullable=False)
     payment_method = Column(String(50), nullable=False)
     payment_id = Column(String(255), nullable=True)  # ID в платежной системе
-    status = Column(String(50), default="PENDING", nullable=False)  # PENDING, SUCCESS, FAILED
+    status = Column(String(50), default="PENDING", nullable=False)  # PENDING, SUCCESS, FAILED, EXPIRED, PAID_UNMATCHED
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=True)
     created_at = Column(DateTime, default=func.now(), nullable=False)
     completed_at = Column(DateTime, nullable=True)
+    # Сверка статуса (services/payment_reconciler.py): количество проверок и срок следующей
+    check_attempts = Column(Integer, default=0, server_default="0", nullable=False)
+    next_check_at = Column(DateTime, nullable=True)
     
     __table_args__ = (
         CheckConstraint('amount > 0', name='check_amount_positive'),
         Index('idx_payment_user_status', 'user_id', 'status'),
+        Index('idx_payment_status_next_check', 'status', 'next_check_at'),
+        # Один платеж платежной системы - одна запись (идемпотентность webhook)
+        Index('idx_payment_method_payment_id', 'payment_method', 'payment_id', unique=True),
+    )
+
+
+class PaymentEvent(Base):
+    """Входящее событие платежной системы (inbox webhook)
+
+    Webhook только сохраняет событие и сразу отвечает 200, обработку выполняют
+    фоновые воркеры (services/payment_inbox.py). Повторная доставка того же
+    события платежной системой отбрасывается уникальным ключом.
+    """
+    __tablename__ = "payment_events"
+    
+    id = Column(Integer, primary_key=True)
+    provider = Column(String(50), nullable=False)  # yookassa, heleket
+    event_id = Column(String(255), nullable=False)  # Ключ события у платежной системы
+    event_type = Column(String(100), nullable=True)
+    payload = Column(Text, nullable=False)  # Исходный JSON webhook
+    status = Column(String(20), default="NEW", nullable=False)  # NEW, PROCESSING, DONE, FAILED
+    attempts = Column(Integer, default=0, nullable=False)
+    # Повторы по RetryLater с известным сроком (429 Telegram) - не расходуют attempts
+    deferrals = Column(Integer, default=0, server_default="0", nullable=False)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, default=func.now(), nullable=False)
+    locked_until = Column(DateTime, nullable=True)  # Срок захвата события воркером
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    processed_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        UniqueConstraint('provider', 'event_id', name='uq_payment_event_provider_event'),
+        Index('idx_payment_event_status_next', 'status', 'next_attempt_at'),
+    )
+
+
+class DeliveryOutbox(Base):
+    """Исходящая доставка после оплаты (transactional outbox)
+
+    Запись создается в той же транзакции, что и проведение оплаты заказа,
+    и отправляется фоновым воркером (services/delivery_outbox.py). Товар
+    не теряется, если Telegram API недоступен в момент оплаты.
+    """
+    __tablename__ = "delivery_outbox"
+    
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=True)
+    kind = Column(String(50), nullable=False)  # order_document, purchase_notification, admin_alert
+    chat_id = Column(BigInteger, nullable=True)  # Получатель (для уведомлений - чат администраторов)
+    payload = Column(Text, nullable=False)  # JSON с содержимым сообщения
+    status = Column(String(20), default="PENDING", nullable=False)  # PENDING, PROCESSING, SENT, FAILED
+    attempts = Column(Integer, default=0, nullable=False)
+    # Повторы по RetryLater с известным сроком (429 Telegram) - не расходуют attempts
+    deferrals = Column(Integer, default=0, server_default="0", nullable=False)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, default=func.now(), nullable=False)
+    locked_until = Column(DateTime, nullable=True)  # Срок захвата записи воркером
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index('idx_delivery_status_next', 'status', 'next_attempt_at'),
+        Index('idx_delivery_order', 'order_id'),
     )
 
 
@@ -284,4 +366,49 @@ class AuditLog(Base):
     )
 
 
+class BroadcastJob(Base):
+    """Массовая рассылка (services/broadcast_jobs.py)
+
+    Сообщение администратора копируется получателям (copy_message) пачками
+    по возрастанию users.id; cursor - users.id последнего обработанного
+    получателя, после перезапуска рассылка продолжается с него.
+    """
+    __tablename__ = "broadcast_jobs"
+    
+    id = Column(Integer, primary_key=True)
+    created_by = Column(BigInteger, nullable=False)  # telegram_id администратора
+    from_chat_id = Column(BigInteger, nullable=False)  # Чат с исходным сообщением
+    message_id = Column(Integer, nullable=False)  # Исходное сообщение
+    audience = Column(String(50), default="all", nullable=False)  # Кому отправлять
+    status = Column(String(20), default="PENDING", nullable=False)  # PENDING, RUNNING, DONE, CANCELLED
+    cursor = Column(Integer, default=0, nullable=False)
+    total = Column(Integer, default=0, nullable=False)
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    blocked = Column(Integer, default=0, nullable=False)
+    progress_message_id = Column(Integer, nullable=True)  # Сообщение с прогрессом у администратора
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index('idx_broadcast_jobs_status', 'status'),
+    )
+
+
+class FsmRecord(Base):
+    """Состояние FSM пользователя (database/fsm_storage.py)
 
+    Общее для всех процессов бота, поэтому сценарий может продолжиться
+    в другом воркере. Записи старше FSM_STATE_TTL_HOURS удаляются.
+    """
+    __tablename__ = "fsm_states"
+    
+    key = Column(String(255), primary_key=True)  # bot:chat:user[:thread][:business]:destiny
+    state = Column(String(255), nullable=True)
+    data = Column(Text, nullable=True)  # JSON
+    expires_at = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index('idx_fsm_states_expires', 'expires_at'),
+    )
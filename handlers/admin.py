@@ -9,10 +9,14 @@ from database.models import (
     User, Order, Product, Category, Account, Log, Setting, StockNotification
 )
 from services.account_service import upload_accounts_from_file
+from services.user_access import get_user_access, invalidate_user_access
+from services.catalog_cache import invalidate_catalog, mark_stock_changed
+from services.payment_reconciler import close_order_payments
 from utils.keyboards import (
     get_admin_menu_keyboard, get_admin_orders_keyboard, get_admin_catalog_keyboard,
-    get_confirm_keyboard
+    get_confirm_keyboard, get_page_nav_buttons
 )
+from utils.pagination import fetch_keyset_page, parse_page_callback
 from config import settings
 from datetime import datetime, timedelta
 import logging
@@ -84,15 +88,9 @@ async def is_admin_async(user_id: int, session: AsyncSession) -> bool:
     if user_id in settings.admin_ids_list or user_id in settings.developer_ids_list:
         return True
     
-    # Затем проверяем роль в БД
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    
-    if user and user.role in ("admin", "developer"):
-        return True
-    
-    return False
+    # Затем проверяем роль в БД (через кеш прав пользователя)
+    access = await get_user_access(session, user_id)
+    return bool(access and access.is_admin)
 
 
 async def is_developer_async(user_id: int, session: AsyncSession) -> bool:
@@ -101,15 +99,9 @@ async def is_developer_async(user_id: int, session: AsyncSession) -> bool:
     if user_id in settings.developer_ids_list:
         return True
     
-    # Затем проверяем роль в БД
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    
-    if user and user.role == "developer":
-        return True
-    
-    return False
+    # Затем проверяем роль в БД (через кеш прав пользователя)
+    access = await get_user_access(session, user_id)
+    return bool(access and access.is_developer)
 
 
 def get_all_menu_buttons():
@@ -406,6 +398,7 @@ async def admin_cancel_order(callback: CallbackQuery, session: AsyncSession):
     # Отменяем заказ
     order.status = "ОТМЕНЕНО"
     order.reserved_until = None
+    await close_order_payments(session, [order.id], "FAILED")
     await session.commit()
     
     # Уведомляем пользователя
@@ -510,6 +503,7 @@ async def admin_add_category_finish(message: Message, state: FSMContext, session
     category = Category(name=category_name)
     session.add(category)
     await session.commit()
+    invalidate_catalog()
     
     await message.answer(f"✅ Категория '{category_name}' добавлена")
     await state.clear()
@@ -641,6 +635,7 @@ async def admin_delete_category_execute(callback: CallbackQuery, session: AsyncS
         # Деактивируем категорию вместо удаления
         category.is_active = False
         await session.commit()
+        invalidate_catalog()
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_catalog")]
@@ -656,6 +651,7 @@ async def admin_delete_category_execute(callback: CallbackQuery, session: AsyncS
         # Удаляем категорию полностью, если нет товаров
         await session.delete(category)
         await session.commit()
+        invalidate_catalog()
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_catalog")]
@@ -1020,6 +1016,7 @@ async def _create_product_from_state(state: FSMContext, session: AsyncSession, m
     )
     session.add(product)
     await session.commit()
+    invalidate_catalog()
     await session.refresh(product)
     
     # Формируем сообщение с информацией о товаре
@@ -1139,7 +1136,7 @@ async def admin_upload_accounts_process(message: Message, state: FSMContext, ses
 
 # Статистика
 @router.callback_query(F.data == "admin_stats")
-async def admin_stats(callback: CallbackQuery, session: AsyncSession):
+async def admin_stats(callback: CallbackQuery, session: AsyncSession, read_session: AsyncSession):
     """Статистика"""
     if not await is_admin_async(callback.from_user.id, session):
         await callback.answer("Доступ запрещен", show_alert=True)
@@ -1147,26 +1144,26 @@ async def admin_stats(callback: CallbackQuery, session: AsyncSession):
     
     # Общее количество пользователей
     stmt_users = select(func.count(User.id))
-    result_users = await session.execute(stmt_users)
+    result_users = await read_session.execute(stmt_users)
     total_users = result_users.scalar()
     
     # Общее количество заказов
     stmt_orders = select(func.count(Order.id))
-    result_orders = await session.execute(stmt_orders)
+    result_orders = await read_session.execute(stmt_orders)
     total_orders = result_orders.scalar()
     
     # Заказы по статусам
     stmt_pending = select(func.count(Order.id)).where(Order.status == "ОЖИДАЕТ ОПЛАТЫ")
-    result_pending = await session.execute(stmt_pending)
+    result_pending = await read_session.execute(stmt_pending)
     pending_orders = result_pending.scalar()
     
     stmt_completed = select(func.count(Order.id)).where(Order.status == "ВЫПОЛНЕНО")
-    result_completed = await session.execute(stmt_completed)
+    result_completed = await read_session.execute(stmt_completed)
     completed_orders = result_completed.scalar()
     
     # Общая сумма продаж
     stmt_revenue = select(func.sum(Order.total_amount)).where(Order.status == "ВЫПОЛНЕНО")
-    result_revenue = await session.execute(stmt_revenue)
+    result_revenue = await read_session.execute(stmt_revenue)
     total_revenue = result_revenue.scalar() or 0
     
     text = f"""📊 <b>Статистика</b>
@@ -1360,6 +1357,7 @@ async def admin_user_block(callback: CallbackQuery, session: AsyncSession):
     
     user.is_blocked = not user.is_blocked
     await session.commit()
+    invalidate_user_access(user.telegram_id)
     
     status = "заблокирован" if user.is_blocked else "разблокирован"
     
@@ -1455,6 +1453,7 @@ async def admin_bulk_block_users_process(message: Message, state: FSMContext, se
                 not_found += 1
         
         await session.commit()
+        invalidate_user_access(*user_ids)
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_users")]
@@ -2160,6 +2159,7 @@ async def admin_edit_product_field(callback: CallbackQuery, state: FSMContext, s
         if product:
             product.is_active = not product.is_active
             await session.commit()
+            invalidate_catalog()
             await callback.answer(f"Активность изменена на: {'Да' if product.is_active else 'Нет'}", show_alert=True)
             await callback.message.edit_text(f"✅ Товар {'активирован' if product.is_active else 'деактивирован'}")
         return
@@ -2216,6 +2216,7 @@ async def admin_edit_product_set_category(callback: CallbackQuery, state: FSMCon
     if product:
         product.category_id = category_id
         await session.commit()
+        invalidate_catalog()
         await callback.answer("Категория изменена", show_alert=True)
         await callback.message.edit_text("✅ Категория товара обновлена")
     else:
@@ -2264,6 +2265,7 @@ async def admin_edit_product_value(message: Message, state: FSMContext, session:
             product.recommendations = message.text.strip()
         
         await session.commit()
+        invalidate_catalog()
         await message.answer(f"✅ Поле '{field}' обновлено!")
         await state.clear()
         
@@ -2273,17 +2275,28 @@ async def admin_edit_product_value(message: Message, state: FSMContext, session:
 
 # ========== УДАЛЕНИЕ ТОВАРОВ ==========
 
+ADMIN_PRODUCTS_PAGE_SIZE = 20
+
+
 @router.callback_query(F.data == "admin_delete_product")
+@router.callback_query(F.data.startswith("admin_delete_product_page_"))
 async def admin_delete_product_start(callback: CallbackQuery, session: AsyncSession):
-    """Начать удаление товара - показываем список"""
+    """Начать удаление товара - показываем список (постранично)"""
     if not await is_admin_async(callback.from_user.id, session):
         await callback.answer("Доступ запрещен", show_alert=True)
         return
     
-    # Получаем все товары
-    stmt = select(Product).order_by(Product.name)
-    result = await session.execute(stmt)
-    products = result.scalars().all()
+    direction, anchor_id = parse_page_callback(callback.data, "admin_delete_product_page")
+    page = await fetch_keyset_page(
+        session,
+        select(Product),
+        (Product.name, Product.id),
+        Product.id,
+        anchor_id,
+        direction,
+        ADMIN_PRODUCTS_PAGE_SIZE
+    )
+    products = page.items
     
     if not products:
         await callback.message.edit_text(
@@ -2299,7 +2312,7 @@ async def admin_delete_product_start(callback: CallbackQuery, session: AsyncSess
     buttons = []
     text = "🗑️ <b>Удаление товара</b>\n\nВыберите товар для удаления:\n\n"
     
-    for product in products[:50]:  # Ограничиваем 50 товарами
+    for product in products:
         status = "✅" if product.is_active else "❌"
         text += f"{status} <b>{product.name}</b> (ID: {product.id}, цена: {product.price:.2f} ₽, остаток: {product.stock_count})\n"
         buttons.append([InlineKeyboardButton(
@@ -2307,9 +2320,9 @@ async def admin_delete_product_start(callback: CallbackQuery, session: AsyncSess
             callback_data=f"delete_product_{product.id}"
         )])
     
-    if len(products) > 50:
-        text += f"\n... и еще {len(products) - 50} товаров"
-    
+    nav_buttons = get_page_nav_buttons(page, "admin_delete_product_page")
+    if nav_buttons:
+        buttons.append(nav_buttons)
     buttons.append([InlineKeyboardButton(text="🗑️ Массовое удаление", callback_data="admin_bulk_delete_products")])
     buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_catalog")])
     
@@ -2390,6 +2403,7 @@ async def admin_delete_product_execute(callback: CallbackQuery, session: AsyncSe
         # Не удаляем, а деактивируем
         product.is_active = False
         await session.commit()
+        invalidate_catalog()
         await callback.message.edit_text(
             f"✅ Товар деактивирован (есть {orders_count} заказов)",
             reply_markup=keyboard
@@ -2398,6 +2412,7 @@ async def admin_delete_product_execute(callback: CallbackQuery, session: AsyncSe
         # Удаляем полностью
         await session.delete(product)
         await session.commit()
+        invalidate_catalog()
         await callback.message.edit_text(
             "✅ Товар удален",
             reply_markup=keyboard
@@ -2533,16 +2548,24 @@ async def admin_setting_list(callback: CallbackQuery, session: AsyncSession):
 # ========== УПРАВЛЕНИЕ АККАУНТАМИ ==========
 
 @router.callback_query(F.data == "admin_manage_accounts")
+@router.callback_query(F.data.startswith("admin_manage_accounts_page_"))
 async def admin_manage_accounts_menu(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
-    """Меню управления аккаунтами - выбор товара"""
+    """Меню управления аккаунтами - выбор товара (постранично)"""
     if not await is_admin_async(callback.from_user.id, session):
         await callback.answer("Доступ запрещен", show_alert=True)
         return
     
-    # Получаем все товары
-    stmt = select(Product).where(Product.is_active == True).order_by(Product.name)
-    result = await session.execute(stmt)
-    products = result.scalars().all()
+    direction, anchor_id = parse_page_callback(callback.data, "admin_manage_accounts_page")
+    page = await fetch_keyset_page(
+        session,
+        select(Product).where(Product.is_active == True),
+        (Product.name, Product.id),
+        Product.id,
+        anchor_id,
+        direction,
+        ADMIN_PRODUCTS_PAGE_SIZE
+    )
+    products = page.items
     
     if not products:
         await callback.message.edit_text(
@@ -2554,20 +2577,24 @@ async def admin_manage_accounts_menu(callback: CallbackQuery, state: FSMContext,
         await callback.answer()
         return
     
+    # Получаем количество аккаунтов на складе одним запросом для всей страницы
+    stmt_counts = select(Account.product_id, func.count(Account.id)).where(
+        Account.product_id.in_([product.id for product in products]),
+        Account.is_sold == False
+    ).group_by(Account.product_id)
+    result_counts = await session.execute(stmt_counts)
+    stock_counts = dict(result_counts.all())
+    
     buttons = []
     for product in products:
-        # Получаем количество аккаунтов на складе
-        stmt_count = select(func.count(Account.id)).where(
-            Account.product_id == product.id,
-            Account.is_sold == False
-        )
-        result_count = await session.execute(stmt_count)
-        stock_count = result_count.scalar() or 0
-        
+        stock_count = stock_counts.get(product.id, 0)
         buttons.append([InlineKeyboardButton(
             text=f"📦 {product.name} (остаток: {stock_count})",
             callback_data=f"admin_accounts_product_{product.id}"
         )])
+    nav_buttons = get_page_nav_buttons(page, "admin_manage_accounts_page")
+    if nav_buttons:
+        buttons.append(nav_buttons)
     buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_catalog")])
     
     await callback.message.edit_text(
@@ -2718,6 +2745,7 @@ async def admin_account_add_process(message: Message, state: FSMContext, session
         .values(stock_count=Product.stock_count + 1)
     )
     
+    mark_stock_changed(session, product_id)
     await session.commit()
     
     stmt_product = select(Product).where(Product.id == product_id)
@@ -3002,6 +3030,7 @@ async def admin_delete_account_execute(callback: CallbackQuery, session: AsyncSe
         .values(stock_count=Product.stock_count - 1)
     )
     
+    mark_stock_changed(session, product_id)
     await session.commit()
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -3145,6 +3174,7 @@ async def admin_set_role(callback: CallbackQuery, session: AsyncSession):
     old_role = user.role or "user"
     user.role = new_role
     await session.commit()
+    invalidate_user_access(user.telegram_id)
     
     # Отправляем уведомление пользователю об изменении роли
     try:
@@ -1,4 +1,5 @@
 """Обработчик баланса"""
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
@@ -24,17 +25,11 @@ class TopupStates(StatesGroup):
 
 
 @router.message(F.text == "💰 Баланс")
-async def show_balance(message: Message, session: AsyncSession, state: FSMContext):
+async def show_balance(message: Message, session: AsyncSession, state: FSMContext, user: Optional[User]):
     """Показать баланс"""
     # Очищаем FSM состояние при переходе в баланс
     await state.clear()
     
-    user_id = message.from_user.id
-    
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    
     if not user:
         await message.answer("Пользователь не найден. Используйте /start")
         return
@@ -46,14 +41,9 @@ async def show_balance(message: Message, session: AsyncSession, state: FSMContex
 
 
 @router.callback_query(F.data.startswith("topup_"))
-async def process_topup(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
+async def process_topup(callback: CallbackQuery, session: AsyncSession, state: FSMContext, user: Optional[User]):
     """Обработка пополнения баланса"""
     method = callback.data.split("_")[1]
-    user_id = callback.from_user.id
-    
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -91,7 +81,7 @@ async def process_topup(callback: CallbackQuery, session: AsyncSession, state: F
 
 
 @router.message(TopupStates.waiting_amount)
-async def process_topup_amount(message: Message, state: FSMContext, session: AsyncSession):
+async def process_topup_amount(message: Message, state: FSMContext, session: AsyncSession, user: Optional[User]):
     """Обработка суммы пополнения"""
     # Проверяем, не выбрана ли кнопка меню
     from utils.text import MENU_CATALOG, MENU_BALANCE, MENU_ORDERS, MENU_REFERRAL, MENU_SUPPORT, MENU_INFO, MENU_RULES, MENU_ADMIN, MENU_BROADCAST
@@ -113,11 +103,6 @@ async def process_topup_amount(message: Message, state: FSMContext, session: Asy
         
         data = await state.get_data()
         method = data.get("topup_method")
-        user_id = message.from_user.id
-        
-        stmt = select(User).where(User.telegram_id == user_id)
-        result = await session.execute(stmt)
-        user = result.scalar_one_or_none()
         
         if not user:
             await message.answer("Пользователь не найден")
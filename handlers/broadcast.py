@@ -4,10 +4,13 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from database.models import User
+from services.audience import (
+    AUDIENCE_ALL, SEGMENT_PRODUCT, SEGMENT_CATEGORY, SEGMENT_BALANCE, SEGMENT_INACTIVE,
+    SEGMENT_REFERRERS, SEGMENT_SUBSCRIBERS, SEGMENTS, parse_audience, resolve_audience, describe_audience, count_audience
+)
+from services.broadcast_jobs import create_broadcast_job, cancel_broadcast_job
+from services.reachability import is_unreachable_error, mark_unreachable
 from config import settings
-import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,6 +38,7 @@ class BroadcastStates(StatesGroup):
     """Состояния для рассылки"""
     waiting_message = State()
     waiting_user_id = State()
+    waiting_audience_param = State()
 
 
 def is_admin(user_id: int) -> bool:
@@ -69,22 +73,116 @@ async def broadcast_menu(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "broadcast_mass")
 async def broadcast_mass_start(callback: CallbackQuery, state: FSMContext):
-    """Начать массовую рассылку"""
+    """Начать массовую рассылку: выбор аудитории"""
     if not is_admin(callback.from_user.id):
         await callback.answer("Доступ запрещен", show_alert=True)
         return
     
-    await state.update_data(broadcast_type="mass")
-    await state.set_state(BroadcastStates.waiting_message)
+    await state.clear()
+    
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="👥 Все пользователи", callback_data=f"broadcast_audience_{AUDIENCE_ALL}")],
+        [InlineKeyboardButton(text="📦 Купившие товар", callback_data=f"broadcast_audience_{SEGMENT_PRODUCT}")],
+        [InlineKeyboardButton(text="📂 Купившие товар из категории", callback_data=f"broadcast_audience_{SEGMENT_CATEGORY}")],
+        [InlineKeyboardButton(text="💰 Баланс больше суммы", callback_data=f"broadcast_audience_{SEGMENT_BALANCE}")],
+        [InlineKeyboardButton(text="💤 Без заказов N дней", callback_data=f"broadcast_audience_{SEGMENT_INACTIVE}")],
+        [InlineKeyboardButton(text="🤝 Пригласившие друзей", callback_data=f"broadcast_audience_{SEGMENT_REFERRERS}")],
+        [InlineKeyboardButton(text="🔔 Ждут поступления товара", callback_data=f"broadcast_audience_{SEGMENT_SUBSCRIBERS}")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_menu")]
+    ])
     
-    from utils.keyboards import get_back_keyboard
     await callback.message.edit_text(
         "📢 <b>Массовая рассылка</b>\n\n"
-        "Отправьте сообщение для рассылки всем пользователям:",
+        "Выберите получателей:",
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+    await callback.answer()
+
+
+async def show_audience_preview(message: Message, state: FSMContext, session: AsyncSession, audience: str):
+    """Показать количество получателей и перейти к вводу сообщения"""
+    # Рассылка будет создана с той же границей периода, что и в предпросмотре
+    audience = resolve_audience(audience)
+    count = await count_audience(session, audience)
+    if count == 0:
+        await state.clear()
+        await message.answer(
+            f"📢 <b>Массовая рассылка</b>\n\n"
+            f"Аудитория: {describe_audience(audience)}\n\n"
+            f"Нет получателей.",
+            parse_mode="HTML"
+        )
+        return
+    
+    await state.update_data(broadcast_type="mass", audience=audience)
+    await state.set_state(BroadcastStates.waiting_message)
+    
+    from utils.keyboards import get_back_keyboard
+    await message.answer(
+        f"📢 <b>Массовая рассылка</b>\n\n"
+        f"Аудитория: {describe_audience(audience)}\n"
+        f"Получателей: {count}\n\n"
+        f"Отправьте сообщение для рассылки:",
         reply_markup=get_back_keyboard("admin_menu"),
         parse_mode="HTML"
     )
+
+
+@router.callback_query(F.data.startswith("broadcast_audience_"))
+async def broadcast_audience_selected(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    """Выбор сегмента аудитории"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещен", show_alert=True)
+        return
+    
+    segment = callback.data[len("broadcast_audience_"):]
+    if segment not in SEGMENTS:
+        await callback.answer("Неизвестная аудитория", show_alert=True)
+        return
+    prompts = {
+        SEGMENT_PRODUCT: "Введите ID товара:",
+        SEGMENT_CATEGORY: "Введите ID категории:",
+        SEGMENT_BALANCE: "Введите сумму (₽) - получат пользователи с балансом больше нее:",
+        SEGMENT_INACTIVE: "Введите количество дней без заказов:",
+        SEGMENT_SUBSCRIBERS: "Введите ID товара или 0 - все, кто ждет поступления любого товара:",
+    }
     await callback.answer()
+    
+    if segment in prompts:
+        await state.update_data(audience_segment=segment)
+        await state.set_state(BroadcastStates.waiting_audience_param)
+        await callback.message.edit_text(
+            f"📢 <b>Массовая рассылка</b>\n\n{prompts[segment]}",
+            parse_mode="HTML"
+        )
+        return
+    
+    await show_audience_preview(callback.message, state, session, segment)
+
+
+@router.message(BroadcastStates.waiting_audience_param)
+async def process_audience_param(message: Message, state: FSMContext, session: AsyncSession):
+    """Параметр сегмента аудитории (ID товара, сумма, количество дней)"""
+    if await check_menu_button_and_clear_state(message, state):
+        return
+    
+    data = await state.get_data()
+    segment = data.get("audience_segment")
+    value = (message.text or "").strip()
+    
+    if segment == SEGMENT_SUBSCRIBERS and value == "0":
+        audience = segment
+    else:
+        audience = f"{segment}:{value}"
+    try:
+        parse_audience(audience)
+    except ValueError:
+        await message.answer("Введите корректное положительное число:")
+        return
+    
+    await show_audience_preview(message, state, session, audience)
 
 
 @router.callback_query(F.data == "broadcast_individual")
@@ -131,18 +229,13 @@ async def send_broadcast_message(
     message_photo: str = None,
     message_document: str = None
 ):
-    """Отправить сообщение пользователю"""
-    try:
-        if message_photo:
-            await bot.send_photo(user_id, message_photo, caption=message_text)
-        elif message_document:
-            await bot.send_document(user_id, message_document, caption=message_text)
-        else:
-            await bot.send_message(user_id, message_text)
-        return True
-    except Exception as e:
-        logger.error(f"Error sending message to user {user_id}: {e}")
-        return False
+    """Отправить сообщение пользователю (ошибки Telegram пробрасываются)"""
+    if message_photo:
+        await bot.send_photo(user_id, message_photo, caption=message_text)
+    elif message_document:
+        await bot.send_document(user_id, message_document, caption=message_text)
+    else:
+        await bot.send_message(user_id, message_text)
 
 
 @router.message(BroadcastStates.waiting_message)
@@ -161,57 +254,8 @@ async def process_broadcast_message(message: Message, state: FSMContext, session
         return
     
     if broadcast_type == "mass":
-        # Массовая рассылка
-        await message.answer("📢 Начинаю массовую рассылку...")
-        
-        stmt = select(User).where(User.is_blocked == False)
-        result = await session.execute(stmt)
-        users = result.scalars().all()
-        
-        total = len(users)
-        success = 0
-        failed = 0
-        
-        # Throttling: не более 25 сообщений в секунду
-        throttle_delay = 1.0 / settings.BROADCAST_THROTTLE
-        
-        for user in users:
-            try:
-                # Определяем тип сообщения
-                if message.photo:
-                    await send_broadcast_message(
-                        message.bot,
-                        user.telegram_id,
-                        message.caption or "",
-                        message_photo=message.photo[-1].file_id
-                    )
-                elif message.document:
-                    await send_broadcast_message(
-                        message.bot,
-                        user.telegram_id,
-                        message.caption or "",
-                        message_document=message.document.file_id
-                    )
-                else:
-                    await send_broadcast_message(
-                        message.bot,
-                        user.telegram_id,
-                        message.text
-                    )
-                success += 1
-            except Exception as e:
-                logger.error(f"Error sending to user {user.telegram_id}: {e}")
-                failed += 1
-            
-            # Throttling
-            await asyncio.sleep(throttle_delay)
-        
-        await message.answer(
-            f"✅ Рассылка завершена!\n"
-            f"Всего: {total}\n"
-            f"Успешно: {success}\n"
-            f"Ошибок: {failed}"
-        )
+        # Массовая рассылка выполняется в фоне, прогресс обновляется в отдельном сообщении
+        await create_broadcast_job(session, message, data.get("audience", AUDIENCE_ALL))
         
     elif broadcast_type == "individual":
         # Индивидуальная рассылка
@@ -242,7 +286,22 @@ async def process_broadcast_message(message: Message, state: FSMContext, session
             await message.answer(f"✅ Сообщение отправлено пользователю {target_user_id}")
         except Exception as e:
             logger.error(f"Error sending to user {target_user_id}: {e}")
+            if is_unreachable_error(e):
+                await mark_unreachable([target_user_id])
             await message.answer(f"❌ Ошибка при отправке: {e}")
     
     await state.clear()
 
+
+@router.callback_query(F.data.startswith("broadcast_cancel_"))
+async def broadcast_cancel(callback: CallbackQuery, session: AsyncSession):
+    """Остановить массовую рассылку"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещен", show_alert=True)
+        return
+    
+    job_id = int(callback.data.split("_")[-1])
+    if await cancel_broadcast_job(session, job_id):
+        await callback.answer("⏹ Рассылка будет остановлена")
+    else:
+        await callback.answer("Рассылка уже завершена")
@@ -1,18 +1,22 @@
 """Обработчик каталога"""
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from database.models import Category, Product, StockNotification
+from database.models import Product, StockNotification
 from utils.keyboards import (
-    get_categories_keyboard, get_products_keyboard, get_product_detail_keyboard,
+    get_catalog_categories_keyboard, get_catalog_products_keyboard, get_product_detail_keyboard,
     get_payment_methods_keyboard
 )
 from utils.text import MENU_CATALOG
 from services.discount import calculate_total_price
 from services.account_service import reserve_accounts
+from services.catalog_cache import get_catalog
+from services.order_expiry import schedule_order_expiry
+from utils.pagination import parse_page_callback
 from database.models import Order, User
 from datetime import datetime, timedelta
 from config import settings
@@ -29,14 +33,13 @@ class OrderStates(StatesGroup):
 
 
 @router.message(F.text == MENU_CATALOG)
-async def show_catalog(message: Message, session: AsyncSession, state: FSMContext):
+async def show_catalog(message: Message, read_session: AsyncSession, state: FSMContext):
     """Показать каталог"""
     # Очищаем FSM состояние при переходе в каталог
     await state.clear()
     
-    stmt = select(Category).where(Category.is_active == True)
-    result = await session.execute(stmt)
-    categories = result.scalars().all()
+    catalog = await get_catalog(read_session)
+    categories = catalog.active_categories()
     
     if not categories:
         await message.answer("Каталог пуст. Обратитесь к администратору.")
@@ -44,16 +47,15 @@ async def show_catalog(message: Message, session: AsyncSession, state: FSMContex
     
     await message.answer(
         "📂 Выберите категорию:",
-        reply_markup=get_categories_keyboard(categories)
+        reply_markup=get_catalog_categories_keyboard(catalog)
     )
 
 
 @router.callback_query(F.data == "back_to_catalog")
-async def back_to_catalog(callback: CallbackQuery, session: AsyncSession):
+async def back_to_catalog(callback: CallbackQuery, read_session: AsyncSession):
     """Вернуться в каталог"""
-    stmt = select(Category).where(Category.is_active == True)
-    result = await session.execute(stmt)
-    categories = result.scalars().all()
+    catalog = await get_catalog(read_session)
+    categories = catalog.active_categories()
     
     if not categories:
         await callback.message.edit_text("Каталог пуст. Обратитесь к администратору.")
@@ -62,22 +64,18 @@ async def back_to_catalog(callback: CallbackQuery, session: AsyncSession):
     
     await callback.message.edit_text(
         "📂 Выберите категорию:",
-        reply_markup=get_categories_keyboard(categories)
+        reply_markup=get_catalog_categories_keyboard(catalog)
     )
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("category_"))
-async def show_category_products(callback: CallbackQuery, session: AsyncSession):
+async def show_category_products(callback: CallbackQuery, read_session: AsyncSession):
     """Показать товары категории"""
     category_id = int(callback.data.split("_")[1])
     
-    stmt = select(Product).where(
-        Product.category_id == category_id,
-        Product.is_active == True,
-    )
-    result = await session.execute(stmt)
-    products = result.scalars().all()
+    catalog = await get_catalog(read_session)
+    products = catalog.active_products(category_id)
     
     if not products:
         await callback.answer("В этой категории пока нет товаров", show_alert=True)
@@ -86,7 +84,30 @@ async def show_category_products(callback: CallbackQuery, session: AsyncSession)
     try:
         await callback.message.edit_text(
             "🛒 Выберите товар:",
-            reply_markup=get_products_keyboard(products, category_id),
+            reply_markup=get_catalog_products_keyboard(catalog, category_id),
+        )
+    except Exception as e:
+        # Игнорируем ошибку "message is not modified"
+        if "message is not modified" not in str(e).lower():
+            raise
+
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("catpage_"))
+async def show_category_products_page(callback: CallbackQuery, read_session: AsyncSession):
+    """Листание товаров категории (catpage_{category_id}_{n|p}_{product_id})"""
+    category_id = int(callback.data.split("_")[1])
+    direction, anchor_id = parse_page_callback(callback.data, f"catpage_{category_id}")
+    
+    catalog = await get_catalog(read_session)
+    if not catalog.active_products(category_id):
+        await callback.answer("В этой категории пока нет товаров", show_alert=True)
+        return
+    
+    try:
+        await callback.message.edit_reply_markup(
+            reply_markup=get_catalog_products_keyboard(catalog, category_id, anchor_id, direction),
         )
     except Exception as e:
         # Игнорируем ошибку "message is not modified"
@@ -97,13 +118,12 @@ async def show_category_products(callback: CallbackQuery, session: AsyncSession)
 
 
 @router.callback_query(F.data.startswith("product_"))
-async def show_product_detail(callback: CallbackQuery, session: AsyncSession):
+async def show_product_detail(callback: CallbackQuery, read_session: AsyncSession):
     """Показать детали товара"""
     product_id = int(callback.data.split("_")[1])
     
-    stmt = select(Product).where(Product.id == product_id)
-    result = await session.execute(stmt)
-    product = result.scalar_one_or_none()
+    catalog = await get_catalog(read_session)
+    product = catalog.get_product(product_id)
     
     if not product:
         await callback.answer("Товар не найден", show_alert=True)
@@ -164,7 +184,7 @@ async def show_product_detail(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("buy_"))
-async def start_buy_process(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+async def start_buy_process(callback: CallbackQuery, state: FSMContext, session: AsyncSession, user: Optional[User]):
     """Начать процесс покупки"""
     product_id = int(callback.data.split("_")[1])
     
@@ -177,11 +197,6 @@ async def start_buy_process(callback: CallbackQuery, state: FSMContext, session:
         return
     
     # Проверяем количество неоплаченных заказов
-    user_id = callback.from_user.id
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
-    
     if user:
         stmt_orders = select(Order).where(
             Order.user_id == user.id,
@@ -211,7 +226,7 @@ async def start_buy_process(callback: CallbackQuery, state: FSMContext, session:
 
 
 @router.message(OrderStates.waiting_quantity)
-async def process_quantity(message: Message, state: FSMContext, session: AsyncSession):
+async def process_quantity(message: Message, state: FSMContext, session: AsyncSession, user: Optional[User]):
     """Обработка введенного количества"""
     # Проверяем, не выбрана ли кнопка меню
     from utils.text import MENU_CATALOG, MENU_BALANCE, MENU_ORDERS, MENU_REFERRAL, MENU_SUPPORT, MENU_INFO, MENU_RULES, MENU_ADMIN, MENU_BROADCAST
@@ -248,12 +263,6 @@ async def process_quantity(message: Message, state: FSMContext, session: AsyncSe
             await state.clear()
             return
         
-        # Получаем пользователя
-        user_id = message.from_user.id
-        stmt_user = select(User).where(User.telegram_id == user_id)
-        result_user = await session.execute(stmt_user)
-        user = result_user.scalar_one_or_none()
-        
         if not user:
             await message.answer("Пользователь не найден. Используйте /start")
             await state.clear()
@@ -266,6 +275,8 @@ async def process_quantity(message: Message, state: FSMContext, session: AsyncSe
         try:
             reserved_accounts = await reserve_accounts(session, product_id, quantity, None)
         except ValueError as e:
+            # Аккаунты уже захвачены UPDATE ... RETURNING - снимаем захват и блокировки
+            await session.rollback()
             await message.answer(f"❌ {str(e)}")
             await state.clear()
             return
@@ -296,6 +307,7 @@ async def process_quantity(message: Message, state: FSMContext, session: AsyncSe
         
         await session.commit()
         await session.refresh(order)
+        schedule_order_expiry(order.id, order.reserved_until)
         
         # Уведомляем администраторов о новом заказе
         try:
@@ -353,12 +365,11 @@ async def process_quantity(message: Message, state: FSMContext, session: AsyncSe
 
 
 @router.callback_query(F.data == "back_to_products")
-async def back_to_products(callback: CallbackQuery, session: AsyncSession):
+async def back_to_products(callback: CallbackQuery, read_session: AsyncSession):
     """Вернуться к списку товаров"""
     # Возвращаемся в каталог
-    stmt = select(Category).where(Category.is_active == True)
-    result = await session.execute(stmt)
-    categories = result.scalars().all()
+    catalog = await get_catalog(read_session)
+    categories = catalog.active_categories()
     
     if not categories:
         await callback.message.edit_text("Каталог пуст. Обратитесь к администратору.")
@@ -367,21 +378,15 @@ async def back_to_products(callback: CallbackQuery, session: AsyncSession):
     
     await callback.message.edit_text(
         "📂 Выберите категорию:",
-        reply_markup=get_categories_keyboard(categories)
+        reply_markup=get_catalog_categories_keyboard(catalog)
     )
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("notify_"))
-async def subscribe_notification(callback: CallbackQuery, session: AsyncSession):
+async def subscribe_notification(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Подписка на уведомление о поступлении товара"""
     product_id = int(callback.data.split("_")[1])
-    user_id = callback.from_user.id
-    
-    # Получаем пользователя
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
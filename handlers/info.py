@@ -1,4 +1,5 @@
 """Обработчик информации и поддержки"""
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
@@ -217,15 +218,8 @@ async def handle_support_reply(message: Message, session: AsyncSession):
 
 
 
-async def forward_to_support_chat(message: Message, session: AsyncSession):
+async def forward_to_support_chat(message: Message, session: AsyncSession, user: Optional[User]):
     """Пересылка сообщения пользователя в чат поддержки"""
-    user_id = message.from_user.id
-    
-    # Получаем пользователя из БД
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    
     if not user:
         await message.answer("Вы не зарегистрированы. Используйте /start")
         return False
@@ -302,7 +296,7 @@ async def forward_to_support_chat(message: Message, session: AsyncSession):
 
 
 @router.message(F.chat.type == "private")
-async def handle_user_message(message: Message, session: AsyncSession, state: FSMContext):
+async def handle_user_message(message: Message, session: AsyncSession, state: FSMContext, user: Optional[User]):
     """Обработка сообщений от пользователей для поддержки"""
     # Проверяем, что это не команда
     if message.text and message.text.startswith('/'):
@@ -326,5 +320,5 @@ async def handle_user_message(message: Message, session: AsyncSession, state: FS
         return  # Администраторы могут отправлять обычные сообщения
     
     # Пересылаем в поддержку
-    await forward_to_support_chat(message, session)
+    await forward_to_support_chat(message, session, user)
 
@@ -1,4 +1,5 @@
 """Обработчик заказов"""
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
@@ -6,6 +7,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from database.models import Order, User, Product
 from services.account_service import get_accounts_for_order, create_accounts_file
+from services.catalog_cache import mark_stock_changed
+from services.payment_reconciler import close_order_payments
 from utils.keyboards import get_orders_keyboard, get_order_detail_keyboard
 from utils.text import MENU_ORDERS
 from aiogram.types import BufferedInputFile
@@ -17,23 +20,17 @@ router = Router()
 
 
 @router.message(F.text == MENU_ORDERS)
-async def show_orders(message: Message, session: AsyncSession, state: FSMContext):
+async def show_orders(message: Message, read_session: AsyncSession, state: FSMContext, user: Optional[User]):
     """Показать заказы пользователя"""
     # Очищаем FSM состояние при переходе в заказы
     await state.clear()
     
-    user_id = message.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
-    
     if not user:
         await message.answer("Пользователь не найден. Используйте /start")
         return
     
     stmt = select(Order).where(Order.user_id == user.id).order_by(Order.created_at.desc())
-    result = await session.execute(stmt)
+    result = await read_session.execute(stmt)
     orders = result.scalars().all()
     
     if not orders:
@@ -47,20 +44,14 @@ async def show_orders(message: Message, session: AsyncSession, state: FSMContext
 
 
 @router.callback_query(F.data == "my_orders")
-async def show_orders_callback(callback: CallbackQuery, session: AsyncSession):
+async def show_orders_callback(callback: CallbackQuery, read_session: AsyncSession, user: Optional[User]):
     """Показать заказы (callback)"""
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
-    
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
     
     stmt = select(Order).where(Order.user_id == user.id).order_by(Order.created_at.desc())
-    result = await session.execute(stmt)
+    result = await read_session.execute(stmt)
     orders = result.scalars().all()
     
     if not orders:
@@ -76,21 +67,16 @@ async def show_orders_callback(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("order_"))
-async def show_order_detail(callback: CallbackQuery, session: AsyncSession):
+async def show_order_detail(callback: CallbackQuery, read_session: AsyncSession, user: Optional[User]):
     """Показать детали заказа"""
     order_id = int(callback.data.split("_")[1])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
     
     stmt = select(Order).where(Order.id == order_id, Order.user_id == user.id)
-    result = await session.execute(stmt)
+    result = await read_session.execute(stmt)
     order = result.scalar_one_or_none()
     
     if not order:
@@ -99,7 +85,7 @@ async def show_order_detail(callback: CallbackQuery, session: AsyncSession):
     
     # Получаем товар
     stmt_product = select(Product).where(Product.id == order.product_id)
-    result_product = await session.execute(stmt_product)
+    result_product = await read_session.execute(stmt_product)
     product = result_product.scalar_one_or_none()
     
     status_emoji = {
@@ -142,14 +128,9 @@ async def show_order_detail(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("pay_order_"))
-async def pay_order(callback: CallbackQuery, session: AsyncSession):
+async def pay_order(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Оплатить неоплаченный заказ"""
     order_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -192,14 +173,9 @@ async def pay_order(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("cancel_order_"))
-async def cancel_order_from_detail(callback: CallbackQuery, session: AsyncSession):
+async def cancel_order_from_detail(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Отменить заказ из деталей"""
     order_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -246,10 +222,12 @@ async def cancel_order_from_detail(callback: CallbackQuery, session: AsyncSessio
             .where(Product.id == order.product_id)
             .values(stock_count=Product.stock_count + order.quantity)
         )
+        mark_stock_changed(session, order.product_id)
     
     # Отменяем заказ
     order.status = "ОТМЕНЕНО"
     order.reserved_until = None
+    await close_order_payments(session, [order.id], "FAILED")
     await session.commit()
     
     from utils.keyboards import get_back_keyboard
@@ -262,14 +240,9 @@ async def cancel_order_from_detail(callback: CallbackQuery, session: AsyncSessio
 
 
 @router.callback_query(F.data.startswith("download_"))
-async def download_order(callback: CallbackQuery, session: AsyncSession):
+async def download_order(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Скачать товар из заказа"""
     order_id = int(callback.data.split("_")[1])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -1,16 +1,17 @@
 """Обработчик платежей"""
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, LabeledPrice, InlineKeyboardMarkup, InlineKeyboardButton, PreCheckoutQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
-from database.models import Order, User, Payment as PaymentModel, Account, ReferralTransaction, Product
+from database.models import Order, User, Account, Product, Payment as PaymentModel
 from services.payment import PaymentService
-from services.account_service import reserve_accounts, create_accounts_file, get_accounts_for_order
+from services.catalog_cache import mark_stock_changed
+from services.payment_reconciler import close_order_payments
+from services.settlement import settle_order, settle_orders_batch, SettlementResult
 from services.discount import calculate_total_price
 from utils.keyboards import get_main_menu_keyboard
 from config import settings
-from datetime import datetime
-from aiogram.types import BufferedInputFile
 import logging
 
 logger = logging.getLogger(__name__)
@@ -18,114 +19,10 @@ logger = logging.getLogger(__name__)
 router = Router()
 
 
-async def process_payment_success(
-    session: AsyncSession,
-    order_id: int,
-    payment_method: str,
-    payment_id: str = None
-):
-    """Обработка успешной оплаты"""
-    try:
-        # Получаем заказ
-        stmt = select(Order).where(Order.id == order_id)
-        result = await session.execute(stmt)
-        order = result.scalar_one_or_none()
-
-        if not order or order.status != "ОЖИДАЕТ ОПЛАТЫ":
-            return (False, None, None)
-
-        # Получаем уже зарезервированные товары (они были зарезервированы при создании заказа)
-        accounts = await get_accounts_for_order(session, order.id)
-
-        # Если товары не найдены  резервируем
-        if not accounts:
-            accounts = await reserve_accounts(session, order.product_id, order.quantity, order.id)
-
-        # Обновляем заказ
-        order.status = "ОПЛАЧЕНО"
-        order.payment_method = payment_method
-        order.payment_id = payment_id
-        order.paid_at = datetime.now()
-        order.reserved_until = None
-
-        # Создаем запись платежа
-        payment = PaymentModel(
-            user_id=order.user_id,
-            amount=order.total_amount,
-            payment_method=payment_method,
-            payment_id=payment_id,
-            status="SUCCESS",
-            order_id=order.id,
-            completed_at=datetime.now()
-        )
-        session.add(payment)
-
-        # Если оплата с баланса, списываем средства
-        if payment_method == "balance":
-            await session.execute(
-                update(User)
-                .where(User.id == order.user_id)
-                .values(balance=User.balance - order.total_amount)
-            )
-
-        # Обработка реферальной системы
-        stmt_user = select(User).where(User.id == order.user_id)
-        result_user = await session.execute(stmt_user)
-        user = result_user.scalar_one_or_none()
-
-        if user and user.referred_by:
-            commission = order.total_amount * (settings.REFERRAL_COMMISSION / 100)
-            await session.execute(
-                update(User)
-                .where(User.id == user.referred_by)
-                .values(balance=User.balance + commission)
-            )
-
-            # Создаем запись реферальной транзакции
-            ref_transaction = ReferralTransaction(
-                referrer_id=user.referred_by,
-                referred_id=user.id,
-                order_id=order.id,
-                amount=order.total_amount,
-                commission=commission
-            )
-            session.add(ref_transaction)
-
-        # Выдаем товар
-        order.status = "ВЫПОЛНЕНО"
-        order.completed_at = datetime.now()
-
-        # Удаляем аккаунты из базы данных после выдачи (физическое удаление)
-        if accounts:
-            account_ids = [acc.id for acc in accounts]
-            from sqlalchemy import delete
-            await session.execute(
-                delete(Account)
-                .where(Account.id.in_(account_ids))
-            )
-            # stock_count уже был уменьшен при резервировании аккаунтов,
-            # поэтому здесь не нужно уменьшать его повторно
-
-        # Коммитим изменения
-        await session.commit()
-
-        return (True, accounts, order)
-
-    except Exception as e:
-        logger.error(f"Error processing payment: {e}", exc_info=True)
-        await session.rollback()
-        return (False, None, None)
-
-
 @router.callback_query(F.data.startswith("pay_balance_"))
-async def pay_from_balance(callback: CallbackQuery, session: AsyncSession):
+async def pay_from_balance(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Оплата с баланса"""
     order_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -150,31 +47,17 @@ async def pay_from_balance(callback: CallbackQuery, session: AsyncSession):
         )
         return
     
-    # Обрабатываем оплату
-    success, accounts, order_obj = await process_payment_success(
-        session, order_id, "balance"
-    )
+    # Проводим оплату (списание с баланса - в той же транзакции)
+    settlement = await settle_order(session, order_id, "balance", user_id=user.id)
     
-    if success:
-        # Отправляем товар
-        file_obj = await create_accounts_file(accounts)
-        
-        await callback.message.answer_document(
-            BufferedInputFile(
-                file_obj.read(),
-                filename=file_obj.name
-            ),
-            caption=f"✅ Заказ #{order_id} оплачен и выполнен!\n\n📦 Ваш товар:"
-        )
-        
-        # Уведомляем администраторов
-        from services.notifications import notify_admins_about_purchase
-        await notify_admins_about_purchase(session, order_obj, callback.bot)
-        
+    if settlement.settled:
+        # Товар отправляется из outbox отдельным сообщением
         await callback.message.edit_text(
             f"✅ Заказ #{order_id} успешно оплачен с баланса!\n\n"
-            f"Товар отправлен в сообщении выше."
+            f"Товар будет отправлен отдельным сообщением."
         )
+    elif settlement.status == SettlementResult.INSUFFICIENT_FUNDS:
+        await callback.answer("Недостаточно средств на балансе", show_alert=True)
     else:
         await callback.answer("Ошибка при обработке платежа", show_alert=True)
     
@@ -186,7 +69,7 @@ async def pay_from_balance(callback: CallbackQuery, session: AsyncSession):
 # В продакшн закомментируйте этот блок полностью
 # TODO
 @router.callback_query(F.data.startswith("pay_test_"))
-async def pay_test(callback: CallbackQuery, session: AsyncSession):
+async def pay_test(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Тестовая оплата (для разработки)"""
     from config import settings
     
@@ -198,10 +81,6 @@ async def pay_test(callback: CallbackQuery, session: AsyncSession):
     order_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
     
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
-    
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
@@ -220,37 +99,24 @@ async def pay_test(callback: CallbackQuery, session: AsyncSession):
     
     # Тестовая оплата - сразу обрабатываем как успешную
     try:
-        success, accounts, order_obj = await process_payment_success(
-            session, order_id, "test"
+        settlement = await settle_order(
+            session, order_id, "test", user_id=user.id,
+            caption=f"✅ Заказ #{order_id} оплачен (тестовая оплата)!\n\n📦 Ваш товар:"
         )
 
-        if success and accounts:
-            # Отправляем товар
-            file_obj = await create_accounts_file(accounts)
-
-            await callback.message.answer_document(
-                BufferedInputFile(
-                    file_obj.read(),
-                    filename=file_obj.name
-                ),
-                caption=f"✅ Заказ #{order_id} оплачен (тестовая оплата)!\n\n📦 Ваш товар:"
-            )
-
-            # Уведомляем администраторов
-            from services.notifications import notify_admins_about_purchase
-            await notify_admins_about_purchase(session, order_obj, callback.bot)
-
+        if settlement.settled:
+            # Товар отправляется из outbox отдельным сообщением
             await callback.message.edit_text(
                 f"✅ Заказ #{order_id} успешно оплачен (тестовая оплата)!\n\n"
-                f"Товар отправлен в сообщении выше."
+                f"Товар будет отправлен отдельным сообщением."
             )
             await callback.answer("✅ Оплата успешна")
-        elif success:
-            # Заказ оплачен, но аккаунты не найдены
+        elif settlement.status == SettlementResult.NO_STOCK:
+            # Товар для выдачи не найден - оплата не проведена
             from utils.keyboards import get_back_keyboard
             await callback.message.edit_text(
-                f"✅ Заказ #{order_id} успешно оплачен (тестовая оплата)!\n\n"
-                f"⚠️ Товар не найден. Обратитесь в поддержку.",
+                f"⚠️ Заказ #{order_id} не оплачен: товар не найден.\n\n"
+                f"Обратитесь в поддержку.",
                 reply_markup=get_back_keyboard("my_orders")
             )
             await callback.answer("⚠️ Товар не найден")
@@ -266,14 +132,9 @@ async def pay_test(callback: CallbackQuery, session: AsyncSession):
 # ========== ОБРАБОТЧИКИ ПЛАТЕЖНЫХ СИСТЕМ ==========
 
 @router.callback_query(F.data.startswith("pay_yookassa_"))
-async def pay_yookassa(callback: CallbackQuery, session: AsyncSession):
+async def pay_yookassa(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Оплата через ЮКасса"""
     order_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -296,8 +157,16 @@ async def pay_yookassa(callback: CallbackQuery, session: AsyncSession):
     )
     
     if payment_data:
-        # Сохраняем payment_id в заказе
+        # Сохраняем payment_id в заказе и ожидающий платеж (для сверки статуса, если webhook не придет)
         order.payment_id = payment_data.get("payment_id")
+        session.add(PaymentModel(
+            user_id=user.id,
+            amount=order.total_amount,
+            payment_method="yookassa",
+            payment_id=order.payment_id,
+            status="PENDING",
+            order_id=order.id
+        ))
         await session.commit()
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -320,14 +189,9 @@ async def pay_yookassa(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("pay_heleket_"))
-async def pay_heleket(callback: CallbackQuery, session: AsyncSession):
+async def pay_heleket(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Оплата через Heleket"""
     order_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -350,7 +214,16 @@ async def pay_heleket(callback: CallbackQuery, session: AsyncSession):
     )
     
     if payment_data:
+        # Сохраняем payment_id в заказе и ожидающий платеж (для сверки статуса, если webhook не придет)
         order.payment_id = payment_data.get("payment_id")
+        session.add(PaymentModel(
+            user_id=user.id,
+            amount=order.total_amount,
+            payment_method="heleket",
+            payment_id=order.payment_id,
+            status="PENDING",
+            order_id=order.id
+        ))
         await session.commit()
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -373,14 +246,9 @@ async def pay_heleket(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("pay_stars_"))
-async def pay_stars(callback: CallbackQuery, session: AsyncSession):
+async def pay_stars(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Оплата через Telegram Stars"""
     order_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -429,14 +297,9 @@ async def pay_stars(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("cancel_order_"))
-async def cancel_order(callback: CallbackQuery, session: AsyncSession):
+async def cancel_order(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Отмена заказа"""
     order_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -482,10 +345,12 @@ async def cancel_order(callback: CallbackQuery, session: AsyncSession):
             .where(Product.id == order.product_id)
             .values(stock_count=Product.stock_count + order.quantity)
         )
+        mark_stock_changed(session, order.product_id)
     
     # Отменяем заказ
     order.status = "ОТМЕНЕНО"
     order.reserved_until = None
+    await close_order_payments(session, [order.id], "FAILED")
     await session.commit()
     
     from utils.keyboards import get_back_keyboard
@@ -498,14 +363,8 @@ async def cancel_order(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("pay_all_orders_"))
-async def pay_all_orders(callback: CallbackQuery, session: AsyncSession):
+async def pay_all_orders(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Оплатить все заказы из корзины"""
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
-    
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
@@ -576,14 +435,8 @@ async def pay_all_orders(callback: CallbackQuery, session: AsyncSession):
 
 
 @router.callback_query(F.data.startswith("pay_all_balance_"))
-async def pay_all_orders_balance(callback: CallbackQuery, session: AsyncSession):
+async def pay_all_orders_balance(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Оплатить все заказы с баланса"""
-    user_id = callback.from_user.id
-    
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
-    
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
@@ -624,50 +477,20 @@ async def pay_all_orders_balance(callback: CallbackQuery, session: AsyncSession)
         )
         return
     
-    # Оплачиваем все заказы
-    successful_orders = []
-    failed_orders = []
-    
-    for order in orders:
-        success, accounts, order_obj = await process_payment_success(
-            session, order.id, "balance"
-        )
-        
-        if success:
-            successful_orders.append((order_obj, accounts))
-        else:
-            failed_orders.append(order.id)
-    
-    # Обновляем баланс пользователя
-    if successful_orders:
-        await session.execute(
-            update(User)
-            .where(User.id == user.id)
-            .values(balance=User.balance - total_amount)
-        )
-        await session.commit()
-    
-    # Отправляем товары
-    from services.notifications import notify_admins_about_purchase
-    
-    for order_obj, accounts in successful_orders:
-        file_obj = await create_accounts_file(accounts)
-        
-        await callback.message.answer_document(
-            BufferedInputFile(
-                file_obj.read(),
-                filename=file_obj.name
-            ),
-            caption=f"✅ Заказ #{order_obj.id} оплачен и выполнен!\n\n📦 Ваш товар:"
-        )
-        
-        await notify_admins_about_purchase(session, order_obj, callback.bot)
+    # Оплачиваем все заказы одной транзакцией: одно списание, один файл с товаром
+    settlement = await settle_orders_batch(session, [order.id for order in orders], user.id)
     
     # Формируем итоговое сообщение
-    if successful_orders and not failed_orders:
-        text = f"✅ Все заказы успешно оплачены и выполнены!\n\nОплачено заказов: {len(successful_orders)}\n💰 Сумма: {total_amount:.2f} ₽"
-    elif successful_orders:
-        text = f"✅ Оплачено заказов: {len(successful_orders)}\n❌ Не удалось оплатить: {len(failed_orders)}"
+    if settlement.settled:
+        paid_amount = sum(order.total_amount for order in settlement.orders)
+        text = (
+            f"✅ Все заказы успешно оплачены и выполнены!\n\n"
+            f"Оплачено заказов: {len(settlement.orders)}\n"
+            f"💰 Сумма: {paid_amount:.2f} ₽\n\n"
+            f"Товар будет отправлен одним файлом."
+        )
+    elif settlement.status == SettlementResult.INSUFFICIENT_FUNDS:
+        text = "❌ Недостаточно средств на балансе"
     else:
         text = "❌ Не удалось оплатить заказы"
     
@@ -678,18 +501,13 @@ async def pay_all_orders_balance(callback: CallbackQuery, session: AsyncSession)
 # ========== WEBHOOK ОБРАБОТЧИКИ ДЛЯ ПЛАТЕЖНЫХ СИСТЕМ ==========
 
 @router.message(F.successful_payment)
-async def handle_successful_payment(message, session: AsyncSession):
+async def handle_successful_payment(message, session: AsyncSession, user: Optional[User]):
     """Обработка успешной оплаты через Telegram Stars"""
     payment = message.successful_payment
     payload = payment.invoice_payload
     
     if payload.startswith("order_"):
         order_id = int(payload.split("_")[1])
-        user_id = message.from_user.id
-        
-        stmt_user = select(User).where(User.telegram_id == user_id)
-        result_user = await session.execute(stmt_user)
-        user = result_user.scalar_one_or_none()
         
         if user:
             stmt = select(Order).where(Order.id == order_id, Order.user_id == user.id)
@@ -697,23 +515,12 @@ async def handle_successful_payment(message, session: AsyncSession):
             order = result.scalar_one_or_none()
             
             if order and order.status == "ОЖИДАЕТ ОПЛАТЫ":
-                success, accounts, order_obj = await process_payment_success(
-                    session, order_id, "stars", payment.telegram_payment_charge_id
+                settlement = await settle_order(
+                    session, order_id, "stars", payment.telegram_payment_charge_id, user_id=user.id
                 )
                 
-                if success:
-                    file_obj = await create_accounts_file(accounts)
-                    
-                    await message.answer_document(
-                        BufferedInputFile(
-                            file_obj.read(),
-                            filename=file_obj.name
-                        ),
-                        caption=f"✅ Заказ #{order_id} оплачен и выполнен!\n\n📦 Ваш товар:"
-                    )
-                    
-                    from services.notifications import notify_admins_about_purchase
-                    await notify_admins_about_purchase(session, order_obj, message.bot)
+                if not settlement.ok:
+                    logger.error(f"Stars payment processing failed for order {order_id}")
 
 
 @router.pre_checkout_query()
@@ -1,4 +1,5 @@
 """Обработчик реферальной системы"""
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
@@ -13,17 +14,11 @@ router = Router()
 
 
 @router.message(F.text == MENU_REFERRAL)
-async def show_referral(message: Message, session: AsyncSession, state: FSMContext):
+async def show_referral(message: Message, session: AsyncSession, state: FSMContext, user: Optional[User]):
     """Показать реферальную ссылку и статистику"""
     # Очищаем FSM состояние при переходе в реферальную систему
     await state.clear()
     
-    user_id = message.from_user.id
-    
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    
     if not user or not user.referral_code:
         await message.answer("Пользователь не найден. Используйте /start")
         return
@@ -68,14 +63,8 @@ async def show_referral(message: Message, session: AsyncSession, state: FSMConte
 
 
 @router.callback_query(F.data == "referral_stats")
-async def show_referral_stats(callback: CallbackQuery, session: AsyncSession):
+async def show_referral_stats(callback: CallbackQuery, session: AsyncSession, user: Optional[User]):
     """Показать подробную статистику рефералов"""
-    user_id = callback.from_user.id
-    
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
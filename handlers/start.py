@@ -1,4 +1,5 @@
 """Обработчик команды /start"""
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import CommandStart
@@ -10,6 +11,7 @@ from database.database import get_session
 from utils.keyboards import get_main_menu_keyboard
 from utils.text import WELCOME_MESSAGE
 from config import settings
+from services.user_access import invalidate_user_access
 from database.models import Setting
 import secrets
 import string
@@ -23,7 +25,7 @@ def generate_referral_code() -> str:
 
 
 @router.message(CommandStart())
-async def cmd_start(message: Message, session: AsyncSession):
+async def cmd_start(message: Message, session: AsyncSession, user: Optional[User]):
     """Обработка команды /start"""
     user_id = message.from_user.id
     username = message.from_user.username
@@ -34,11 +36,7 @@ async def cmd_start(message: Message, session: AsyncSession):
     if len(message.text.split()) > 1:
         referral_code = message.text.split()[1]
     
-    # Получаем или создаем пользователя
-    stmt = select(User).where(User.telegram_id == user_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    
+    # Создаем пользователя, если он еще не зарегистрирован
     if not user:
         # Создаем нового пользователя
         referred_by = None
@@ -77,6 +75,7 @@ async def cmd_start(message: Message, session: AsyncSession):
         session.add(user)
         await session.commit()
         await session.refresh(user)
+        invalidate_user_access(user_id)
         
         # Уведомляем администраторов о новой регистрации
         try:
@@ -115,6 +114,7 @@ async def cmd_start(message: Message, session: AsyncSession):
             pass
         
         await session.commit()
+        invalidate_user_access(user_id)
         # Получаем приветствие из настроек или используем по умолчанию
         stmt_setting = select(Setting).where(Setting.key == "welcome_text")
         result_setting = await session.execute(stmt_setting)
@@ -133,18 +133,13 @@ async def cmd_start(message: Message, session: AsyncSession):
 
 
 @router.callback_query(F.data == "back_to_menu")
-async def back_to_menu(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
+async def back_to_menu(callback: CallbackQuery, session: AsyncSession, state: FSMContext, user: Optional[User]):
     """Возврат в главное меню"""
     # Очищаем FSM состояние
     await state.clear()
     
     user_id = callback.from_user.id
     
-    # Получаем пользователя из БД для проверки роли
-    stmt_user = select(User).where(User.telegram_id == user_id)
-    result_user = await session.execute(stmt_user)
-    user = result_user.scalar_one_or_none()
-    
     # Проверяем права администратора (гибридная проверка: .env + БД)
     is_admin = user_id in settings.admin_ids_list or user_id in settings.developer_ids_list
     if not is_admin and user and user.role in ("admin", "developer"):
@@ -15,211 +15,59 @@
 Webhook endpoints:
 - POST /webhook/yookassa - обработчик webhook от ЮКасса
 - POST /webhook/heleket - обработчик webhook от Heleket
-- GET /health - проверка работоспособности
+- GET /health - проверка работоспособности и статистика пула соединений БД
 
 Важно:
 - Webhook обработчики проверяют подпись запросов для безопасности
 - Все webhook запросы логируются
 - Обработка платежей идемпотентна (безопасна при повторных запросах)
+- Webhook платежных систем только сохраняет событие в inbox (payment_events)
+  и сразу отвечает 200, платеж обрабатывается фоновыми воркерами
 """
 import json
 import logging
 from typing import Dict, Any
 from aiohttp import web
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import update
 from database.database import async_session_maker
-from database.models import Payment, User, Order, Account
-from services.payment import PaymentService
-from services.account_service import reserve_accounts, create_accounts_file, get_accounts_for_order
-from services.notifications import notify_admins_about_purchase
-from config import settings
-from datetime import datetime
+from database.models import Payment
+from services.payment import PaymentService, get_payment_api_stats
+from services.payment_inbox import store_payment_event, payment_inbox
+from services.delivery_outbox import delivery_outbox
+from services.payment_reconciler import payment_reconciler, unmatched_payment_reason, close_unmatched_payment
+from services.update_queue import update_queue
+from services.job_scheduler import job_scheduler
+from services.settlement import settle_order, settle_balance_topup
+from services.lease_queue import PermanentFailure
 from aiogram import Bot
-from aiogram.types import BufferedInputFile
 
 logger = logging.getLogger(__name__)
 
 
-async def process_balance_topup(
-    session: AsyncSession,
-    user_id: int,
-    amount: float,
-    payment_id: str,
-    payment_method: str
-) -> bool:
-    """Обработать пополнение баланса"""
-    try:
-        # Проверяем, не обработан ли уже этот платеж
-        stmt = select(Payment).where(
-            Payment.payment_id == payment_id,
-            Payment.payment_method == payment_method
-        )
-        result = await session.execute(stmt)
-        existing_payment = result.scalar_one_or_none()
-        
-        if existing_payment and existing_payment.status == "SUCCESS":
-            logger.info(f"Payment {payment_id} already processed")
-            return True
-        
-        # Получаем пользователя
-        stmt_user = select(User).where(User.id == user_id)
-        result_user = await session.execute(stmt_user)
-        user = result_user.scalar_one_or_none()
-        
-        if not user:
-            logger.error(f"User {user_id} not found")
-            return False
-        
-        # Обновляем или создаем запись платежа
-        if existing_payment:
-            existing_payment.status = "SUCCESS"
-            existing_payment.completed_at = datetime.now()
-        else:
-            payment = Payment(
-                user_id=user_id,
-                amount=amount,
-                payment_method=payment_method,
-                payment_id=payment_id,
-                status="SUCCESS",
-                completed_at=datetime.now()
-            )
-            session.add(payment)
-        
-        # Пополняем баланс
-        await session.execute(
-            update(User)
-            .where(User.id == user_id)
-            .values(balance=User.balance + amount)
-        )
-        
-        await session.commit()
-        logger.info(f"Balance topup successful: user {user_id}, amount {amount}, payment {payment_id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing balance topup: {e}", exc_info=True)
-        await session.rollback()
-        return False
-
-
 async def process_order_payment(
     session: AsyncSession,
     order_id: int,
     payment_id: str,
     payment_method: str,
+    amount: float = 0,
     bot: Bot = None
 ) -> bool:
-    """Обработать оплату заказа"""
-    try:
-        # Получаем заказ
-        stmt = select(Order).where(Order.id == order_id)
-        result = await session.execute(stmt)
-        order = result.scalar_one_or_none()
-        
-        if not order:
-            logger.error(f"Order {order_id} not found")
-            return False
-        
-        # Проверяем, не оплачен ли уже заказ
-        if order.status != "ОЖИДАЕТ ОПЛАТЫ":
-            logger.info(f"Order {order_id} already processed (status: {order.status})")
-            return True
-        
-        # Получаем зарезервированные аккаунты
-        accounts = await get_accounts_for_order(session, order.id)
-        
-        # Если товары не найдены, резервируем
-        if not accounts:
-            accounts = await reserve_accounts(session, order.product_id, order.quantity, order.id)
-        
-        if not accounts:
-            logger.error(f"No accounts available for order {order_id}")
-            return False
-        
-        # Обновляем заказ
-        order.status = "ОПЛАЧЕНО"
-        order.payment_method = payment_method
-        order.payment_id = payment_id
-        order.paid_at = datetime.now()
-        order.reserved_until = None
-        
-        # Создаем запись платежа
-        payment = Payment(
-            user_id=order.user_id,
-            amount=order.total_amount,
-            payment_method=payment_method,
-            payment_id=payment_id,
-            status="SUCCESS",
-            order_id=order.id,
-            completed_at=datetime.now()
-        )
-        session.add(payment)
-        
-        # Обработка реферальной системы
-        stmt_user = select(User).where(User.id == order.user_id)
-        result_user = await session.execute(stmt_user)
-        user = result_user.scalar_one_or_none()
-        
-        if user and user.referred_by:
-            commission = order.total_amount * (settings.REFERRAL_COMMISSION / 100)
-            await session.execute(
-                update(User)
-                .where(User.id == user.referred_by)
-                .values(balance=User.balance + commission)
-            )
-            
-            from database.models import ReferralTransaction
-            ref_transaction = ReferralTransaction(
-                referrer_id=user.referred_by,
-                referred_id=user.id,
-                order_id=order.id,
-                amount=order.total_amount,
-                commission=commission
-            )
-            session.add(ref_transaction)
-        
-        # Выдаем товар
-        order.status = "ВЫПОЛНЕНО"
-        order.completed_at = datetime.now()
-        
-        # Удаляем аккаунты из базы данных после выдачи
-        if accounts:
-            account_ids = [acc.id for acc in accounts]
-            from sqlalchemy import delete
-            await session.execute(
-                delete(Account)
-                .where(Account.id.in_(account_ids))
-            )
-        
-        await session.commit()
-        
-        # Отправляем товар пользователю через бота
-        if bot:
-            try:
-                file_obj = await create_accounts_file(accounts)
-                
-                await bot.send_document(
-                    user.telegram_id,
-                    BufferedInputFile(
-                        file_obj.read(),
-                        filename=file_obj.name
-                    ),
-                    caption=f"✅ Заказ #{order_id} оплачен и выполнен!\n\n📦 Ваш товар:"
-                )
-                
-                # Уведомляем администраторов
-                await notify_admins_about_purchase(session, order, bot)
-            except Exception as e:
-                logger.error(f"Error sending order to user: {e}", exc_info=True)
-        
-        logger.info(f"Order payment processed successfully: order {order_id}, payment {payment_id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing order payment: {e}", exc_info=True)
-        await session.rollback()
-        return False
+    """Обработать оплату заказа (см. services/settlement.py)
+    
+    Выдача товара и уведомление администраторов записываются в outbox
+    в той же транзакции и отправляются фоновыми воркерами.
+    
+    Raises:
+        PermanentFailure: заказ отменен или товара нет - повтор не поможет,
+            платеж закрывается как PAID_UNMATCHED с уведомлением администраторам
+    """
+    settlement = await settle_order(session, order_id, payment_method, payment_id)
+    reason = unmatched_payment_reason(settlement, order_id)
+    if reason is not None:
+        await close_unmatched_payment(session, bot, payment_method, payment_id, amount, reason)
+        raise PermanentFailure(f"Order {order_id} cannot be settled: {settlement.status}")
+    return settlement.ok
 
 
 class PaymentWebhookData:
@@ -261,8 +109,20 @@ class PaymentWebhookHandler:
         """Проверяет, является ли событие успешной оплатой (должен быть переопределен)"""
         raise NotImplementedError
     
+    def get_event_type(self, data: Dict[str, Any]) -> str:
+        """Возвращает тип события из данных webhook"""
+        return data.get("event") or data.get("event_type", "")
+    
+    def get_event_id(self, data: Dict[str, Any], webhook_data: PaymentWebhookData) -> str:
+        """Ключ события для отбрасывания повторных доставок"""
+        return f"{self.get_event_type(data)}:{webhook_data.payment_id}"
+    
     async def handle_webhook(self, request: web.Request) -> web.Response:
-        """Универсальный обработчик webhook"""
+        """Универсальный обработчик webhook
+        
+        Проверяет подпись и сохраняет событие в inbox, обработка платежа
+        выполняется фоновыми воркерами (services/payment_inbox.py).
+        """
         try:
             # Получаем данные из запроса
             data = await request.json()
@@ -293,50 +153,20 @@ class PaymentWebhookHandler:
                 )
                 return web.Response(status=400, text="Missing required fields")
             
-            # Обрабатываем событие
-            event_type = data.get("event") or data.get("event_type", "")
+            event_type = self.get_event_type(data)
+            if not self.is_success_event(data, event_type) and event_type != self.get_failed_event_name():
+                logger.info(f"Unhandled {self.payment_method} event: {event_type}")
+                return web.Response(status=200, text="OK")
             
+            # Сохраняем событие, обработка - в фоне
             async with async_session_maker() as session:
-                if self.is_success_event(data, event_type):
-                    # Определяем тип платежа: пополнение баланса или оплата заказа
-                    bot = getattr(request.app, "bot", None)
-                    
-                    if webhook_data.order_id and webhook_data.order_id > 0:
-                        # Оплата заказа
-                        success = await process_order_payment(
-                            session, webhook_data.order_id, webhook_data.payment_id, 
-                            self.payment_method, bot
-                        )
-                    else:
-                        # Пополнение баланса
-                        success = await process_balance_topup(
-                            session, webhook_data.user_id, webhook_data.amount, 
-                            webhook_data.payment_id, self.payment_method
-                        )
-                    
-                    if success:
-                        return web.Response(status=200, text="OK")
-                    else:
-                        return web.Response(status=500, text="Processing failed")
-                
-                elif event_type == self.get_failed_event_name():
-                    # Обновляем статус платежа на FAILED
-                    stmt = select(Payment).where(
-                        Payment.payment_id == webhook_data.payment_id,
-                        Payment.payment_method == self.payment_method
-                    )
-                    result = await session.execute(stmt)
-                    payment = result.scalar_one_or_none()
-                    
-                    if payment:
-                        payment.status = "FAILED"
-                        await session.commit()
-                    
-                    return web.Response(status=200, text="OK")
-                
-                else:
-                    logger.info(f"Unhandled {self.payment_method} event: {event_type}")
-                    return web.Response(status=200, text="OK")
+                stored = await store_payment_event(
+                    session, self.payment_method, self.get_event_id(data, webhook_data), event_type, data
+                )
+            if not stored:
+                logger.info(f"Duplicate {self.payment_method} event {event_type} for payment {webhook_data.payment_id}")
+            
+            return web.Response(status=200, text="OK")
         
         except json.JSONDecodeError as e:
             logger.error(f"Invalid JSON in {self.payment_method} webhook: {e}")
@@ -344,6 +174,42 @@ class PaymentWebhookHandler:
         except Exception as e:
             logger.error(f"Error processing {self.payment_method} webhook: {e}", exc_info=True)
             return web.Response(status=500, text="Internal error")
+    
+    async def process_event(self, session: AsyncSession, data: Dict[str, Any], bot: Bot = None) -> bool:
+        """Обработать сохраненное событие (вызывается воркером inbox)"""
+        webhook_data = self.parse_webhook_data(data)
+        event_type = self.get_event_type(data)
+        
+        if self.is_success_event(data, event_type):
+            # Определяем тип платежа: пополнение баланса или оплата заказа
+            if webhook_data.order_id and webhook_data.order_id > 0:
+                # Оплата заказа
+                return await process_order_payment(
+                    session, webhook_data.order_id, webhook_data.payment_id,
+                    self.payment_method, webhook_data.amount, bot
+                )
+            # Пополнение баланса
+            return await settle_balance_topup(
+                session, webhook_data.user_id, webhook_data.amount,
+                webhook_data.payment_id, self.payment_method
+            )
+        
+        if event_type == self.get_failed_event_name():
+            # Обновляем статус платежа на FAILED (уже зачисленный платеж не трогаем)
+            await session.execute(
+                update(Payment)
+                .where(
+                    Payment.payment_method == self.payment_method,
+                    Payment.payment_id == webhook_data.payment_id,
+                    Payment.status != "SUCCESS"
+                )
+                .values(status="FAILED")
+            )
+            await session.commit()
+            return True
+        
+        logger.info(f"Unhandled {self.payment_method} event: {event_type}")
+        return True
 
 
 class YooKassaWebhookHandler(PaymentWebhookHandler):
@@ -426,6 +292,26 @@ _yookassa_handler = YooKassaWebhookHandler()
 _heleket_handler = HeleketWebhookHandler()
 
 
+_handlers_by_provider = {
+    handler.payment_method: handler
+    for handler in (_yookassa_handler, _heleket_handler)
+}
+
+
+async def process_payment_event(provider: str, data: Dict[str, Any], bot: Bot = None) -> bool:
+    """Обработать событие из inbox payment_events
+    
+    Возвращает False при временной ошибке (событие будет обработано повторно),
+    PermanentFailure - если повтор не поможет.
+    """
+    handler = _handlers_by_provider.get(provider)
+    if handler is None:
+        logger.error(f"Unknown payment provider in inbox: {provider}")
+        raise PermanentFailure(f"Unknown payment provider: {provider}")
+    async with async_session_maker() as session:
+        return await handler.process_event(session, data, bot)
+
+
 async def handle_yookassa_webhook(request: web.Request) -> web.Response:
     """Обработчик webhook от ЮКасса"""
     return await _yookassa_handler.handle_webhook(request)
@@ -470,8 +356,12 @@ def create_webhook_app(bot: Bot = None, dispatcher=None) -> web.Application:
             from aiogram.types import Update
             update = Update(**update_data)
             
-            # Обрабатываем обновление через диспетчер
-            await dispatcher.feed_update(bot, update)
+            # Ставим обновление в очередь и сразу отвечаем Telegram
+            # (без запущенной очереди обрабатываем синхронно)
+            if not update_queue.running:
+                await dispatcher.feed_update(bot, update)
+            elif not update_queue.put(update):
+                return web.Response(status=503, text="Queue is full")
             
             return web.Response(status=200, text="OK")
         except Exception as e:
@@ -485,7 +375,19 @@ def create_webhook_app(bot: Bot = None, dispatcher=None) -> web.Application:
     
     # Health check endpoint
     async def health_check(request: web.Request) -> web.Response:
-        return web.Response(text="OK")
+        from database.database import get_pool_stats
+        from middlewares.database import get_session_stats
+        return web.json_response({
+            "status": "OK",
+            "db_pool": get_pool_stats(),
+            "db_sessions": get_session_stats(),
+            "payment_inbox": payment_inbox.get_stats(),
+            "delivery_outbox": delivery_outbox.get_stats(),
+            "payment_api": get_payment_api_stats(),
+            "payment_reconciler": payment_reconciler.get_stats(),
+            "telegram_updates": update_queue.get_stats(),
+            "jobs": job_scheduler.get_stats(),
+        })
     
     app.router.add_get("/health", health_check)
     
@@ -10,6 +10,7 @@ from aiogram.types import FSInputFile
 
 from config import settings
 from database.database import init_db, get_session
+from database.fsm_storage import SQLStorage
 from handlers import (
     start, catalog, orders, balance, referral, info, payment, admin, broadcast
 )
@@ -27,93 +28,12 @@ logging.basicConfig(
 )
 
 
-async def cancel_expired_orders(bot: Bot):
-    """Автоматическая отмена просроченных заказов"""
-    from database.database import async_session_maker
-    from database.models import Order, Product
-    from sqlalchemy import select, update
-    from datetime import datetime
-    
-    while True:
-        try:
-            async with async_session_maker() as session:
-                # Находим заказы, которые просрочены (reserved_until < now и статус ОЖИДАЕТ ОПЛАТЫ)
-                now = datetime.now()
-                stmt = select(Order).where(
-                    Order.status == "ОЖИДАЕТ ОПЛАТЫ",
-                    Order.reserved_until < now
-                )
-                result = await session.execute(stmt)
-                expired_orders = result.scalars().all()
-                
-                for order in expired_orders:
-                    # Освобождаем зарезервированные аккаунты
-                    from database.models import Account
-                    
-                    # Получаем аккаунты заказа
-                    stmt_accounts = select(Account).where(Account.order_id == order.id)
-                    result_accounts = await session.execute(stmt_accounts)
-                    accounts = result_accounts.scalars().all()
-                    
-                    if accounts:
-                        account_ids = [acc.id for acc in accounts]
-                        # Освобождаем аккаунты (возвращаем в каталог)
-                        await session.execute(
-                            update(Account)
-                            .where(Account.id.in_(account_ids))
-                            .values(
-                                is_sold=False,
-                                sold_at=None,
-                                order_id=None
-                            )
-                        )
-                        
-                        # Возвращаем товар на склад
-                        await session.execute(
-                            update(Product)
-                            .where(Product.id == order.product_id)
-                            .values(stock_count=Product.stock_count + order.quantity)
-                        )
-                    
-                    # Отменяем заказ
-                    order.status = "ОТМЕНЕНО"
-                    order.reserved_until = None
-                    
-                    # Уведомляем пользователя
-                    try:
-                        from database.models import User
-                        stmt_user = select(User).where(User.id == order.user_id)
-                        result_user = await session.execute(stmt_user)
-                        user = result_user.scalar_one_or_none()
-                        
-                        if user:
-                            await bot.send_message(
-                                user.telegram_id,
-                                f"⏰ <b>Заказ отменен</b>\n\n"
-                                f"Заказ #{order.id} был отменен из-за истечения времени ожидания оплаты (15 минут).\n\n"
-                                f"✅ Товар возвращен в каталог.\n\n"
-                                f"Вы можете создать новый заказ.",
-                                parse_mode="HTML"
-                            )
-                    except Exception as e:
-                        logger.error(f"Error notifying user about expired order: {e}")
-                
-                if expired_orders:
-                    await session.commit()
-                    logger.info(f"Cancelled {len(expired_orders)} expired orders")
-                
-        except Exception as e:
-            logger.error(f"Error in cancel_expired_orders: {e}")
-        
-        # Проверяем каждые 5 минут
-        await asyncio.sleep(300)
-
-
 async def sync_roles_from_env(bot: Bot):
     """Синхронизация ролей пользователей из .env в БД"""
     from database.database import async_session_maker
     from database.models import User
     from sqlalchemy import select
+    from services.user_access import invalidate_user_access
     
     async with async_session_maker() as session:
         # Обновляем роли для всех пользователей из .env
@@ -143,6 +63,7 @@ async def sync_roles_from_env(bot: Bot):
                 logger.error(f"Error syncing role for user {user_id}: {e}")
         
         await session.commit()
+        invalidate_user_access(*all_admin_ids)
 
 
 async def setup_support_chat(bot: Bot):
@@ -253,10 +174,16 @@ async def start_payment_webhook_server(bot: Bot, dispatcher: Dispatcher = None):
         
         # Создаем сайт с SSL или без
         if use_https and ssl_context:
-            site = web.TCPSite(runner, '0.0.0.0', settings.PAYMENT_WEBHOOK_PORT, ssl_context=ssl_context)
+            site = web.TCPSite(
+                runner, '0.0.0.0', settings.PAYMENT_WEBHOOK_PORT,
+                ssl_context=ssl_context, reuse_port=settings.WEBHOOK_REUSE_PORT
+            )
             protocol = "https"
         else:
-            site = web.TCPSite(runner, '0.0.0.0', settings.PAYMENT_WEBHOOK_PORT)
+            site = web.TCPSite(
+                runner, '0.0.0.0', settings.PAYMENT_WEBHOOK_PORT,
+                reuse_port=settings.WEBHOOK_REUSE_PORT
+            )
             protocol = "http"
         
         await site.start()
@@ -305,17 +232,42 @@ async def on_startup(bot: Bot):
     await init_db()
     logger.info("Database initialized")
     
-    # Синхронизация ролей из .env в БД
-    await sync_roles_from_env(bot)
-    logger.info("Roles synchronized from .env")
+    # Фоновые задачи выполняются только в одном процессе бота (лидере)
+    from services.job_scheduler import job_scheduler
+    from services.order_expiry import order_expiry_scheduler
+    from services.payment_reconciler import payment_reconciler
+    # Синхронизация ролей из .env в БД и настройка чата поддержки
+    job_scheduler.add_job("sync_roles", lambda: sync_roles_from_env(bot))
+    job_scheduler.add_job("support_chat_setup", lambda: setup_support_chat(bot))
+    # Автоматическая отмена заказов по истечении резерва
+    job_scheduler.add_service("order_expiry", lambda: order_expiry_scheduler.start(bot), order_expiry_scheduler.stop)
+    # Массовые рассылки (продолжаются после перезапуска с сохраненного курсора)
+    from services.broadcast_jobs import broadcast_jobs
+    job_scheduler.add_service("broadcast_jobs", lambda: broadcast_jobs.start(bot), broadcast_jobs.stop)
+    # Сверка статусов платежей, webhook которых не дошел
+    job_scheduler.add_job(
+        "payment_reconcile", lambda: payment_reconciler.reconcile(bot=bot), interval=settings.PAYMENT_RECONCILE_INTERVAL
+    )
+    
+    # Открываем пулы HTTP соединений к API платежных систем
+    from services.payment import start_payment_clients
+    start_payment_clients()
+    
+    # Запускаем воркеры обработки событий webhook платежных систем
+    from services.payment_inbox import payment_inbox
+    from handlers.webhook import process_payment_event
+    payment_inbox.start(process_payment_event, bot)
+    logger.info("Payment inbox workers started")
     
-    # Настройка чата поддержки
-    await setup_support_chat(bot)
-    logger.info("Support chat setup completed")
+    # Запускаем воркеры выдачи товара после оплаты
+    from services.delivery_outbox import delivery_outbox
+    delivery_outbox.start(bot)
+    logger.info("Delivery outbox workers started")
+    # Удаление содержимого товара из недоставленных записей после срока хранения
+    job_scheduler.add_job("delivery_outbox_retention", delivery_outbox.redact_failed, interval=3600)
     
-    # Запускаем задачу автоматической отмены заказов
-    asyncio.create_task(cancel_expired_orders(bot))
-    logger.info("Expired orders cancellation task started")
+    job_scheduler.start()
+    logger.info("Job scheduler started")
     
     # Запускаем HTTP сервер для webhook платежных систем
     # Для Telegram webhook сервер будет перезапущен в main() с dispatcher
@@ -343,6 +295,26 @@ async def on_shutdown(bot: Bot):
     """Действия при остановке бота"""
     logger.info("Bot shutting down...")
     
+    # Дообрабатываем принятые обновления Telegram (webhook режим)
+    from services.update_queue import update_queue
+    await update_queue.stop()
+    
+    # Останавливаем фоновые задачи (лидерство перейдет к другому процессу)
+    from services.job_scheduler import job_scheduler
+    await job_scheduler.stop()
+    
+    # Останавливаем воркеры событий платежных систем
+    from services.payment_inbox import payment_inbox
+    await payment_inbox.stop()
+    
+    # Останавливаем воркеры выдачи товара (неотправленное будет отправлено после перезапуска)
+    from services.delivery_outbox import delivery_outbox
+    await delivery_outbox.stop()
+    
+    # Закрываем HTTP клиенты платежных систем
+    from services.payment import close_payment_clients
+    await close_payment_clients()
+    
     # Останавливаем webhook сервер для платежных систем
     if hasattr(bot, '_webhook_runner'):
         try:
@@ -376,7 +348,13 @@ async def main():
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
     
-    storage = MemoryStorage()
+    if settings.FSM_STORAGE == "sql":
+        # Состояния в БД: сценарий пользователя может продолжиться в другом процессе
+        storage = SQLStorage(ttl_hours=settings.FSM_STATE_TTL_HOURS)
+        from services.job_scheduler import job_scheduler
+        job_scheduler.add_job("fsm_cleanup", storage.cleanup, interval=3600)
+    else:
+        storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
     
     # Регистрация роутеров (порядок важен!)
@@ -395,16 +373,29 @@ async def main():
     # Регистрация middleware
     from middlewares import (
         DatabaseMiddleware, 
+        UserContextMiddleware,
         BlockedUserMiddleware, 
+        ReachabilityMiddleware,
         ErrorHandlerMiddleware,
-        KeyboardUpdateMiddleware
+        KeyboardUpdateMiddleware,
+        FsmCacheMiddleware
     )
     
     # Middleware для получения сессии БД
     dp.message.middleware(DatabaseMiddleware())
     dp.callback_query.middleware(DatabaseMiddleware())
     
-    # Middleware для проверки блокировки (после DatabaseMiddleware, чтобы session был доступен)
+    # Middleware для загрузки пользователя один раз на обновление (data["user"]);
+    # регистрируется после DatabaseMiddleware, так как использует data["session"]
+    dp.message.middleware(UserContextMiddleware())
+    dp.callback_query.middleware(UserContextMiddleware())
+    
+    # Middleware для снятия отметки недоступности, когда пользователь снова пишет боту
+    dp.message.middleware(ReachabilityMiddleware())
+    dp.callback_query.middleware(ReachabilityMiddleware())
+    
+    # Middleware для проверки блокировки (через кеш прав, использует data["session"]);
+    # после ReachabilityMiddleware, чтобы отметка недоступности снималась и у заблокированных
     dp.message.middleware(BlockedUserMiddleware())
     dp.callback_query.middleware(BlockedUserMiddleware())
     
@@ -414,6 +405,9 @@ async def main():
     # Middleware для обработки ошибок
     dp.update.outer_middleware(ErrorHandlerMiddleware())
     
+    # Кеш состояний FSM на время обработки одного обновления (для FSM_STORAGE=sql)
+    dp.update.outer_middleware(FsmCacheMiddleware())
+    
     # Обработчик ошибок через декоратор (резервный)
     # В aiogram 3.x обработчик получает ErrorEvent
     @dp.errors()
@@ -495,6 +489,10 @@ async def main():
             # Выполняем startup действия
             await on_startup(bot)
             
+            # Запускаем воркеры очереди обновлений Telegram
+            from services.update_queue import update_queue
+            update_queue.start(bot, dp)
+            
             # Перезапускаем webhook сервер с dispatcher для обработки Telegram обновлений
             if hasattr(bot, '_webhook_runner'):
                 await bot._webhook_runner.cleanup()
@@ -524,6 +522,7 @@ async def main():
                 logger.info("Received shutdown signal")
             finally:
                 await on_shutdown(bot)
+                await storage.close()
                 
         except Exception as e:
             logger.error(f"Error in webhook mode: {e}", exc_info=True)
@@ -1,12 +1,18 @@
 """Middlewares для бота"""
 from middlewares.database import DatabaseMiddleware
+from middlewares.user_context import UserContextMiddleware
 from middlewares.blocked_user import BlockedUserMiddleware
+from middlewares.reachability import ReachabilityMiddleware
 from middlewares.error_handler import ErrorHandlerMiddleware
 from middlewares.keyboard_update import KeyboardUpdateMiddleware
+from middlewares.fsm_cache import FsmCacheMiddleware
 
 __all__ = [
     "DatabaseMiddleware",
+    "UserContextMiddleware",
     "BlockedUserMiddleware",
+    "ReachabilityMiddleware",
     "ErrorHandlerMiddleware",
     "KeyboardUpdateMiddleware",
+    "FsmCacheMiddleware",
 ]
@@ -2,9 +2,8 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
-from sqlalchemy import select
-from database.models import User
 from config import settings
+from services.user_access import get_user_access
 from utils.text import MENU_SUPPORT, MENU_CATALOG, MENU_BALANCE, MENU_ORDERS, MENU_REFERRAL, MENU_INFO, MENU_RULES, MENU_ADMIN, MENU_BROADCAST
 
 
@@ -71,32 +70,28 @@ class BlockedUserMiddleware(BaseMiddleware):
         if user_id in settings.admin_ids_list or user_id in settings.developer_ids_list:
             return await handler(event, data)
         
-        # Проверяем блокировку в БД
+        # Проверяем блокировку (через кеш прав пользователя)
         session = data.get("session")
-        if session:
-            stmt = select(User).where(User.telegram_id == user_id)
-            result = await session.execute(stmt)
-            user = result.scalar_one_or_none()
+        access = await get_user_access(session, user_id) if session else None
+        if access and access.is_blocked:
+            # Разрешаем доступ к поддержке для заблокированных пользователей
+            if self._is_support_related(event):
+                return await handler(event, data)
             
-            if user and user.is_blocked:
-                # Разрешаем доступ к поддержке для заблокированных пользователей
-                if self._is_support_related(event):
-                    return await handler(event, data)
-                
-                blocked_message = (
-                    "❌ <b>Вы заблокированы</b>\n\n"
-                    "Ваш доступ к боту ограничен администратором.\n"
-                    "Если вы считаете, что это ошибка, обратитесь в поддержку."
-                )
-                
-                if is_callback:
-                    try:
-                        await event.message.edit_text(blocked_message, parse_mode="HTML")
-                    except:
-                        await event.answer("Вы заблокированы", show_alert=True)
-                    return
-                else:
-                    await event.answer(blocked_message, parse_mode="HTML")
-                    return
+            blocked_message = (
+                "❌ <b>Вы заблокированы</b>\n\n"
+                "Ваш доступ к боту ограничен администратором.\n"
+                "Если вы считаете, что это ошибка, обратитесь в поддержку."
+            )
+            
+            if is_callback:
+                try:
+                    await event.message.edit_text(blocked_message, parse_mode="HTML")
+                except:
+                    await event.answer("Вы заблокированы", show_alert=True)
+                return
+            else:
+                await event.answer(blocked_message, parse_mode="HTML")
+                return
         
         return await handler(event, data)
@@ -1,18 +1,106 @@
 """Middleware для работы с базой данных"""
-from typing import Callable, Dict, Any, Awaitable
+from typing import Callable, Dict, Any, Awaitable, Optional
 from aiogram import BaseMiddleware
-from database.database import async_session_maker
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import async_session_maker, get_read_session_maker, mark_recent_write
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LazySession:
+    """Ленивая сессия БД
+
+    Настоящая AsyncSession создается только при первом обращении к ней
+    (execute, add, commit и т.д.). Обновления, которые не работают с БД
+    (кнопки меню, повторные нажатия, ранние выходы), не занимают соединение из пула.
+    """
+
+    def __init__(self, session_factory=async_session_maker, on_commit: Optional[Callable[[], None]] = None):
+        self._session_factory = session_factory
+        self._session: Optional[AsyncSession] = None
+        self._on_commit = on_commit
+
+    @property
+    def is_opened(self) -> bool:
+        """Была ли открыта настоящая сессия"""
+        return self._session is not None
+
+    def _get_session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_factory()
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        # Вызывается только для атрибутов, которых нет у самого прокси
+        return getattr(self._get_session(), name)
+
+    async def commit(self):
+        """Зафиксировать транзакцию"""
+        await self._get_session().commit()
+        if self._on_commit is not None:
+            self._on_commit()
+
+    async def close(self):
+        """Закрыть сессию (если она была открыта) и вернуть соединение в пул"""
+        if self._session is not None:
+            await self._session.close()
 
 
 class DatabaseMiddleware(BaseMiddleware):
-    """Middleware для получения сессии БД"""
-    
+    """Middleware для получения сессии БД
+
+    В data["session"] передается сессия основной БД, в data["read_session"] -
+    сессия для обработчиков, которые только читают данные (реплика, если она
+    настроена). Сразу после записи пользователь читает с основной БД.
+    """
+
+    # Счетчики обновлений: с открытой сессией и без обращения к БД
+    sessions_opened = 0
+    sessions_skipped = 0
+    replica_sessions_opened = 0
+
     async def __call__(
         self,
         handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
         event: Any,
         data: Dict[str, Any]
     ) -> Any:
-        async with async_session_maker() as session:
-            data["session"] = session
+        from_user = data.get("event_from_user")
+        telegram_id = from_user.id if from_user else None
+
+        on_commit = None
+        if telegram_id is not None:
+            on_commit = lambda: mark_recent_write(telegram_id)
+        session = LazySession(on_commit=on_commit)
+        data["session"] = session
+
+        read_session_maker = get_read_session_maker(telegram_id)
+        if read_session_maker is async_session_maker:
+            read_session = session
+        else:
+            read_session = LazySession(read_session_maker)
+        data["read_session"] = read_session
+
+        try:
             return await handler(event, data)
+        finally:
+            if session.is_opened:
+                DatabaseMiddleware.sessions_opened += 1
+            else:
+                DatabaseMiddleware.sessions_skipped += 1
+            await session.close()
+
+            if read_session is not session:
+                if read_session.is_opened:
+                    DatabaseMiddleware.replica_sessions_opened += 1
+                await read_session.close()
+
+
+def get_session_stats() -> Dict[str, int]:
+    """Статистика использования сессий в DatabaseMiddleware"""
+    return {
+        "opened": DatabaseMiddleware.sessions_opened,
+        "skipped": DatabaseMiddleware.sessions_skipped,
+        "replica_opened": DatabaseMiddleware.replica_sessions_opened,
+    }
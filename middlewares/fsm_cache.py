@@ -0,0 +1,21 @@
+"""Middleware для кеша состояний FSM на время обработки обновления"""
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from database.fsm_storage import update_cache_scope
+
+
+class FsmCacheMiddleware(BaseMiddleware):
+    """Повторные чтения состояния FSM в пределах обновления берутся из кеша
+
+    Кеш сбрасывается после обработки обновления, поэтому следующее
+    обновление пользователя читает состояние из БД (database/fsm_storage.py).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        with update_cache_scope():
+            return await handler(event, data)
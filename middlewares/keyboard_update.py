@@ -2,9 +2,8 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message
-from sqlalchemy import select
-from database.models import User
 from config import settings
+from services.user_access import get_user_access
 from utils.keyboards import get_main_menu_keyboard
 
 
@@ -36,22 +35,15 @@ class KeyboardUpdateMiddleware(BaseMiddleware):
         if not user_id:
             return await handler(event, data)
         
-        # Получаем сессию БД
+        # Проверяем текущую роль пользователя (через кеш прав пользователя)
         session = data.get("session")
-        if not session:
-            return await handler(event, data)
-        
-        # Проверяем текущую роль пользователя
-        stmt = select(User).where(User.telegram_id == user_id)
-        result = await session.execute(stmt)
-        user = result.scalar_one_or_none()
-        
-        if not user:
+        access = await get_user_access(session, user_id) if session else None
+        if not access:
             return await handler(event, data)
         
         # Определяем, является ли пользователь админом
         is_admin = user_id in settings.admin_ids_list or user_id in settings.developer_ids_list
-        if not is_admin and user.role in ("admin", "developer"):
+        if not is_admin and access.is_admin:
             is_admin = True
         
         # Проверяем, изменилась ли роль
@@ -0,0 +1,27 @@
+"""Middleware для снятия отметки недоступности пользователя"""
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from services.user_access import get_user_access
+from services.reachability import mark_reachable
+
+
+class ReachabilityMiddleware(BaseMiddleware):
+    """Снимает User.is_reachable = False, когда пользователь снова пишет боту
+
+    Проверка идет через кеш прав пользователя, поэтому для обычных
+    (доступных) пользователей запросов к БД не добавляет.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = getattr(event, "from_user", None)
+        session = data.get("session")
+        if from_user and session:
+            access = await get_user_access(session, from_user.id)
+            if access and not access.is_reachable:
+                await mark_reachable(from_user.id)
+        return await handler(event, data)
@@ -0,0 +1,45 @@
+"""Middleware для загрузки пользователя один раз на обновление"""
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from sqlalchemy import select
+from database.models import User
+from services.user_access import remember_user_access
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Middleware для загрузки пользователя из БД в data["user"]
+
+    Пользователь загружается одним запросом на обновление и передается
+    следующим middleware и обработчикам (параметр user). Если пользователь
+    не зарегистрирован, в data["user"] кладется None. Если обработчик не
+    принимает параметр user, запрос не выполняется вовсе.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        # Уже загружен (например, при повторном вызове цепочки после SkipHandler)
+        if "user" in data:
+            return await handler(event, data)
+
+        # Обработчику пользователь не нужен - не трогаем БД
+        handler_object = data.get("handler")
+        if handler_object is not None and not handler_object.varkw and "user" not in handler_object.params:
+            return await handler(event, data)
+
+        from_user = getattr(event, "from_user", None)
+        session = data.get("session")
+
+        user = None
+        if from_user and session:
+            stmt = select(User).where(User.telegram_id == from_user.id)
+            result = await session.execute(stmt)
+            user = result.scalar_one_or_none()
+            # Заодно обновляем кеш прав, чтобы проверки блокировки и роли не ходили в БД
+            remember_user_access(from_user.id, user)
+
+        data["user"] = user
+        return await handler(event, data)
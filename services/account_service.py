@@ -4,13 +4,48 @@ from io import BytesIO
 from typing import List
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
+from database.database import engine
 from database.models import Account, Product, Order
+from services.catalog_cache import mark_stock_changed
 from datetime import datetime
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def _claim_accounts(product_id: int, quantity: int, values: dict, skip_locked: bool):
+    """UPDATE свободных аккаунтов товара, выбранных с FOR UPDATE
+
+    В PostgreSQL выборка делается в CTE и выполняется ровно один раз (подзапрос
+    с LIMIT под IN PostgreSQL может вычислить повторно). В SQLite блокировок
+    строк нет, а драйвер sqlite3 не открывает транзакцию перед запросом,
+    начинающимся с WITH (захват зафиксировался бы сразу), поэтому там
+    используется UPDATE с подзапросом.
+    """
+    claim = (
+        select(Account.id)
+        .where(
+            Account.product_id == product_id,
+            Account.is_sold == False
+        )
+        .order_by(Account.id)
+        .limit(quantity)
+        .with_for_update(skip_locked=skip_locked)
+    )
+    if engine.dialect.name == "postgresql":
+        claim = claim.cte("claim")
+        condition = Account.id == claim.c.id
+    else:
+        condition = Account.id.in_(claim.scalar_subquery())
+    return (
+        update(Account)
+        .where(condition)
+        .values(**values)
+        .returning(Account)
+        .execution_options(synchronize_session=False)
+    )
+
+
 async def reserve_accounts(
     session: AsyncSession,
     product_id: int,
@@ -19,39 +54,18 @@ async def reserve_accounts(
 ) -> List[Account]:
     """
     Резервирование аккаунтов для заказа
-    Использует SELECT FOR UPDATE для предотвращения race condition
+    Свободные аккаунты захватываются одним UPDATE ... FROM (WITH claim AS
+    (SELECT ... FOR UPDATE SKIP LOCKED)) RETURNING (_claim_accounts): строки, уже занятые
+    параллельными покупателями, пропускаются, а не ожидаются. Если захвачено
+    меньше нужного (часть строк заблокирована транзакциями, которые могут
+    откатиться), остаток добирается один раз с ожиданием блокировок.
+    Остаток на складе уменьшается условным UPDATE.
+    Блокировки захваченных аккаунтов и строки товара держатся до commit/rollback
+    транзакции вызывающего кода, поэтому ее нужно завершать сразу после резервирования.
     order_id может быть None при первоначальном резервировании
-    Работает с уже переданной сессией (без создания вложенной транзакции)
+    Работает с уже переданной сессией (без создания вложенной транзакции).
+    При ValueError вызывающий код должен откатить транзакцию.
     """
-    # Блокируем строки для обновления (SELECT FOR UPDATE)
-    stmt = (
-        select(Account)
-        .where(
-            Account.product_id == product_id,
-            Account.is_sold == False
-        )
-        .limit(quantity)
-        .with_for_update()
-    )
-    result = await session.execute(stmt)
-    accounts = result.scalars().all()
-    
-    if len(accounts) < quantity:
-        raise ValueError(f"Недостаточно товара на складе. Доступно: {len(accounts)}, требуется: {quantity}")
-    
-    # Проверяем stock_count перед обновлением
-    stmt_product = select(Product).where(Product.id == product_id).with_for_update()
-    result_product = await session.execute(stmt_product)
-    product = result_product.scalar_one_or_none()
-    
-    if not product:
-        raise ValueError(f"Товар с ID {product_id} не найден")
-    
-    if product.stock_count < quantity:
-        raise ValueError(f"Недостаточно товара на складе. Доступно: {product.stock_count}, требуется: {quantity}")
-    
-    # Резервируем аккаунты
-    account_ids = [acc.id for acc in accounts]
     update_values = {
         "is_sold": True,
         "sold_at": datetime.now()
@@ -59,18 +73,34 @@ async def reserve_accounts(
     if order_id:
         update_values["order_id"] = order_id
     
-    await session.execute(
-        update(Account)
-        .where(Account.id.in_(account_ids))
-        .values(**update_values)
-    )
+    result = await session.execute(_claim_accounts(product_id, quantity, update_values, skip_locked=True))
+    accounts = list(result.scalars().all())
     
-    # Обновляем количество на складе
-    await session.execute(
+    if len(accounts) < quantity:
+        # Заблокированные строки могут освободиться при откате чужой транзакции -
+        # дожидаемся ее и добираем остаток (уже захваченные строки не подходят под is_sold == False)
+        result = await session.execute(
+            _claim_accounts(product_id, quantity - len(accounts), update_values, skip_locked=False)
+        )
+        accounts.extend(result.scalars().all())
+    
+    if len(accounts) < quantity:
+        raise ValueError(f"Недостаточно товара на складе. Доступно: {len(accounts)}, требуется: {quantity}")
+    
+    # Уменьшаем остаток только если его хватает (атомарно, без предварительного SELECT)
+    result_product = await session.execute(
         update(Product)
-        .where(Product.id == product_id)
+        .where(
+            Product.id == product_id,
+            Product.stock_count >= quantity
+        )
         .values(stock_count=Product.stock_count - quantity)
+        .returning(Product.id)
+        .execution_options(synchronize_session=False)
     )
+    if result_product.scalar_one_or_none() is None:
+        raise ValueError(f"Товар с ID {product_id} не найден или недостаточно товара на складе")
+    mark_stock_changed(session, product_id)
     
     return accounts
 
@@ -174,6 +204,7 @@ async def upload_accounts_from_file(
         .where(Product.id == product_id)
         .values(stock_count=Product.stock_count + loaded)
     )
+    mark_stock_changed(session, product_id)
     
     return loaded, duplicates
 
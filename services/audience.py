@@ -0,0 +1,164 @@
+"""Сегменты аудитории рассылок
+
+Аудитория задается строкой "<сегмент>" или "<сегмент>:<параметр>" и хранится
+в broadcast_jobs.audience:
+- all - все пользователи;
+- product:<id> - купившие товар (заказ оплачен или выполнен);
+- category:<id> - купившие товар из категории;
+- balance:<сумма> - баланс больше суммы;
+- inactive:<дней>[@<дата>] - зарегистрированы раньше и не создавали заказов
+  N дней; граница периода фиксируется при создании рассылки
+  (resolve_audience), чтобы предпросмотр, total и все пачки рассылки, в том
+  числе после перезапуска, считались от одной даты;
+- referrers - пригласившие хотя бы одного пользователя;
+- subscribers, subscribers:<id> - ждут уведомления о поступлении (товара).
+
+Сегмент компилируется в условие на users с подзапросом IN по индексу
+соответствующей таблицы, поэтому получатели выбираются одним запросом
+(BroadcastJobRunner читает их keyset-пагинацией по users.id), а количество
+для предпросмотра считается одним COUNT. Заблокированные и недоступные
+пользователи (services/reachability.py) исключаются всегда.
+"""
+import math
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+from sqlalchemy import select, func, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.models import User, Order, Product, StockNotification
+import logging
+
+logger = logging.getLogger(__name__)
+
+AUDIENCE_ALL = "all"
+SEGMENT_PRODUCT = "product"
+SEGMENT_CATEGORY = "category"
+SEGMENT_BALANCE = "balance"
+SEGMENT_INACTIVE = "inactive"
+SEGMENT_REFERRERS = "referrers"
+SEGMENT_SUBSCRIBERS = "subscribers"
+
+# Сегменты с обязательным параметром
+PARAM_SEGMENTS = (SEGMENT_PRODUCT, SEGMENT_CATEGORY, SEGMENT_BALANCE, SEGMENT_INACTIVE)
+SEGMENTS = (AUDIENCE_ALL, SEGMENT_REFERRERS, SEGMENT_SUBSCRIBERS) + PARAM_SEGMENTS
+
+# Заказы, которые считаются покупкой
+PURCHASED_STATUSES = ("ОПЛАЧЕНО", "ВЫПОЛНЕНО")
+
+# Ограничения параметров: длина broadcast_jobs.audience, INTEGER в БД, период неактивности
+MAX_AUDIENCE_LENGTH = 50
+MAX_ID = 2 ** 31 - 1
+MAX_INACTIVE_DAYS = 3650
+
+
+def parse_audience(audience: str) -> Tuple[str, Optional[float], Optional[datetime]]:
+    """Разобрать строку аудитории в (сегмент, параметр, граница периода)
+
+    Граница периода есть только у зафиксированного сегмента inactive.
+
+    Raises:
+        ValueError: неизвестный сегмент или некорректный параметр
+    """
+    if len(audience) > MAX_AUDIENCE_LENGTH:
+        raise ValueError("Broadcast audience is too long")
+    segment, _, raw = audience.partition(":")
+    if segment not in SEGMENTS:
+        raise ValueError(f"Unknown broadcast audience: {audience}")
+    if not raw:
+        if segment in PARAM_SEGMENTS:
+            raise ValueError(f"Audience {segment} requires a parameter")
+        return segment, None, None
+    if segment in (AUDIENCE_ALL, SEGMENT_REFERRERS):
+        raise ValueError(f"Audience {segment} takes no parameter")
+
+    if segment == SEGMENT_BALANCE:
+        param = float(raw.replace(",", "."))
+        if not math.isfinite(param) or param < 0:
+            raise ValueError("Balance threshold must be a non-negative number")
+        return segment, param, None
+
+    since = None
+    if segment == SEGMENT_INACTIVE:
+        raw, _, since_raw = raw.partition("@")
+        if since_raw:
+            since = datetime.fromisoformat(since_raw)
+
+    param = int(raw)
+    limit = MAX_INACTIVE_DAYS if segment == SEGMENT_INACTIVE else MAX_ID
+    if not 0 < param <= limit:
+        raise ValueError(f"Audience {segment} parameter must be between 1 and {limit}")
+    return segment, param, since
+
+
+def resolve_audience(audience: str) -> str:
+    """Зафиксировать границу периода сегмента inactive (остальные не меняются)"""
+    segment, param, since = parse_audience(audience)
+    if segment != SEGMENT_INACTIVE or since is not None:
+        return audience
+    since = datetime.now().replace(microsecond=0) - timedelta(days=param)
+    return f"{segment}:{param}@{since.isoformat()}"
+
+
+def audience_condition(audience: str):
+    """Условие отбора пользователей для аудитории рассылки"""
+    segment, param, since = parse_audience(audience)
+    base = and_(User.is_blocked == False, User.is_reachable == True)
+
+    if segment == AUDIENCE_ALL:
+        return base
+    if segment == SEGMENT_PRODUCT:
+        buyers = select(Order.user_id).where(
+            Order.product_id == param,
+            Order.status.in_(PURCHASED_STATUSES)
+        )
+        return and_(base, User.id.in_(buyers))
+    if segment == SEGMENT_CATEGORY:
+        buyers = select(Order.user_id).where(
+            Order.product_id.in_(select(Product.id).where(Product.category_id == param)),
+            Order.status.in_(PURCHASED_STATUSES)
+        )
+        return and_(base, User.id.in_(buyers))
+    if segment == SEGMENT_BALANCE:
+        return and_(base, User.balance > param)
+    if segment == SEGMENT_INACTIVE:
+        if since is None:
+            since = datetime.now() - timedelta(days=param)
+        active = select(Order.user_id).where(Order.created_at >= since)
+        return and_(base, User.created_at < since, User.id.not_in(active))
+    if segment == SEGMENT_REFERRERS:
+        referrers = select(User.referred_by).where(User.referred_by.isnot(None))
+        return and_(base, User.id.in_(referrers))
+    # SEGMENT_SUBSCRIBERS
+    subscribers = select(StockNotification.user_id).where(StockNotification.is_notified == False)
+    if param is not None:
+        subscribers = subscribers.where(StockNotification.product_id == param)
+    return and_(base, User.id.in_(subscribers))
+
+
+def describe_audience(audience: str) -> str:
+    """Описание аудитории для администратора"""
+    segment, param, since = parse_audience(audience)
+    if segment == AUDIENCE_ALL:
+        return "все пользователи"
+    if segment == SEGMENT_PRODUCT:
+        return f"купившие товар #{param}"
+    if segment == SEGMENT_CATEGORY:
+        return f"купившие товар из категории #{param}"
+    if segment == SEGMENT_BALANCE:
+        return f"баланс больше {param:.2f} ₽"
+    if segment == SEGMENT_INACTIVE:
+        if since is not None:
+            return f"без заказов {param} дн. (с {since:%d.%m.%Y %H:%M})"
+        return f"без заказов {param} дн."
+    if segment == SEGMENT_REFERRERS:
+        return "пригласившие друзей"
+    if param is not None:
+        return f"ждут поступления товара #{param}"
+    return "ждут поступления товаров"
+
+
+async def count_audience(session: AsyncSession, audience: str) -> int:
+    """Количество получателей (предпросмотр перед рассылкой)"""
+    result = await session.execute(
+        select(func.count()).select_from(User).where(audience_condition(audience))
+    )
+    return result.scalar() or 0
@@ -0,0 +1,170 @@
+"""Отправка рассылок с ограничением частоты
+
+Все рассылки бота проходят через общий token bucket (BROADCAST_THROTTLE
+сообщений в секунду), сообщения отправляют BROADCAST_CONCURRENCY
+параллельных отправителей: задержка одного запроса к Telegram не снижает
+скорость рассылки.
+
+Ошибки отправки:
+- 429 (TelegramRetryAfter) - выдача токенов приостанавливается для всех
+  отправителей на retry_after, сообщение отправляется повторно; такие повторы
+  не расходуют попытки получателя (ограничены BROADCAST_MAX_FLOOD_WAITS);
+- 5xx и сетевые ошибки - повтор получателю с экспоненциальной задержкой,
+  не больше BROADCAST_MAX_ATTEMPTS попыток;
+- бот заблокирован / чат не найден - получатель пропускается без повтора
+  и после рассылки отмечается недоступным (services/reachability.py).
+"""
+import asyncio
+import time
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Union
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+    TelegramNetworkError, TelegramServerError
+)
+from services.reachability import is_unreachable_error, mark_unreachable
+from utils.rate_limit import TokenBucket
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Отправка одному получателю по telegram_id
+SendFunc = Callable[[int], Awaitable[object]]
+Recipients = Union[Iterable[int], AsyncIterable[int]]
+
+
+class BroadcastResult:
+    """Счетчики рассылки (обновляются во время отправки)"""
+
+    __slots__ = ("total", "sent", "failed", "blocked", "retried", "unreachable", "started_at", "finished_at")
+
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        # telegram_id недоступных получателей
+        self.unreachable: List[int] = []
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Отправлено сообщений в секунду"""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "retried": self.retried,
+            "elapsed": round(self.elapsed, 1),
+            "rate": round(self.rate, 1),
+        }
+
+
+async def _iterate(recipients: Recipients):
+    if hasattr(recipients, "__aiter__"):
+        async for recipient in recipients:
+            yield recipient
+    else:
+        for recipient in recipients:
+            yield recipient
+
+
+class BroadcastEngine:
+    """Параллельная отправка с общим ограничением частоты"""
+
+    def __init__(self, rate: float, concurrency: int, max_attempts: int, max_flood_waits: int):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.max_flood_waits = max_flood_waits
+        # Лимит Telegram общий для бота, поэтому bucket общий для всех рассылок
+        self.bucket = TokenBucket(rate)
+
+    async def _send(self, send: SendFunc, chat_id: int, result: BroadcastResult):
+        """Отправить одному получателю с повторами"""
+        attempt = 0
+        flood_waits = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await send(chat_id)
+                result.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                # Flood control действует на весь бот - приостанавливаем всех и
+                # отправляем повторно, не расходуя попытки получателя
+                self.bucket.pause(e.retry_after)
+                error = e
+                flood_waits += 1
+                if flood_waits >= self.max_flood_waits:
+                    break
+                result.retried += 1
+                continue
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                if is_unreachable_error(e):
+                    result.blocked += 1
+                    result.unreachable.append(chat_id)
+                    logger.debug(f"Broadcast recipient {chat_id} unavailable: {e}")
+                    return
+                # Ошибка в самом сообщении - повтор не поможет
+                error = e
+                break
+            except (TelegramNetworkError, TelegramServerError) as e:
+                error = e
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    break
+                result.retried += 1
+                await asyncio.sleep(min(2 ** (attempt - 1), 30))
+            except Exception as e:
+                error = e
+                break
+
+        result.failed += 1
+        logger.warning(f"Broadcast to {chat_id} failed: {error}")
+
+    async def run(self, recipients: Recipients, send: SendFunc) -> BroadcastResult:
+        """Отправить сообщение всем получателям и вернуть итоговые счетчики"""
+        result = BroadcastResult()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def sender():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    await self._send(send, chat_id, result)
+                finally:
+                    queue.task_done()
+
+        senders = [asyncio.create_task(sender()) for _ in range(self.concurrency)]
+        try:
+            async for chat_id in _iterate(recipients):
+                result.total += 1
+                await queue.put(chat_id)
+            await queue.join()
+        finally:
+            for task in senders:
+                task.cancel()
+            await asyncio.gather(*senders, return_exceptions=True)
+            result.finished_at = time.monotonic()
+
+        await mark_unreachable(result.unreachable)
+        logger.info(f"Broadcast finished: {result.as_dict()}")
+        return result
+
+
+broadcast_engine = BroadcastEngine(
+    rate=settings.BROADCAST_THROTTLE,
+    concurrency=settings.BROADCAST_CONCURRENCY,
+    max_attempts=settings.BROADCAST_MAX_ATTEMPTS,
+    max_flood_waits=settings.BROADCAST_MAX_FLOOD_WAITS
+)
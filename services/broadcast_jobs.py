@@ -0,0 +1,262 @@
+"""Массовые рассылки как сохраняемые задания
+
+Рассылка сохраняется в broadcast_jobs (ссылка на исходное сообщение
+администратора, сегмент аудитории из services/audience.py, курсор и счетчики)
+и выполняется фоновым исполнителем в процессе-лидере
+(services/job_scheduler.py), а не в обработчике сообщения.
+
+Получатели читаются пачками по BROADCAST_CHUNK_SIZE кортежей (users.id,
+telegram_id) keyset-пагинацией по users.id, поэтому память не зависит от
+размера аудитории, и отправляются через BroadcastEngine (services/broadcast.py).
+После каждой пачки курсор и счетчики сохраняются одним UPDATE, поэтому после
+перезапуска рассылка продолжается с последней сохраненной пачки (получатели
+незавершенной пачки могут получить сообщение повторно).
+
+Администратор видит сообщение с прогрессом, скоростью и оставшимся временем,
+которое обновляется не чаще раза в BROADCAST_PROGRESS_INTERVAL секунд, и может
+остановить рассылку кнопкой.
+"""
+import asyncio
+import time
+from datetime import datetime
+from functools import partial
+from typing import Optional
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import async_session_maker
+from database.models import BroadcastJob, User
+from services.audience import AUDIENCE_ALL, audience_condition, count_audience, describe_audience, resolve_audience
+from services.broadcast import broadcast_engine
+from utils.pagination import iter_keyset_chunks
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "PENDING"
+STATUS_RUNNING = "RUNNING"
+STATUS_DONE = "DONE"
+STATUS_CANCELLED = "CANCELLED"
+
+ACTIVE_STATUSES = (STATUS_PENDING, STATUS_RUNNING)
+
+
+def _cancel_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Остановить рассылку", callback_data=f"broadcast_cancel_{job_id}")]
+    ])
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин {seconds} сек"
+    return f"{seconds} сек"
+
+
+def progress_text(job: BroadcastJob, rate: Optional[float] = None) -> str:
+    """Текст сообщения с прогрессом рассылки"""
+    processed = job.sent + job.failed + job.blocked
+    percent = processed * 100 // job.total if job.total else 100
+    titles = {
+        STATUS_PENDING: "📢 Рассылка #{id} в очереди",
+        STATUS_RUNNING: "📢 Рассылка #{id} выполняется",
+        STATUS_DONE: "✅ Рассылка #{id} завершена",
+        STATUS_CANCELLED: "⏹ Рассылка #{id} остановлена",
+    }
+    lines = [
+        titles.get(job.status, "📢 Рассылка #{id}").format(id=job.id),
+        f"Аудитория: {describe_audience(job.audience)}",
+        "",
+        f"Обработано: {processed} из {job.total} ({percent}%)",
+        f"Успешно: {job.sent}",
+        f"Недоступны (бот заблокирован): {job.blocked}",
+        f"Ошибок: {job.failed}",
+    ]
+    if job.status == STATUS_RUNNING and rate:
+        remaining = max(job.total - processed, 0)
+        lines.append(f"Скорость: {rate:.1f} сообщ./сек")
+        lines.append(f"Осталось: ~{_format_duration(remaining / rate)}")
+    elif job.status in (STATUS_DONE, STATUS_CANCELLED) and job.started_at and job.finished_at:
+        lines.append(f"Время: {_format_duration((job.finished_at - job.started_at).total_seconds())}")
+    return "\n".join(lines)
+
+
+async def create_broadcast_job(session: AsyncSession, message: Message, audience: str = AUDIENCE_ALL) -> BroadcastJob:
+    """Сохранить рассылку сообщения администратора и показать прогресс
+
+    Сообщение копируется получателям как есть (текст, фото, документ и т.д.).
+    """
+    # Граница периода фиксируется один раз: total и все пачки считаются от нее
+    audience = resolve_audience(audience)
+    total = await count_audience(session, audience)
+    job = BroadcastJob(
+        created_by=message.from_user.id,
+        from_chat_id=message.chat.id,
+        message_id=message.message_id,
+        audience=audience,
+        status=STATUS_PENDING,
+        total=total
+    )
+    session.add(job)
+    await session.flush()
+
+    progress = await message.answer(progress_text(job), reply_markup=_cancel_keyboard(job.id))
+    job.progress_message_id = progress.message_id
+    await session.commit()
+
+    broadcast_jobs.notify()
+    return job
+
+
+async def cancel_broadcast_job(session: AsyncSession, job_id: int) -> bool:
+    """Остановить рассылку (исполнитель остановится после текущей пачки)"""
+    result = await session.execute(
+        update(BroadcastJob)
+        .where(BroadcastJob.id == job_id, BroadcastJob.status.in_(ACTIVE_STATUSES))
+        .values(status=STATUS_CANCELLED, finished_at=datetime.now())
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount > 0
+
+
+class BroadcastJobRunner:
+    """Фоновый исполнитель рассылок (по одной за раз)"""
+
+    def __init__(self, chunk_size: int, progress_interval: float, poll_interval: float = 5):
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        """Разбудить исполнитель после создания рассылки"""
+        self._wakeup.set()
+
+    async def _next_job(self) -> Optional[BroadcastJob]:
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(BroadcastJob)
+                .where(BroadcastJob.status.in_(ACTIVE_STATUSES))
+                .order_by(BroadcastJob.id)
+                .limit(1)
+            )
+            return result.scalar_one_or_none()
+
+    async def _save_progress(self, job: BroadcastJob, values: dict) -> BroadcastJob:
+        """Сохранить курсор и счетчики, вернуть актуальное состояние рассылки"""
+        async with async_session_maker() as session:
+            result = await session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job.id)
+                .values(**values)
+                .returning(BroadcastJob)
+                .execution_options(synchronize_session=False)
+            )
+            job = result.scalar_one()
+            await session.commit()
+            return job
+
+    async def _show_progress(self, bot: Bot, job: BroadcastJob, rate: Optional[float] = None):
+        if not job.progress_message_id:
+            return
+        try:
+            await bot.edit_message_text(
+                progress_text(job, rate),
+                chat_id=job.from_chat_id,
+                message_id=job.progress_message_id,
+                reply_markup=_cancel_keyboard(job.id) if job.status in ACTIVE_STATUSES else None
+            )
+        except Exception as e:
+            logger.debug(f"Could not update broadcast {job.id} progress: {e}")
+
+    async def _process(self, bot: Bot, job: BroadcastJob):
+        if job.status == STATUS_PENDING:
+            job = await self._save_progress(job, {"status": STATUS_RUNNING, "started_at": datetime.now()})
+        logger.info(f"Broadcast {job.id} running from cursor {job.cursor}")
+
+        send = partial(bot.copy_message, from_chat_id=job.from_chat_id, message_id=job.message_id)
+        run_started = time.monotonic()
+        processed_at_start = job.sent + job.failed + job.blocked
+        last_progress = 0.0
+
+        # Получатели читаются пачками (users.id, telegram_id) после курсора
+        chunks = iter_keyset_chunks(
+            async_session_maker,
+            select(User.id, User.telegram_id).where(audience_condition(job.audience)),
+            [User.id],
+            self.chunk_size,
+            after=(job.cursor,)
+        )
+        try:
+            async for chunk in chunks:
+                result = await broadcast_engine.run([row.telegram_id for row in chunk], send)
+                job = await self._save_progress(job, {
+                    "cursor": chunk[-1].id,
+                    "sent": BroadcastJob.sent + result.sent,
+                    "failed": BroadcastJob.failed + result.failed,
+                    "blocked": BroadcastJob.blocked + result.blocked,
+                })
+                if job.status != STATUS_RUNNING:
+                    break
+
+                now = time.monotonic()
+                if now - last_progress >= self.progress_interval:
+                    processed = job.sent + job.failed + job.blocked - processed_at_start
+                    await self._show_progress(bot, job, processed / (now - run_started))
+                    last_progress = now
+        finally:
+            await chunks.aclose()
+
+        if job.status == STATUS_RUNNING:
+            job = await self._save_progress(job, {"status": STATUS_DONE, "finished_at": datetime.now()})
+
+        logger.info(f"Broadcast {job.id} {job.status}: sent {job.sent}, blocked {job.blocked}, failed {job.failed}")
+        await self._show_progress(bot, job)
+
+    async def run(self, bot: Bot):
+        """Основной цикл исполнителя"""
+        while True:
+            try:
+                self._wakeup.clear()
+                job = await self._next_job()
+                if job is not None:
+                    await self._process(bot, job)
+                    continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in broadcast job runner: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self, bot: Bot):
+        """Запустить исполнитель в фоне"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        """Остановить исполнитель (рассылка продолжится после перезапуска)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+broadcast_jobs = BroadcastJobRunner(
+    chunk_size=settings.BROADCAST_CHUNK_SIZE,
+    progress_interval=settings.BROADCAST_PROGRESS_INTERVAL
+)
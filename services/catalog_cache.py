@@ -0,0 +1,288 @@
+"""Снимок каталога в памяти процесса
+
+Категории и товары меняются только из админ-панели, а остатки - при продаже,
+отмене заказа и загрузке аккаунтов. Поэтому просмотр каталога обслуживается
+из памяти:
+
+- invalidate_catalog() - после изменений каталога в админ-панели, следующее
+  чтение полностью перезагружает снимок;
+- mark_stock_changed(session, product_id) - при изменении остатка; после commit
+  этой сессии остаток товара перечитывается одним запросом.
+
+Каждое изменение увеличивает версию снимка (version), а каждая полная
+перезагрузка - еще и structure_version. display_version меняется при полной
+перезагрузке и когда товар появляется в наличии или заканчивается: от него
+зависит витрина (порядок товаров и отметки наличия), по нему кешируются
+отсортированные списки товаров и клавиатуры каталога.
+Изменения из других процессов подхватываются по таймерам CATALOG_CACHE_TTL
+и CATALOG_STOCK_TTL.
+
+Плановое обновление по таймеру читает через переданную сессию (обычно
+реплику). Перезагрузка после invalidate_catalog() и перечитывание измененных
+остатков всегда идут в основную БД: реплика может еще не получить только что
+записанные изменения, и устаревший снимок остался бы в кеше до следующего
+изменения.
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional, Set
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import async_session_maker
+from database.models import Category, Product
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ключ в session.info для остатков, изменившихся в текущей транзакции
+_PENDING_STOCK_KEY = "catalog_stock_changed"
+
+
+class CategoryView:
+    """Категория в снимке каталога"""
+
+    __slots__ = ("id", "name", "description", "is_active")
+
+    def __init__(self, category: Category):
+        self.id = category.id
+        self.name = category.name
+        self.description = category.description
+        self.is_active = category.is_active
+
+
+class ProductView:
+    """Товар в снимке каталога"""
+
+    __slots__ = (
+        "id", "name", "description", "price", "category_id", "stock_count",
+        "is_active", "format_info", "recommendations"
+    )
+
+    def __init__(self, product: Product):
+        self.id = product.id
+        self.name = product.name
+        self.description = product.description
+        self.price = product.price
+        self.category_id = product.category_id
+        self.stock_count = product.stock_count
+        self.is_active = product.is_active
+        self.format_info = product.format_info
+        self.recommendations = product.recommendations
+
+
+class CatalogSnapshot:
+    """Неизменяемый (кроме остатков) снимок каталога"""
+
+    def __init__(
+        self,
+        categories: List[CategoryView],
+        products: List[ProductView],
+        version: int,
+        structure_version: int,
+        display_version: int
+    ):
+        self.version = version
+        self.structure_version = structure_version
+        self.display_version = display_version
+        self.categories = categories
+        self.products: Dict[int, ProductView] = {p.id: p for p in products}
+        self._by_category: Dict[int, List[ProductView]] = {}
+        for product in products:
+            self._by_category.setdefault(product.category_id, []).append(product)
+        # Отсортированные витрины категорий, действительны до смены display_version
+        self._sorted: Dict[int, List[ProductView]] = {}
+
+    def active_categories(self) -> List[CategoryView]:
+        """Активные категории"""
+        return [c for c in self.categories if c.is_active]
+
+    def active_products(self, category_id: int) -> List[ProductView]:
+        """Активные товары категории"""
+        return [p for p in self._by_category.get(category_id, []) if p.is_active]
+
+    def sorted_products(self, category_id: int) -> List[ProductView]:
+        """Активные товары категории для витрины: сначала в наличии, затем по названию"""
+        products = self._sorted.get(category_id)
+        if products is None:
+            products = sorted(
+                self.active_products(category_id),
+                key=lambda p: (p.stock_count <= 0, p.name, p.id)
+            )
+            self._sorted[category_id] = products
+        return products
+
+    def _display_changed(self, display_version: int):
+        self.display_version = display_version
+        self._sorted = {}
+
+    def get_product(self, product_id: int) -> Optional[ProductView]:
+        """Товар по ID (в том числе неактивный)"""
+        return self.products.get(product_id)
+
+
+class CatalogCache:
+    """Кеш снимка каталога"""
+
+    def __init__(self, ttl: float, stock_ttl: float):
+        self.ttl = ttl
+        self.stock_ttl = stock_ttl
+        self.version = 0
+        self.structure_version = 0
+        self.display_version = 0
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._loaded_at = 0.0
+        self._stock_loaded_at = 0.0
+        self._dirty_stock: Set[int] = set()
+        # Снимок сброшен после изменения - перезагрузить из основной БД
+        self._invalidated = False
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        """Полная перезагрузка при следующем чтении"""
+        self._snapshot = None
+        self._invalidated = True
+        self.version += 1
+
+    def mark_stock_dirty(self, product_ids):
+        """Перечитать остатки товаров при следующем чтении"""
+        self._dirty_stock.update(product_ids)
+        self.version += 1
+
+    async def get(self, session: AsyncSession) -> CatalogSnapshot:
+        """Получить актуальный снимок каталога"""
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if (
+            snapshot is not None
+            and now - self._loaded_at < self.ttl
+            and now - self._stock_loaded_at < self.stock_ttl
+            and not self._dirty_stock
+        ):
+            return snapshot
+
+        async with self._lock:
+            now = time.monotonic()
+            if self._snapshot is None or now - self._loaded_at >= self.ttl:
+                if self._invalidated:
+                    self._invalidated = False
+                    try:
+                        async with async_session_maker() as primary:
+                            await self._load(primary)
+                    except Exception:
+                        self._invalidated = True
+                        raise
+                else:
+                    await self._load(session)
+            elif self._dirty_stock:
+                stock_expired = now - self._stock_loaded_at >= self.stock_ttl
+                async with async_session_maker() as primary:
+                    await self._refresh_stock(primary, None if stock_expired else self._dirty_stock)
+            elif now - self._stock_loaded_at >= self.stock_ttl:
+                await self._refresh_stock(session, None)
+            return self._snapshot
+
+    async def _load(self, session: AsyncSession):
+        version = self.version
+        # Отметки снимаются до запроса: сделанные во время загрузки останутся до следующего чтения
+        dirty = set(self._dirty_stock)
+        self._dirty_stock.clear()
+        try:
+            result_categories = await session.execute(select(Category).order_by(Category.id))
+            categories = [CategoryView(c) for c in result_categories.scalars().all()]
+            result_products = await session.execute(select(Product).order_by(Product.id))
+            products = [ProductView(p) for p in result_products.scalars().all()]
+        except Exception:
+            self._dirty_stock.update(dirty)
+            raise
+
+        self.structure_version += 1
+        self.display_version += 1
+        self._snapshot = CatalogSnapshot(
+            categories, products, version, self.structure_version, self.display_version
+        )
+        self._loaded_at = self._stock_loaded_at = time.monotonic()
+        if self.version != version:
+            # Каталог изменили во время загрузки - перезагрузим при следующем чтении
+            self._loaded_at = 0.0
+        logger.debug(f"Catalog snapshot loaded: {len(categories)} categories, {len(products)} products")
+
+    async def _refresh_stock(self, session: AsyncSession, product_ids: Optional[Set[int]]):
+        """Перечитать остатки (всех товаров или только измененных)"""
+        stmt = select(Product.id, Product.stock_count)
+        if product_ids is not None:
+            dirty = set(product_ids)
+            stmt = stmt.where(Product.id.in_(dirty))
+            self._dirty_stock.difference_update(dirty)
+        else:
+            dirty = set(self._dirty_stock)
+            self._dirty_stock.clear()
+
+        started = time.monotonic()
+        try:
+            result = await session.execute(stmt)
+            rows = result.all()
+        except Exception:
+            # Остатки не перечитаны - вернем отметки, чтобы повторить при следующем чтении
+            self._dirty_stock.update(dirty)
+            raise
+        if product_ids is None:
+            self._stock_loaded_at = started
+
+        display_changed = False
+        for product_id, stock_count in rows:
+            product = self._snapshot.products.get(product_id)
+            if product is None:
+                # Новый товар из другого процесса - нужна полная перезагрузка
+                try:
+                    await self._load(session)
+                except Exception:
+                    self._dirty_stock.update(dirty)
+                    raise
+                return
+            if (product.stock_count > 0) != (stock_count > 0):
+                display_changed = True
+            product.stock_count = stock_count
+        if display_changed:
+            self.display_version += 1
+            self._snapshot._display_changed(self.display_version)
+        self._snapshot.version = self.version
+
+
+catalog_cache = CatalogCache(ttl=settings.CATALOG_CACHE_TTL, stock_ttl=settings.CATALOG_STOCK_TTL)
+
+
+async def get_catalog(session: AsyncSession) -> CatalogSnapshot:
+    """Получить снимок каталога"""
+    return await catalog_cache.get(session)
+
+
+def get_catalog_version() -> int:
+    """Текущая версия каталога (меняется при любом изменении)"""
+    return catalog_cache.version
+
+
+def invalidate_catalog():
+    """Сбросить снимок каталога (вызывать после commit изменений в админ-панели)"""
+    catalog_cache.invalidate()
+
+
+def mark_stock_changed(session: AsyncSession, product_id: int):
+    """Отметить изменение остатка товара в текущей транзакции
+
+    Остаток будет перечитан только после успешного commit сессии.
+    """
+    session.info.setdefault(_PENDING_STOCK_KEY, set()).add(product_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_pending_stock_changes(session: Session):
+    product_ids = session.info.pop(_PENDING_STOCK_KEY, None)
+    if product_ids:
+        catalog_cache.mark_stock_dirty(product_ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_stock_changes(session: Session):
+    session.info.pop(_PENDING_STOCK_KEY, None)
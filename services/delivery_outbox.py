@@ -0,0 +1,260 @@
+"""Outbox доставок после оплаты
+
+Оплата заказа и выдача товара разделены: в транзакции оплаты вызывается
+enqueue_order_delivery(), которая добавляет в delivery_outbox файл с товаром
+для покупателя и уведомление администраторов. После commit фоновые воркеры
+отправляют записи в Telegram:
+
+- доставка выполняется "хотя бы один раз": запись отмечается SENT только
+  после успешной отправки, захваченная упавшим процессом запись
+  отправляется повторно после окончания аренды;
+- при 429 (TelegramRetryAfter) повтор выполняется через retry_after и не
+  расходует попытки (ограничен DELIVERY_OUTBOX_MAX_FLOOD_WAITS), при 5xx и
+  сетевых ошибках - с экспоненциальной задержкой;
+- если пользователь заблокировал бота или чат не найден, запись сразу
+  отмечается FAILED (товар остается в payload и может быть выдан вручную).
+  О недоставленном товаре администраторы получают уведомление (тоже через
+  outbox).
+
+Содержимое товара (payload.content) удаляется из записи тем же UPDATE, что
+отмечает ее SENT. У записей FAILED оно удаляется через
+DELIVERY_OUTBOX_FAILED_RETENTION_DAYS дней (redact_failed, задача лидера).
+
+Состояние доставки заказа - записи delivery_outbox с его order_id (для
+пакетной оплаты - payload.order_ids).
+"""
+import html
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import BufferedInputFile
+from sqlalchemy import select, update
+from database.database import async_session_maker
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.models import DeliveryOutbox, Order, Account
+from services.account_service import create_accounts_file
+from services.lease_queue import LeaseQueueWorkers, PermanentFailure, RetryLater
+from services.reachability import is_unreachable_error, mark_unreachable
+from services.notifications import (
+    build_purchase_notification, build_batch_purchase_notification, deliver_notification_to_chat
+)
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "PENDING"
+STATUS_SENT = "SENT"
+STATUS_FAILED = "FAILED"
+
+KIND_ORDER_DOCUMENT = "order_document"
+KIND_PURCHASE_NOTIFICATION = "purchase_notification"
+KIND_ADMIN_ALERT = "admin_alert"
+
+
+def _add_delivery(session: AsyncSession, kind: str, order_id: Optional[int], chat_id: Optional[int], payload: Dict[str, Any]):
+    session.add(DeliveryOutbox(
+        order_id=order_id,
+        kind=kind,
+        chat_id=chat_id,
+        payload=json.dumps(payload, ensure_ascii=False),
+        status=STATUS_PENDING,
+        next_attempt_at=datetime.now()
+    ))
+
+
+async def enqueue_order_delivery(
+    session: AsyncSession,
+    order: Order,
+    accounts: List[Account],
+    chat_id: int,
+    caption: Optional[str] = None
+):
+    """Добавить выдачу товара и уведомление администраторов в текущую транзакцию
+
+    Вызывается до commit оплаты: аккаунты удаляются из БД в той же транзакции,
+    поэтому их содержимое сохраняется в outbox. После commit нужно вызвать
+    delivery_outbox.notify().
+    """
+    file_obj = await create_accounts_file(accounts)
+    _add_delivery(session, KIND_ORDER_DOCUMENT, order.id, chat_id, {
+        "filename": file_obj.name,
+        "content": file_obj.getvalue().decode("utf-8"),
+        "caption": caption or f"✅ Заказ #{order.id} оплачен и выполнен!\n\n📦 Ваш товар:",
+    })
+
+    text = await build_purchase_notification(session, order)
+    if text:
+        _add_delivery(session, KIND_PURCHASE_NOTIFICATION, order.id, None, {"text": text})
+
+
+async def enqueue_batch_delivery(
+    session: AsyncSession,
+    orders: List[Order],
+    accounts: List[Account],
+    chat_id: int
+):
+    """Добавить одну выдачу товара и одно уведомление для пакетной оплаты заказов
+
+    Товар всех заказов отправляется одним файлом. order_id у таких записей
+    пуст, номера заказов хранятся в payload (order_ids).
+    """
+    order_ids = [order.id for order in orders]
+    numbers = ", ".join(f"#{order_id}" for order_id in order_ids)
+    file_obj = await create_accounts_file(accounts)
+    _add_delivery(session, KIND_ORDER_DOCUMENT, None, chat_id, {
+        "filename": file_obj.name,
+        "content": file_obj.getvalue().decode("utf-8"),
+        "caption": f"✅ Заказы {numbers} оплачены и выполнены!\n\n📦 Ваш товар:",
+        "order_ids": order_ids,
+    })
+
+    text = await build_batch_purchase_notification(session, orders)
+    if text:
+        _add_delivery(session, KIND_PURCHASE_NOTIFICATION, None, None, {"text": text, "order_ids": order_ids})
+
+
+def _redact_payload(payload: str) -> str:
+    """payload без содержимого товара"""
+    data = json.loads(payload)
+    data.pop("content", None)
+    data["redacted"] = True
+    return json.dumps(data, ensure_ascii=False)
+
+
+async def get_order_delivery_status(session: AsyncSession, order_id: int) -> Optional[str]:
+    """Статус доставки товара по заказу (None, если доставка не создавалась)"""
+    result = await session.execute(
+        select(DeliveryOutbox.status).where(
+            DeliveryOutbox.order_id == order_id,
+            DeliveryOutbox.kind == KIND_ORDER_DOCUMENT
+        ).order_by(DeliveryOutbox.id.desc()).limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
+class DeliveryOutboxWorkers(LeaseQueueWorkers):
+    """Пул воркеров, отправляющих записи delivery_outbox
+
+    Количество воркеров ограничивает число одновременных запросов к Telegram API.
+    """
+
+    def __init__(self, workers: int, max_attempts: int, max_flood_waits: int):
+        super().__init__(
+            name="delivery outbox",
+            model=DeliveryOutbox,
+            workers=workers,
+            max_attempts=max_attempts,
+            pending_status=STATUS_PENDING,
+            done_status=STATUS_SENT,
+            done_at="sent_at",
+            backoff_base=5,
+            lease_seconds=120,
+            max_deferrals=max_flood_waits
+        )
+
+    def describe(self, delivery: DeliveryOutbox) -> str:
+        return f"Delivery {delivery.id} (order {delivery.order_id})"
+
+    def done_values(self, delivery: DeliveryOutbox) -> Dict[str, Any]:
+        # Товар доставлен - данные аккаунтов в БД больше не храним
+        if delivery.kind == KIND_ORDER_DOCUMENT:
+            return {"payload": _redact_payload(delivery.payload)}
+        return {}
+
+    async def _send(self, bot: Bot, delivery: DeliveryOutbox):
+        payload = json.loads(delivery.payload)
+        if delivery.kind == KIND_ORDER_DOCUMENT:
+            await bot.send_document(
+                delivery.chat_id,
+                BufferedInputFile(payload["content"].encode("utf-8"), filename=payload["filename"]),
+                caption=payload["caption"]
+            )
+        elif delivery.kind in (KIND_PURCHASE_NOTIFICATION, KIND_ADMIN_ALERT):
+            await deliver_notification_to_chat(bot, payload["text"])
+        else:
+            raise PermanentFailure(f"Unknown delivery kind: {delivery.kind}")
+
+    async def handle(self, delivery: DeliveryOutbox, bot: Bot):
+        try:
+            await self._send(bot, delivery)
+        except TelegramRetryAfter as e:
+            raise RetryLater(str(e), e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Повтор не поможет: бот заблокирован или чат недоступен
+            if delivery.kind == KIND_ORDER_DOCUMENT and is_unreachable_error(e):
+                await mark_unreachable([delivery.chat_id])
+            raise PermanentFailure(str(e))
+        # 5xx, сетевые ошибки и прочее - повтор с экспоненциальной задержкой
+
+    async def on_failed(self, session: AsyncSession, delivery: DeliveryOutbox, error: str):
+        if delivery.kind != KIND_ORDER_DOCUMENT:
+            return
+        # Покупатель не получил оплаченный товар - администраторы должны выдать его вручную
+        order_ids = json.loads(delivery.payload).get("order_ids") or [delivery.order_id]
+        numbers = ", ".join(f"#{order_id}" for order_id in order_ids if order_id) or "-"
+        _add_delivery(session, KIND_ADMIN_ALERT, delivery.order_id, None, {"text": (
+            f"⚠️ <b>Товар не доставлен</b>\n\n"
+            f"📦 Заказ: {numbers}\n"
+            f"👤 Покупатель: {delivery.chat_id}\n"
+            f"❗ Ошибка: {html.escape(error or '')}\n\n"
+            f"Товар сохранен в delivery_outbox #{delivery.id}, выдайте его вручную."
+        )})
+        self.notify()
+
+    def start(self, bot: Bot):
+        """Запустить воркеры в фоне"""
+        self._start(bot)
+
+    async def redact_failed(self, batch_size: int = 500) -> int:
+        """Удалить содержимое товара из недоставленных записей старше срока хранения
+
+        Возвращает количество обработанных записей.
+        """
+        cutoff = datetime.now() - timedelta(days=settings.DELIVERY_OUTBOX_FAILED_RETENTION_DAYS)
+        redacted = 0
+        while True:
+            async with async_session_maker() as session:
+                result = await session.execute(
+                    select(DeliveryOutbox.id, DeliveryOutbox.payload)
+                    .where(
+                        DeliveryOutbox.status == STATUS_FAILED,
+                        DeliveryOutbox.kind == KIND_ORDER_DOCUMENT,
+                        DeliveryOutbox.created_at < cutoff,
+                        DeliveryOutbox.payload.like('%"content"%')
+                    )
+                    .order_by(DeliveryOutbox.id)
+                    .limit(batch_size)
+                )
+                rows = result.all()
+                for row in rows:
+                    await session.execute(
+                        update(DeliveryOutbox)
+                        .where(DeliveryOutbox.id == row.id)
+                        .values(payload=_redact_payload(row.payload))
+                    )
+                await session.commit()
+            redacted += len(rows)
+            if len(rows) < batch_size:
+                break
+        if redacted:
+            logger.info(f"Redacted {redacted} failed deliveries older than retention")
+        return redacted
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика доставок"""
+        return {
+            "workers": len(self._tasks),
+            "sent": self.done,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+delivery_outbox = DeliveryOutboxWorkers(
+    workers=settings.DELIVERY_OUTBOX_WORKERS,
+    max_attempts=settings.DELIVERY_OUTBOX_MAX_ATTEMPTS,
+    max_flood_waits=settings.DELIVERY_OUTBOX_MAX_FLOOD_WAITS
+)
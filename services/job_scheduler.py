@@ -0,0 +1,279 @@
+"""Фоновые задачи, которые выполняются только в одном процессе бота
+
+Если запущено несколько процессов бота, периодические задачи (отмена
+просроченных заказов, сверка платежей, очистка FSM) и разовые задачи
+запуска (синхронизация ролей, инструкция по чату поддержки) выполняет
+только лидер.
+
+Лидер выбирается блокировкой:
+- PostgreSQL - сессионная advisory lock (pg_try_advisory_lock) на отдельном
+  соединении вне пула (NullPool), чтобы блокировка не занимала соединение
+  из DB_POOL_SIZE. Если процесс лидера упал или потерял соединение,
+  PostgreSQL снимает блокировку, и ее захватывает другой процесс.
+  Сессионная блокировка не работает через pgbouncer в режиме transaction,
+  поэтому при DB_PGBOUNCER_MODE соединение открывается по
+  DATABASE_DIRECT_URL (напрямую к PostgreSQL); если он не задан,
+  используется блокировка файла (только для процессов на одной машине);
+- SQLite - блокировка файла рядом с базой (flock), снимается ОС при
+  завершении процесса.
+
+Процессы, не ставшие лидером, пытаются захватить блокировку каждые
+JOB_LEADER_RETRY_SECONDS секунд; лидер с той же периодичностью проверяет
+соединение с блокировкой. Статистика задач (длительность последнего
+запуска, время последнего успешного) выводится в /health.
+"""
+import asyncio
+import os
+import time
+import zlib
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+from sqlalchemy.pool import NullPool
+from database.database import engine
+from config import settings
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresLeaderLock:
+    """Сессионная advisory lock PostgreSQL на выделенном соединении
+
+    Соединение открывается отдельным движком без пула: оно живет, пока
+    процесс остается лидером, и не должно уменьшать пул основного движка.
+    """
+
+    def __init__(self, name: str, url: str):
+        # Ключ блокировки - стабильное 32-битное число от имени
+        self.key = zlib.crc32(name.encode("utf-8"))
+        self._engine = create_async_engine(url, poolclass=NullPool)
+        self._connection: Optional[AsyncConnection] = None
+
+    async def acquire(self) -> bool:
+        connection = await self._engine.connect()
+        try:
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            result = await connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key})
+            if result.scalar():
+                self._connection = connection
+                return True
+        except Exception:
+            await connection.close()
+            raise
+        await connection.close()
+        return False
+
+    async def check(self) -> bool:
+        """Проверить, что соединение с блокировкой живо"""
+        try:
+            await self._connection.execute(text("SELECT 1"))
+            return True
+        except Exception as e:
+            logger.error(f"Leader lock connection lost: {e}")
+            return False
+
+    async def release(self):
+        if self._connection is None:
+            return
+        try:
+            await self._connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+        except Exception:
+            pass
+        try:
+            await self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+
+
+class FileLeaderLock:
+    """Блокировка файла для процессов на одной машине (SQLite)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    async def acquire(self) -> bool:
+        if fcntl is None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    async def check(self) -> bool:
+        return True
+
+    async def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _create_lock(name: str):
+    if engine.dialect.name == "postgresql":
+        if settings.DATABASE_DIRECT_URL:
+            return PostgresLeaderLock(name, settings.DATABASE_DIRECT_URL)
+        if not settings.DB_PGBOUNCER_MODE:
+            return PostgresLeaderLock(name, settings.DATABASE_URL)
+        logger.warning(
+            "DB_PGBOUNCER_MODE is on, but DATABASE_DIRECT_URL is not set: "
+            "PostgreSQL leader election is disabled, falling back to a file lock. "
+            "Background jobs will run once per machine, not once per cluster!"
+        )
+    database = engine.url.database
+    if engine.dialect.name == "sqlite" and database and database != ":memory:":
+        return FileLeaderLock(f"{database}.{name}.lock")
+    return FileLeaderLock(os.path.join("logs", f"{name}.lock"))
+
+
+class Job:
+    """Задача планировщика и ее статистика"""
+
+    def __init__(self, name: str, func: Callable[[], Awaitable[Any]], interval: Optional[float]):
+        self.name = name
+        self.func = func
+        # None - разовая задача, выполняется при получении лидерства
+        self.interval = interval
+        self.runs = 0
+        self.failures = 0
+        self.last_duration_ms: Optional[float] = None
+        self.last_success_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    async def run_once(self):
+        started = time.perf_counter()
+        try:
+            await self.func()
+            self.last_success_at = datetime.now()
+            self.last_error = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logger.error(f"Job {self.name} failed: {e}", exc_info=True)
+        finally:
+            self.runs += 1
+            self.last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    async def run(self):
+        await self.run_once()
+        while self.interval is not None:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_duration_ms": self.last_duration_ms,
+            "last_success_at": self.last_success_at.isoformat() if self.last_success_at else None,
+            "last_error": self.last_error,
+        }
+
+
+class JobScheduler:
+    """Выполнение задач в процессе-лидере"""
+
+    def __init__(self, lock_name: str, retry_interval: float):
+        self.lock_name = lock_name
+        self.retry_interval = retry_interval
+        self._jobs: List[Job] = []
+        # Долгоживущие фоновые службы: (имя, запуск, остановка)
+        self._services: List[tuple] = []
+        self._job_tasks: List[asyncio.Task] = []
+        self._task: Optional[asyncio.Task] = None
+        self.is_leader = False
+        self.leader_since: Optional[datetime] = None
+
+    def add_job(self, name: str, func: Callable[[], Awaitable[Any]], interval: Optional[float] = None):
+        """Добавить задачу: периодическую (interval в секундах) или разовую"""
+        self._jobs.append(Job(name, func, interval))
+
+    def add_service(self, name: str, start: Callable[[], None], stop: Callable[[], Awaitable[None]]):
+        """Добавить фоновую службу со своим циклом (работает, пока процесс - лидер)"""
+        self._services.append((name, start, stop))
+
+    async def _lead(self):
+        self.is_leader = True
+        self.leader_since = datetime.now()
+        logger.info(f"This process is now the leader for background jobs ({self.lock_name})")
+        for name, start, _ in self._services:
+            start()
+        self._job_tasks = [asyncio.create_task(job.run()) for job in self._jobs]
+
+    async def _step_down(self):
+        for task in self._job_tasks:
+            task.cancel()
+        await asyncio.gather(*self._job_tasks, return_exceptions=True)
+        self._job_tasks = []
+        for name, _, stop in self._services:
+            try:
+                await stop()
+            except Exception as e:
+                logger.error(f"Error stopping {name}: {e}")
+        self.is_leader = False
+        self.leader_since = None
+
+    async def run(self):
+        """Основной цикл: захват лидерства и контроль блокировки"""
+        lock = _create_lock(self.lock_name)
+        try:
+            while True:
+                try:
+                    if not self.is_leader:
+                        if await lock.acquire():
+                            await self._lead()
+                    elif not await lock.check():
+                        logger.warning("Lost leadership, stopping background jobs")
+                        await self._step_down()
+                        await lock.release()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error in job scheduler: {e}", exc_info=True)
+                await asyncio.sleep(self.retry_interval)
+        finally:
+            if self.is_leader:
+                await self._step_down()
+            await lock.release()
+
+    def start(self):
+        """Запустить планировщик в фоне"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Остановить задачи и освободить лидерство"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика задач для /health"""
+        return {
+            "is_leader": self.is_leader,
+            "leader_since": self.leader_since.isoformat() if self.leader_since else None,
+            "services": [name for name, _, _ in self._services],
+            "jobs": {job.name: job.get_stats() for job in self._jobs},
+        }
+
+
+job_scheduler = JobScheduler(lock_name="tgmailbot_jobs", retry_interval=settings.JOB_LEADER_RETRY_SECONDS)
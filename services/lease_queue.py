@@ -0,0 +1,301 @@
+"""Очередь задач в таблице БД с арендой записей
+
+Общий воркер для payment_events (services/payment_inbox.py) и
+delivery_outbox (services/delivery_outbox.py). Таблица должна иметь столбцы
+status, attempts, deferrals, last_error, next_attempt_at и locked_until.
+
+Воркеры захватывают по одной записи через UPDATE ... RETURNING с подзапросом
+SELECT ... FOR UPDATE SKIP LOCKED и арендой (locked_until): запись,
+захваченная упавшим процессом, после окончания аренды обрабатывается снова.
+
+Результат обработчика:
+- завершился без исключения - запись отмечается выполненной;
+- PermanentFailure - повтор не поможет, запись сразу отмечается FAILED;
+- RetryLater с задержкой (например, retry_after при 429 Telegram) - повтор
+  через эту задержку; такой повтор не расходует попытки (ограничен отдельно
+  max_deferrals);
+- RetryLater без задержки и другие исключения - повтор с экспоненциальной
+  задержкой.
+Повторы ограничены max_attempts попытками, после чего запись отмечается FAILED.
+Запись, аренда которой истекла после последней попытки, повторно не
+захватывается: свободный воркер отмечает ее FAILED (_fail_expired).
+"""
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import async_session_maker
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATUS_PROCESSING = "PROCESSING"
+STATUS_FAILED = "FAILED"
+
+
+class PermanentFailure(Exception):
+    """Ошибка, которую повтор не исправит"""
+
+
+class RetryLater(Exception):
+    """Временная ошибка (delay - известный срок повтора, например retry_after)"""
+
+    def __init__(self, message: str, delay: Optional[float] = None):
+        super().__init__(message)
+        self.delay = delay
+
+
+class LeaseQueueWorkers:
+    """Пул воркеров, обрабатывающих записи таблицы-очереди
+
+    Args:
+        name: имя очереди для логов
+        model: модель таблицы-очереди
+        pending_status: статус записи, ожидающей обработки
+        done_status: статус успешно обработанной записи
+        done_at: столбец с временем успешной обработки
+        failed_at: столбец с временем перевода в FAILED (None - не заполнять)
+        backoff_base: задержка первого повтора, секунд (удваивается с каждой попыткой)
+        backoff_max: максимальная задержка повтора, секунд
+        max_deferrals: максимум повторов по RetryLater с задержкой
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model,
+        workers: int,
+        max_attempts: int,
+        pending_status: str,
+        done_status: str,
+        done_at: str,
+        failed_at: Optional[str] = None,
+        backoff_base: float = 10,
+        backoff_max: float = 600,
+        poll_interval: float = 5,
+        lease_seconds: int = 300,
+        max_deferrals: int = 50
+    ):
+        self.name = name
+        self.model = model
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.pending_status = pending_status
+        self.done_status = done_status
+        self.done_at = done_at
+        self.failed_at = failed_at
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_deferrals = max_deferrals
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        # Счетчики для /health
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+
+    def notify(self):
+        """Разбудить воркеры после commit новых записей"""
+        self._wakeup.set()
+
+    def describe(self, record) -> str:
+        """Описание записи для логов"""
+        return f"{self.name} record {record.id}"
+
+    async def handle(self, record, context: Any):
+        """Обработать запись (переопределяется)"""
+        raise NotImplementedError
+
+    def done_values(self, record) -> Dict[str, Any]:
+        """Дополнительные значения для записи, отмечаемой выполненной (переопределяется)"""
+        return {}
+
+    async def on_failed(self, session: AsyncSession, record, error: str):
+        """Вызывается в транзакции, которая отмечает запись FAILED (переопределяется)"""
+
+    async def _claim(self):
+        """Захватить одну запись, готовую к обработке"""
+        model = self.model
+        now = datetime.now()
+        is_ready = or_(
+            and_(model.status == self.pending_status, model.next_attempt_at <= now),
+            and_(
+                model.status == STATUS_PROCESSING,
+                model.locked_until <= now,
+                model.attempts < self.max_attempts
+            )
+        )
+        candidate = (
+            select(model.id)
+            .where(is_ready)
+            .order_by(model.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        async with async_session_maker() as session:
+            # Условие повторяется во внешнем UPDATE: из двух воркеров,
+            # выбравших одну запись, ее получит только один
+            result = await session.execute(
+                update(model)
+                .where(model.id == candidate, is_ready)
+                .values(
+                    status=STATUS_PROCESSING,
+                    locked_until=now + timedelta(seconds=self.lease_seconds),
+                    attempts=model.attempts + 1
+                )
+                .returning(model)
+                .execution_options(synchronize_session=False)
+            )
+            record = result.scalar_one_or_none()
+            await session.commit()
+            return record
+
+    async def _fail_expired(self) -> bool:
+        """Отметить FAILED одну запись, аренда которой истекла после последней попытки
+
+        Возвращает True, если такая запись нашлась.
+        """
+        model = self.model
+        now = datetime.now()
+        is_exhausted = and_(
+            model.status == STATUS_PROCESSING,
+            model.locked_until <= now,
+            model.attempts >= self.max_attempts
+        )
+        candidate = (
+            select(model.id)
+            .where(is_exhausted)
+            .order_by(model.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        error = "Lease expired after the last attempt"
+        values = {"status": STATUS_FAILED, "locked_until": None, "last_error": error}
+        if self.failed_at:
+            values[self.failed_at] = now
+        async with async_session_maker() as session:
+            result = await session.execute(
+                update(model)
+                .where(model.id == candidate, is_exhausted)
+                .values(**values)
+                .returning(model)
+                .execution_options(synchronize_session=False)
+            )
+            record = result.scalar_one_or_none()
+            if record is not None:
+                self.failed += 1
+                logger.error(f"{self.describe(record)} failed after {record.attempts} attempts: {error}")
+                await self.on_failed(session, record, error)
+            await session.commit()
+            return record is not None
+
+    def _backoff(self, record) -> float:
+        """Экспоненциальная задержка повтора: backoff_base, x2, x4 ... не больше backoff_max"""
+        return min(self.backoff_base * 2 ** (record.attempts - 1), self.backoff_max)
+
+    def _failure_values(
+        self,
+        record,
+        now: datetime,
+        error: str,
+        retry_delay: Optional[float],
+        deferred: bool = False
+    ) -> Dict[str, Any]:
+        """Значения для записи после неудачной обработки
+
+        deferred - повтор по известному сроку: попытка, учтенная при захвате,
+        возвращается, повтор учитывается в deferrals.
+        """
+        if deferred:
+            can_retry = record.deferrals < self.max_deferrals
+        else:
+            can_retry = retry_delay is not None and record.attempts < self.max_attempts
+        if can_retry:
+            self.retried += 1
+            # Будим воркеры к сроку повтора, не дожидаясь очередного опроса
+            asyncio.get_running_loop().call_later(retry_delay, self._wakeup.set)
+            logger.warning(f"{self.describe(record)} will be retried in {retry_delay}s: {error}")
+            values = {
+                "status": self.pending_status,
+                "next_attempt_at": now + timedelta(seconds=retry_delay),
+                "locked_until": None,
+                "last_error": error,
+            }
+            if deferred:
+                values["attempts"] = record.attempts - 1
+                values["deferrals"] = record.deferrals + 1
+            return values
+
+        self.failed += 1
+        logger.error(f"{self.describe(record)} failed after {record.attempts} attempts: {error}")
+        values = {"status": STATUS_FAILED, "locked_until": None, "last_error": error}
+        if self.failed_at:
+            values[self.failed_at] = now
+        return values
+
+    async def _process(self, record, context: Any):
+        try:
+            await self.handle(record, context)
+            now = datetime.now()
+            values = {"status": self.done_status, self.done_at: now, "locked_until": None, "last_error": None}
+            values.update(self.done_values(record))
+            self.done += 1
+        except PermanentFailure as e:
+            values = self._failure_values(record, datetime.now(), str(e), None)
+        except RetryLater as e:
+            if e.delay is not None:
+                values = self._failure_values(record, datetime.now(), str(e), e.delay, deferred=True)
+            else:
+                values = self._failure_values(record, datetime.now(), str(e), self._backoff(record))
+        except Exception as e:
+            logger.error(f"Error processing {self.describe(record)}: {e}", exc_info=True)
+            values = self._failure_values(record, datetime.now(), str(e), self._backoff(record))
+
+        async with async_session_maker() as session:
+            await session.execute(
+                update(self.model)
+                .where(self.model.id == record.id)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            if values["status"] == STATUS_FAILED:
+                await self.on_failed(session, record, values["last_error"])
+            await session.commit()
+
+    async def _run_worker(self, context: Any):
+        while True:
+            try:
+                self._wakeup.clear()
+                record = await self._claim()
+                if record is not None:
+                    await self._process(record, context)
+                    continue
+                if await self._fail_expired():
+                    continue
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in {self.name} worker: {e}", exc_info=True)
+                await asyncio.sleep(5)
+
+    def _start(self, context: Any):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._run_worker(context)) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Остановить воркеры (захваченные записи будут обработаны повторно после аренды)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -1,42 +1,63 @@
 """Сервис уведомлений"""
+from typing import Optional
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
 from database.models import StockNotification, Product, User
+from services.catalog_cache import mark_stock_changed
+from services.reachability import is_unreachable_error, mark_unreachable
 from config import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-async def send_notification_to_chat(bot, message: str, parse_mode: str = "HTML"):
-    """Отправить уведомление в канал/чат поддержки"""
-    try:
-        chat_id = settings.NOTIFICATIONS_CHAT_ID
-        if not chat_id:
-            # Если канал не настроен, отправляем администраторам
-            for admin_id in settings.admin_ids_list:
-                try:
-                    await bot.send_message(admin_id, message, parse_mode=parse_mode)
-                except Exception as e:
-                    logger.error(f"Error sending notification to admin {admin_id}: {e}")
-            return
-        
-        # Пытаемся отправить в канал/чат
+async def _send_notification_to_admins(bot, message: str, parse_mode: str):
+    """Отправить уведомление администраторам
+
+    Ошибка пробрасывается, только если уведомление не получил ни один
+    администратор: повтор для части администраторов дублировал бы сообщение.
+    """
+    error = None
+    delivered = False
+    for admin_id in settings.admin_ids_list:
         try:
-            # Если это числовой ID
-            if chat_id.lstrip('-').isdigit():
-                await bot.send_message(int(chat_id), message, parse_mode=parse_mode)
-            else:
-                # Если это username (начинается с @)
-                await bot.send_message(chat_id, message, parse_mode=parse_mode)
+            await bot.send_message(admin_id, message, parse_mode=parse_mode)
+            delivered = True
         except Exception as e:
-            logger.error(f"Error sending notification to chat {chat_id}: {e}")
-            # Fallback: отправляем администраторам
-            for admin_id in settings.admin_ids_list:
-                try:
-                    await bot.send_message(admin_id, message, parse_mode=parse_mode)
-                except:
-                    pass
+            error = e
+            logger.error(f"Error sending notification to admin {admin_id}: {e}")
+    if not delivered and error is not None:
+        raise error
+
+
+async def deliver_notification_to_chat(bot, message: str, parse_mode: str = "HTML"):
+    """Отправить уведомление в канал/чат поддержки (ошибки пробрасываются)
+
+    Если канал недоступен (бот удален из канала, неверный ID), уведомление
+    отправляется администраторам. Временные ошибки Telegram (429, 5xx, сеть)
+    пробрасываются, чтобы вызывающий код мог повторить отправку
+    (services/delivery_outbox.py).
+    """
+    chat_id = settings.NOTIFICATIONS_CHAT_ID
+    if not chat_id:
+        # Если канал не настроен, отправляем администраторам
+        await _send_notification_to_admins(bot, message, parse_mode)
+        return
+    
+    try:
+        # Числовой ID или username (начинается с @)
+        await bot.send_message(int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id, message, parse_mode=parse_mode)
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logger.error(f"Error sending notification to chat {chat_id}: {e}")
+        # Fallback: отправляем администраторам
+        await _send_notification_to_admins(bot, message, parse_mode)
+
+
+async def send_notification_to_chat(bot, message: str, parse_mode: str = "HTML"):
+    """Отправить уведомление в канал/чат поддержки без повторов (ошибки логируются)"""
+    try:
+        await deliver_notification_to_chat(bot, message, parse_mode)
     except Exception as e:
         logger.error(f"Error in send_notification_to_chat: {e}")
 
@@ -79,6 +100,7 @@ async def notify_stock_available(session: AsyncSession, product_id: int, bot, ch
                     .where(Product.id == product_id)
                     .values(stock_count=actual_stock_count)
                 )
+                mark_stock_changed(session, product_id)
                 await session.commit()
                 # Обновляем объект product
                 result_product = await session.execute(stmt_product)
@@ -88,63 +110,65 @@ async def notify_stock_available(session: AsyncSession, product_id: int, bot, ch
             if product.stock_count <= 0:
                 return
         
-        # Получаем все активные подписки
-        stmt = select(StockNotification).where(
-            StockNotification.product_id == product_id,
-            StockNotification.is_notified == False
+        # Получаем активные подписки вместе с telegram_id (недоступные пользователи пропускаются)
+        stmt = (
+            select(StockNotification, User.telegram_id)
+            .join(User, User.id == StockNotification.user_id)
+            .where(
+                StockNotification.product_id == product_id,
+                StockNotification.is_notified == False,
+                User.is_blocked == False,
+                User.is_reachable == True
+            )
         )
         result = await session.execute(stmt)
-        notifications = result.scalars().all()
+        rows = result.all()
         
-        if not notifications:
+        if not rows:
             return
         
         # Отправляем уведомления
-        for notification in notifications:
+        unreachable = []
+        for notification, telegram_id in rows:
             try:
-                stmt_user = select(User).where(User.id == notification.user_id)
-                result_user = await session.execute(stmt_user)
-                user = result_user.scalar_one_or_none()
+                await bot.send_message(
+                    telegram_id,
+                    f"🔔 <b>Товар поступил в продажу!</b>\n\n"
+                    f"📦 {product.name}\n"
+                    f"💰 Цена: {product.price:.2f} ₽\n"
+                    f"📊 В наличии: {product.stock_count} шт.\n\n"
+                    f"Используйте меню 'Каталог' для покупки.",
+                    parse_mode="HTML"
+                )
                 
-                if user and not user.is_blocked:
-                    await bot.send_message(
-                        user.telegram_id,
-                        f"🔔 <b>Товар поступил в продажу!</b>\n\n"
-                        f"📦 {product.name}\n"
-                        f"💰 Цена: {product.price:.2f} ₽\n"
-                        f"📊 В наличии: {product.stock_count} шт.\n\n"
-                        f"Используйте меню 'Каталог' для покупки.",
-                        parse_mode="HTML"
-                    )
-                    
-                    # Помечаем как уведомленное
-                    notification.is_notified = True
+                # Помечаем как уведомленное
+                notification.is_notified = True
             except Exception as e:
+                if is_unreachable_error(e):
+                    unreachable.append(telegram_id)
                 logger.error(f"Error notifying user {notification.user_id}: {e}")
         
         await session.commit()
+        await mark_unreachable(unreachable)
         
     except Exception as e:
         logger.error(f"Error in notify_stock_available: {e}")
 
 
-async def notify_admins_about_purchase(session: AsyncSession, order, bot):
-    """Уведомить администраторов о покупке"""
-    try:
-        from database.models import User, Product
-        
-        stmt_user = select(User).where(User.id == order.user_id)
-        result_user = await session.execute(stmt_user)
-        user = result_user.scalar_one_or_none()
-        
-        stmt_product = select(Product).where(Product.id == order.product_id)
-        result_product = await session.execute(stmt_product)
-        product = result_product.scalar_one_or_none()
-        
-        if not user or not product:
-            return
-        
-        text = f"""🛒 <b>Новая покупка</b>
+async def build_purchase_notification(session: AsyncSession, order) -> Optional[str]:
+    """Текст уведомления администраторов о покупке (None, если данных нет)"""
+    stmt_user = select(User).where(User.id == order.user_id)
+    result_user = await session.execute(stmt_user)
+    user = result_user.scalar_one_or_none()
+    
+    stmt_product = select(Product).where(Product.id == order.product_id)
+    result_product = await session.execute(stmt_product)
+    product = result_product.scalar_one_or_none()
+    
+    if not user or not product:
+        return None
+    
+    return f"""🛒 <b>Новая покупка</b>
 
 👤 Пользователь: @{user.username or user.first_name or 'Без имени'} (ID: {user.telegram_id})
 📦 Товар: {product.name}
@@ -154,11 +178,37 @@ async def notify_admins_about_purchase(session: AsyncSession, order, bot):
 📋 Остаток на складе: {product.stock_count} шт.
 🆔 Заказ: #{order.id}
 """
-        
-        await send_notification_to_chat(bot, text)
-                
-    except Exception as e:
-        logger.error(f"Error in notify_admins_about_purchase: {e}")
+
+
+async def build_batch_purchase_notification(session: AsyncSession, orders) -> Optional[str]:
+    """Текст одного уведомления администраторов о пакетной оплате нескольких заказов"""
+    if not orders:
+        return None
+    
+    stmt_user = select(User).where(User.id == orders[0].user_id)
+    result_user = await session.execute(stmt_user)
+    user = result_user.scalar_one_or_none()
+    
+    stmt_products = select(Product.id, Product.name).where(Product.id.in_({order.product_id for order in orders}))
+    result_products = await session.execute(stmt_products)
+    product_names = dict(result_products.all())
+    
+    if not user:
+        return None
+    
+    lines = "\n".join(
+        f"• #{order.id}: {product_names.get(order.product_id, 'Товар удален')} × {order.quantity} шт. - {order.total_amount:.2f} ₽"
+        for order in orders
+    )
+    total_amount = sum(order.total_amount for order in orders)
+    
+    return f"""🛒 <b>Новая покупка</b> (заказов: {len(orders)})
+
+👤 Пользователь: @{user.username or user.first_name or 'Без имени'} (ID: {user.telegram_id})
+{lines}
+💰 Сумма: {total_amount:.2f} ₽
+💳 Способ оплаты: {orders[0].payment_method or 'Не указан'}
+"""
 
 
 async def notify_user_registration(session: AsyncSession, user: User, bot):
@@ -226,3 +276,22 @@ async def notify_new_order(session: AsyncSession, order, bot):
     except Exception as e:
         logger.error(f"Error in notify_new_order: {e}")
 
+
+
+async def notify_unmatched_payment(bot, payment_method: str, payment_id: str, amount: float, reason: str):
+    """Уведомить о платеже, который невозможно провести (деньги получены, но заказа нет)"""
+    if bot is None:
+        return
+    try:
+        text = f"""⚠️ <b>Платеж не проведен</b>
+
+💳 Платежная система: {payment_method}
+🆔 Платеж: {payment_id}
+💵 Сумма: {amount:.2f} ₽
+❗ Причина: {reason}
+
+Проверьте платеж и при необходимости выдайте товар или верните деньги вручную.
+"""
+        await send_notification_to_chat(bot, text)
+    except Exception as e:
+        logger.error(f"Error in notify_unmatched_payment: {e}")
@@ -0,0 +1,234 @@
+"""Отмена неоплаченных заказов по истечении резерва
+
+Сроки резерва (reserved_until) хранятся в min-heap в памяти процесса.
+Планировщик спит ровно до ближайшего срока, поэтому товар возвращается
+в каталог через ORDER_RESERVATION_MINUTES, а не через интервал опроса.
+
+Планировщик работает только в процессе-лидере (services/job_scheduler.py).
+Куча заполняется из БД при запуске и пересинхронизируется раз в минуту
+(на случай заказов, созданных другими процессами бота). Заказы, созданные
+в процессе-лидере, добавляются через schedule_order_expiry() сразу.
+
+Перед отменой платежи просроченных заказов сверяются с платежной системой
+(services/payment_reconciler.py): заказ, оплаченный без дошедшего webhook,
+проводится, а не отменяется. Платежи отмененных заказов остаются PENDING:
+пользователь может оплатить ссылку и после отмены, а webhook - потеряться,
+поэтому сверка проверяет их до ответа платежной системы или до
+PAYMENT_RECONCILE_MAX_AGE_HOURS (оплата отмененного заказа закрывается как
+PAID_UNMATCHED с уведомлением администраторам).
+"""
+import asyncio
+import heapq
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+from aiogram import Bot
+from sqlalchemy import select, update, case
+from database.database import async_session_maker
+from database.models import Order, Account, Product, User
+from services.catalog_cache import mark_stock_changed
+from services.payment_reconciler import payment_reconciler
+from services.reachability import is_unreachable_error, mark_unreachable
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATUS = "ОЖИДАЕТ ОПЛАТЫ"
+CANCELLED_STATUS = "ОТМЕНЕНО"
+
+
+async def release_expired_orders(order_ids: Optional[Sequence[int]] = None) -> List[Tuple[int, int]]:
+    """Отменить просроченные заказы и вернуть товар на склад одной транзакцией
+
+    Если order_ids не передан, обрабатываются все просроченные заказы.
+    Возвращает список (telegram_id пользователя, ID заказа) для уведомлений,
+    которые отправляются уже после commit.
+    """
+    now = datetime.now()
+    async with async_session_maker() as session:
+        # Отменяем только заказы, которые все еще ждут оплаты и просрочены
+        # (оплаченные параллельно заказы условие не пройдут)
+        stmt = (
+            update(Order)
+            .where(
+                Order.status == PENDING_STATUS,
+                Order.reserved_until <= now
+            )
+            .values(status=CANCELLED_STATUS, reserved_until=None)
+            .returning(Order.id, Order.user_id)
+            .execution_options(synchronize_session=False)
+        )
+        if order_ids is not None:
+            stmt = stmt.where(Order.id.in_(order_ids))
+        result = await session.execute(stmt)
+        cancelled = result.all()
+
+        if not cancelled:
+            return []
+
+        cancelled_ids = [row.id for row in cancelled]
+
+        # Освобождаем аккаунты всех отмененных заказов одним запросом
+        result_accounts = await session.execute(
+            update(Account)
+            .where(Account.order_id.in_(cancelled_ids))
+            .values(is_sold=False, sold_at=None, order_id=None)
+            .returning(Account.product_id)
+            .execution_options(synchronize_session=False)
+        )
+        released = Counter(result_accounts.scalars().all())
+
+        # Возвращаем товар на склад одним UPDATE для всех товаров
+        if released:
+            await session.execute(
+                update(Product)
+                .where(Product.id.in_(list(released)))
+                .values(stock_count=Product.stock_count + case(dict(released), value=Product.id, else_=0))
+                .execution_options(synchronize_session=False)
+            )
+            for product_id in released:
+                mark_stock_changed(session, product_id)
+
+        result_users = await session.execute(
+            select(User.id, User.telegram_id).where(
+                User.id.in_({row.user_id for row in cancelled}),
+                User.is_reachable == True
+            )
+        )
+        telegram_ids = dict(result_users.all())
+
+        await session.commit()
+
+    logger.info(f"Cancelled {len(cancelled_ids)} expired orders, released {sum(released.values())} accounts")
+    return [
+        (telegram_ids[row.user_id], row.id)
+        for row in cancelled
+        if row.user_id in telegram_ids
+    ]
+
+
+async def notify_expired_orders(bot: Bot, notifications: List[Tuple[int, int]]):
+    """Уведомить пользователей об отмене заказов"""
+    unreachable = []
+    for telegram_id, order_id in notifications:
+        try:
+            await bot.send_message(
+                telegram_id,
+                f"⏰ <b>Заказ отменен</b>\n\n"
+                f"Заказ #{order_id} был отменен из-за истечения времени ожидания оплаты "
+                f"({settings.ORDER_RESERVATION_MINUTES} минут).\n\n"
+                f"✅ Товар возвращен в каталог.\n\n"
+                f"Вы можете создать новый заказ.",
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            if is_unreachable_error(e):
+                unreachable.append(telegram_id)
+            logger.error(f"Error notifying user about expired order: {e}")
+    await mark_unreachable(unreachable)
+
+
+class OrderExpiryScheduler:
+    """Планировщик отмены заказов на min-heap сроков резерва"""
+
+    def __init__(self, resync_interval: float = 60):
+        self.resync_interval = resync_interval
+        self._heap: List[Tuple[datetime, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, order_id: int, reserved_until: datetime):
+        """Добавить срок резерва заказа"""
+        if self._task is None or self._task.done():
+            # Планировщик работает в другом процессе (лидере) - заказ попадет
+            # в его кучу при очередной синхронизации с БД
+            return
+        is_earliest = not self._heap or reserved_until < self._heap[0][0]
+        heapq.heappush(self._heap, (reserved_until, order_id))
+        if is_earliest:
+            # Будим планировщик, чтобы он пересчитал время сна
+            self._wakeup.set()
+
+    async def resync(self):
+        """Перестроить кучу по заказам, ожидающим оплаты, из БД"""
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(Order.reserved_until, Order.id).where(
+                    Order.status == PENDING_STATUS,
+                    Order.reserved_until.is_not(None)
+                )
+            )
+            entries = {(row.reserved_until, row.id) for row in result.all()}
+        # Сохраняем сроки, добавленные во время запроса (лишние записи безопасны:
+        # отмена проверяет статус заказа)
+        entries.update(self._heap)
+        heap = list(entries)
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def _pop_due(self, now: datetime) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    async def run(self, bot: Bot):
+        """Основной цикл планировщика"""
+        loop = asyncio.get_running_loop()
+        next_resync = 0.0
+
+        while True:
+            try:
+                self._wakeup.clear()
+                if loop.time() >= next_resync:
+                    await self.resync()
+                    next_resync = loop.time() + self.resync_interval
+
+                due = self._pop_due(datetime.now())
+                if due:
+                    try:
+                        await payment_reconciler.reconcile(due, bot)
+                    except Exception as e:
+                        logger.error(f"Error reconciling payments of expired orders: {e}", exc_info=True)
+                    notifications = await release_expired_orders(due)
+                    await notify_expired_orders(bot, notifications)
+                    continue
+
+                timeout = next_resync - loop.time()
+                if self._heap:
+                    until_deadline = (self._heap[0][0] - datetime.now()).total_seconds()
+                    timeout = min(timeout, until_deadline)
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in order expiry scheduler: {e}", exc_info=True)
+                await asyncio.sleep(5)
+
+    def start(self, bot: Bot):
+        """Запустить планировщик в фоне"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        """Остановить планировщик"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+order_expiry_scheduler = OrderExpiryScheduler()
+
+
+def schedule_order_expiry(order_id: int, reserved_until: datetime):
+    """Запланировать отмену заказа по истечении резерва"""
+    order_expiry_scheduler.schedule(order_id, reserved_until)
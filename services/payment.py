@@ -1,15 +1,175 @@
-"""Интеграция платежных систем"""
+"""Интеграция платежных систем
+
+Запросы к API платежных систем идут через общий для каждой платежной системы
+ProviderClient: одна aiohttp.ClientSession с пулом keep-alive соединений
+(без DNS/TCP/TLS на каждый запрос), таймаутами, ограничением числа
+одновременных запросов и повтором с jitter при сетевых ошибках и 5xx.
+Клиенты открываются в on_startup (start_payment_clients) и закрываются
+в on_shutdown (close_payment_clients).
+"""
+import asyncio
+import base64
 import hashlib
 import hmac
 import json
-from typing import Optional, Dict, Any
-from aiohttp import ClientSession
+import random
+import time
+import uuid
+from typing import Optional, Dict, Any, Tuple
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError, ClientConnectorError
 from config import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class ProviderClient:
+    """HTTP клиент API одной платежной системы"""
+    
+    def __init__(self, name: str, base_url: str, timeout: float, max_connections: int, retries: int):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = ClientTimeout(total=timeout)
+        self.max_connections = max_connections
+        self.retries = retries
+        self._session: Optional[ClientSession] = None
+        # Метрики запросов
+        self.requests = 0
+        self.errors = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+    
+    def _get_session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self.max_connections, ttl_dns_cache=300),
+                timeout=self.timeout
+            )
+        return self._session
+    
+    def start(self):
+        """Открыть сессию (иначе она откроется при первом запросе)"""
+        self._get_session()
+    
+    async def close(self):
+        """Закрыть сессию и соединения"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def request(
+        self,
+        method: str,
+        path: str,
+        headers: Dict[str, str],
+        json_data: Optional[Dict[str, Any]] = None,
+        retry_server_errors: bool = True
+    ) -> Tuple[int, Optional[Dict]]:
+        """Выполнить запрос: (HTTP статус, JSON ответа или None)
+        
+        Сетевые ошибки повторяются всегда, таймауты и 5xx - только при
+        retry_server_errors (для запросов, повтор которых безопасен).
+        """
+        session = self._get_session()
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                async with session.request(method, url, json=json_data, headers=headers) as response:
+                    data = None
+                    if response.content_type == "application/json":
+                        data = await response.json()
+                    status = response.status
+                error = None
+                retryable = status >= 500 and retry_server_errors
+            except asyncio.TimeoutError as e:
+                status, data, error = 0, None, e
+                retryable = retry_server_errors
+            except ClientError as e:
+                status, data, error = 0, None, e
+                # Соединение не установлено - запрос точно не дошел до платежной системы
+                retryable = retry_server_errors or isinstance(e, ClientConnectorError)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.requests += 1
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+            
+            if error is not None or status >= 500:
+                self.errors += 1
+            
+            if not retryable or attempt >= self.retries:
+                if error is not None:
+                    raise error
+                return status, data
+            
+            attempt += 1
+            self.retried += 1
+            # Экспоненциальная задержка с полным jitter
+            delay = random.uniform(0, 0.5 * 2 ** attempt)
+            logger.warning(f"{self.name} API {method} {path} failed ({error or status}), retry in {delay:.2f}s")
+            await asyncio.sleep(delay)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики запросов"""
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retried": self.retried,
+            "latency_avg_ms": round(self.latency_total / self.requests * 1000, 1) if self.requests else 0,
+            "latency_max_ms": round(self.latency_max * 1000, 1),
+        }
+
+
+def _client(name: str, base_url: str) -> ProviderClient:
+    return ProviderClient(
+        name,
+        base_url,
+        timeout=settings.PAYMENT_API_TIMEOUT,
+        max_connections=settings.PAYMENT_API_MAX_CONNECTIONS,
+        retries=settings.PAYMENT_API_RETRIES
+    )
+
+
+yookassa_client = _client("yookassa", settings.YOOKASSA_API_URL)
+heleket_client = _client("heleket", settings.HELEKET_API_URL)
+
+
+def start_payment_clients():
+    """Открыть HTTP клиенты платежных систем"""
+    yookassa_client.start()
+    heleket_client.start()
+
+
+async def close_payment_clients():
+    """Закрыть HTTP клиенты платежных систем"""
+    await yookassa_client.close()
+    await heleket_client.close()
+
+
+def get_payment_api_stats() -> Dict[str, Dict[str, Any]]:
+    """Метрики запросов к API платежных систем"""
+    return {client.name: client.get_stats() for client in (yookassa_client, heleket_client)}
+
+
+def _yookassa_headers() -> Dict[str, str]:
+    auth_string = f"{settings.YOOKASSA_SHOP_ID}:{settings.YOOKASSA_SECRET_KEY}"
+    auth_header = base64.b64encode(auth_string.encode()).decode()
+    return {
+        "Authorization": f"Basic {auth_header}",
+        "Content-Type": "application/json"
+    }
+
+
+def _heleket_headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {settings.HELEKET_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+
 class PaymentService:
     """Сервис для работы с платежными системами"""
     
@@ -20,43 +180,31 @@ class PaymentService:
             return None
         
         try:
-            import base64
-            auth_string = f"{settings.YOOKASSA_SHOP_ID}:{settings.YOOKASSA_SECRET_KEY}"
-            auth_header = base64.b64encode(auth_string.encode()).decode()
-            
-            async with ClientSession() as session:
-                payload = {
-                    "amount": {
-                        "value": f"{amount:.2f}",
-                        "currency": "RUB"
-                    },
-                    "confirmation": {
-                        "type": "redirect",
-                        "return_url": f"https://t.me/{settings.BOT_NAME}"
-                    },
-                    "description": f"Заказ #{order_id}" if order_id else f"Пополнение баланса",
-                    "metadata": {
-                        "order_id": order_id if order_id else 0,
-                        "user_id": user_id
-                    }
+            payload = {
+                "amount": {
+                    "value": f"{amount:.2f}",
+                    "currency": "RUB"
+                },
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": f"https://t.me/{settings.BOT_NAME}"
+                },
+                "description": f"Заказ #{order_id}" if order_id else f"Пополнение баланса",
+                "metadata": {
+                    "order_id": order_id if order_id else 0,
+                    "user_id": user_id
                 }
-                
-                headers = {
-                    "Authorization": f"Basic {auth_header}",
-                    "Content-Type": "application/json"
+            }
+            
+            # Ключ идемпотентности: повтор запроса не создаст второй платеж
+            headers = {**_yookassa_headers(), "Idempotence-Key": str(uuid.uuid4())}
+            
+            status, data = await yookassa_client.request("POST", "/payments", headers, payload)
+            if status == 200 and data:
+                return {
+                    "payment_id": data.get("id"),
+                    "payment_url": data.get("confirmation", {}).get("confirmation_url")
                 }
-                
-                async with session.post(
-                    "https://api.yookassa.ru/v3/payments",
-                    json=payload,
-                    headers=headers
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return {
-                            "payment_id": data.get("id"),
-                            "payment_url": data.get("confirmation", {}).get("confirmation_url")
-                        }
         except Exception as e:
             logger.error(f"YooKassa payment creation error: {e}")
         
@@ -70,34 +218,27 @@ class PaymentService:
             return None
         
         try:
-            async with ClientSession() as session:
-                headers = {
-                    "Authorization": f"Bearer {settings.HELEKET_API_KEY}",
-                    "Content-Type": "application/json"
-                }
-                
-                payload = {
-                    "amount": amount,
-                    "order_id": str(order_id) if order_id else "0",
-                    "user_id": user_id
+            payload = {
+                "amount": amount,
+                "order_id": str(order_id) if order_id else "0",
+                "user_id": user_id
+            }
+            
+            # Без ключа идемпотентности повторяем только неудачные соединения
+            status, data = await heleket_client.request(
+                "POST", "/payments/create", _heleket_headers(), payload, retry_server_errors=False
+            )
+            if status == 200 and data:
+                return {
+                    "payment_id": data.get("payment_id"),
+                    "payment_url": data.get("payment_url")
                 }
-                
-                async with session.post(
-                    "https://api.heleket.com/v1/payments/create",
-                    json=payload,
-                    headers=headers
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return {
-                            "payment_id": data.get("payment_id"),
-                            "payment_url": data.get("payment_url")
-                        }
         except Exception as e:
             logger.error(f"Heleket payment creation error: {e}")
         
         return None
     
+    
     @staticmethod
     def verify_yookassa_webhook(data: Dict[str, Any], signature: str) -> bool:
         """Проверка подписи webhook от ЮКасса"""
@@ -155,22 +296,9 @@ class PaymentService:
             return None
         
         try:
-            import base64
-            auth_string = f"{settings.YOOKASSA_SHOP_ID}:{settings.YOOKASSA_SECRET_KEY}"
-            auth_header = base64.b64encode(auth_string.encode()).decode()
-            
-            async with ClientSession() as session:
-                headers = {
-                    "Authorization": f"Basic {auth_header}",
-                    "Content-Type": "application/json"
-                }
-                
-                async with session.get(
-                    f"https://api.yookassa.ru/v3/payments/{payment_id}",
-                    headers=headers
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
+            status, data = await yookassa_client.request("GET", f"/payments/{payment_id}", _yookassa_headers())
+            if status == 200:
+                return data
         except Exception as e:
             logger.error(f"YooKassa payment status error: {e}")
         
@@ -183,20 +311,10 @@ class PaymentService:
             return None
         
         try:
-            async with ClientSession() as session:
-                headers = {
-                    "Authorization": f"Bearer {settings.HELEKET_API_KEY}",
-                    "Content-Type": "application/json"
-                }
-                
-                async with session.get(
-                    f"https://api.heleket.com/v1/payments/{payment_id}",
-                    headers=headers
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
+            status, data = await heleket_client.request("GET", f"/payments/{payment_id}", _heleket_headers())
+            if status == 200:
+                return data
         except Exception as e:
             logger.error(f"Heleket payment status error: {e}")
         
         return None
-    
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""Inbox событий платежных систем
+
+Webhook ЮКасса/Heleket только проверяет подпись, сохраняет событие в таблицу
+payment_events и сразу отвечает 200. Зачисление платежа, выдача товара и
+уведомления выполняются пулом фоновых воркеров, поэтому медленные вызовы
+Telegram API не задерживают ответ платежной системе и не вызывают ее повторов.
+
+Повторная доставка события отбрасывается уникальным ключом (provider, event_id).
+Воркеры захватывают события через UPDATE ... RETURNING с арендой (locked_until):
+событие, захваченное упавшим процессом, после окончания аренды обрабатывается
+снова. Неудачная обработка повторяется с растущей задержкой до
+PAYMENT_INBOX_MAX_ATTEMPTS попыток (services/lease_queue.py).
+"""
+import json
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+from aiogram import Bot
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import insert_ignore_duplicates
+from database.models import PaymentEvent
+from services.lease_queue import LeaseQueueWorkers, RetryLater
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATUS_NEW = "NEW"
+STATUS_DONE = "DONE"
+
+# Обработчик события: (provider, payload, bot) -> успешно ли обработано.
+# False - временная ошибка, событие обрабатывается повторно; если повтор
+# не поможет, обработчик выбрасывает PermanentFailure (services/lease_queue.py)
+EventProcessor = Callable[[str, Dict[str, Any], Optional[Bot]], Awaitable[bool]]
+
+
+async def store_payment_event(
+    session: AsyncSession,
+    provider: str,
+    event_id: str,
+    event_type: str,
+    payload: Dict[str, Any]
+) -> bool:
+    """Сохранить событие в inbox
+
+    Возвращает False, если событие с таким ключом уже было получено.
+    """
+    values = {
+        "provider": provider,
+        "event_id": event_id,
+        "event_type": event_type,
+        "payload": json.dumps(payload, ensure_ascii=False),
+        "status": STATUS_NEW,
+        "next_attempt_at": datetime.now(),
+    }
+
+    stmt = insert_ignore_duplicates(PaymentEvent, ["provider", "event_id"])
+    if stmt is not None:
+        result = await session.execute(stmt.values(**values).returning(PaymentEvent.id))
+        inserted = result.scalar_one_or_none() is not None
+        await session.commit()
+    else:
+        try:
+            await session.execute(insert(PaymentEvent).values(**values))
+            await session.commit()
+            inserted = True
+        except IntegrityError:
+            await session.rollback()
+            inserted = False
+
+    if inserted:
+        payment_inbox.notify()
+    else:
+        payment_inbox.duplicates += 1
+    return inserted
+
+
+class PaymentInboxWorkers(LeaseQueueWorkers):
+    """Пул воркеров, обрабатывающих события из payment_events"""
+
+    def __init__(self, workers: int, max_attempts: int):
+        super().__init__(
+            name="payment inbox",
+            model=PaymentEvent,
+            workers=workers,
+            max_attempts=max_attempts,
+            pending_status=STATUS_NEW,
+            done_status=STATUS_DONE,
+            done_at="processed_at",
+            failed_at="processed_at",
+            backoff_base=10,
+            lease_seconds=300
+        )
+        self.duplicates = 0
+
+    def describe(self, event: PaymentEvent) -> str:
+        return f"Payment event {event.provider}/{event.event_id}"
+
+    async def handle(self, event: PaymentEvent, context):
+        processor, bot = context
+        if not await processor(event.provider, json.loads(event.payload), bot):
+            raise RetryLater("Processing failed")
+
+    def start(self, processor: EventProcessor, bot: Optional[Bot] = None):
+        """Запустить воркеры в фоне"""
+        self._start((processor, bot))
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика обработки событий"""
+        return {
+            "workers": len(self._tasks),
+            "duplicates": self.duplicates,
+            "processed": self.done,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+payment_inbox = PaymentInboxWorkers(
+    workers=settings.PAYMENT_INBOX_WORKERS,
+    max_attempts=settings.PAYMENT_INBOX_MAX_ATTEMPTS
+)
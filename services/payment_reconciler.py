@@ -0,0 +1,279 @@
+"""Сверка статусов платежей с платежными системами
+
+Если webhook платежной системы потерялся, оплаченный заказ отменился бы
+по истечении резерва, а пополнение не было бы зачислено. Сверка
+периодически запрашивает статус ожидающих платежей (PENDING старше
+PAYMENT_RECONCILE_MIN_AGE секунд) и проводит подтвержденные через обычный
+путь оплаты (services/settlement.py).
+
+Платежи выбираются по сроку следующей проверки (next_check_at): после
+каждой проверки, не давшей итога, срок откладывается с экспоненциальной
+задержкой, поэтому долго ожидающие платежи не вытесняют новые. Платеж
+закрывается, когда платежная система сообщает об отмене (FAILED), когда
+его заказ отменен пользователем или администратором (FAILED,
+close_order_payments) и когда он не подтвержден за
+PAYMENT_RECONCILE_MAX_AGE_HOURS (EXPIRED). Платежи заказов, отмененных по
+истечении резерва, сверяются дальше: ссылку могут оплатить и после отмены.
+Платеж, подтвержденный платежной системой, но не проведенный (заказ
+отменен или товара нет), закрывается как PAID_UNMATCHED с уведомлением
+администраторам - как и в webhook (close_unmatched_payment).
+
+Кроме того, планировщик отмены заказов (services/order_expiry.py) перед
+отменой сверяет платежи отменяемых заказов - оплаченный заказ не отменяется.
+
+Периодический запуск выполняет планировщик задач (services/job_scheduler.py).
+Запросы к API ограничены по количеству одновременных
+(PAYMENT_RECONCILE_CONCURRENCY) и по частоте (PAYMENT_RECONCILE_RPS).
+"""
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+from aiogram import Bot
+from sqlalchemy import select, update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import async_session_maker
+from database.models import Payment
+from services.payment import PaymentService
+from services.settlement import settle_order, settle_balance_topup, SettlementResult
+from services.notifications import notify_unmatched_payment
+from utils.rate_limit import TokenBucket
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Итог сверки одного платежа
+CONFIRMED = "confirmed"
+FAILED = "failed"
+EXPIRED = "expired"
+UNMATCHED = "unmatched"
+PENDING = "pending"
+
+# Сколько платежей проверяется за один проход
+_BATCH_SIZE = 100
+
+# Интервал между проверками одного платежа: 60 секунд, x2 с каждой проверкой, не больше часа
+_MIN_CHECK_INTERVAL = 60
+_MAX_CHECK_INTERVAL = 3600
+
+
+def _yookassa_state(data: Dict) -> str:
+    status = data.get("status")
+    if status == "succeeded":
+        return CONFIRMED
+    if status == "canceled":
+        return FAILED
+    return PENDING
+
+
+def _heleket_state(data: Dict) -> str:
+    status = data.get("status")
+    if status == "success":
+        return CONFIRMED
+    if status in ("failed", "cancel", "canceled"):
+        return FAILED
+    return PENDING
+
+
+# Платежная система: (запрос статуса, разбор статуса)
+_PROVIDERS = {
+    "yookassa": (PaymentService.get_yookassa_payment_status, _yookassa_state),
+    "heleket": (PaymentService.get_heleket_payment_status, _heleket_state),
+}
+
+
+async def close_order_payments(session: AsyncSession, order_ids: Sequence[int], status: str):
+    """Закрыть ожидающие платежи заказов, отмененных пользователем или администратором
+
+    Commit выполняет вызывающий код - в одной транзакции с отменой заказов.
+    """
+    await session.execute(
+        update(Payment)
+        .where(Payment.order_id.in_(list(order_ids)), Payment.status == "PENDING")
+        .values(status=status)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def unmatched_payment_reason(settlement: SettlementResult, order_id: int) -> Optional[str]:
+    """Причина, по которой оплаченный заказ нельзя провести (None - повтор возможен)"""
+    if settlement.status == SettlementResult.NOT_FOUND:
+        return f"заказ #{order_id} не найден или отменен"
+    if settlement.status == SettlementResult.NO_STOCK:
+        return f"нет товара для выдачи по заказу #{order_id}"
+    return None
+
+
+async def close_unmatched_payment(
+    session: AsyncSession,
+    bot: Optional[Bot],
+    payment_method: str,
+    payment_id: str,
+    amount: float,
+    reason: str
+):
+    """Закрыть платеж, деньги по которому получены, но заказ провести нельзя
+
+    Платеж отмечается PAID_UNMATCHED (больше не сверяется), администраторы
+    получают уведомление для ручной выдачи товара или возврата.
+    """
+    logger.error(f"Payment {payment_method}/{payment_id} is paid, but cannot be settled: {reason}")
+    await session.execute(
+        update(Payment)
+        .where(
+            Payment.payment_method == payment_method,
+            Payment.payment_id == payment_id,
+            Payment.status != "SUCCESS"
+        )
+        .values(status="PAID_UNMATCHED", completed_at=datetime.now())
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    await notify_unmatched_payment(bot, payment_method, payment_id, amount, reason)
+
+
+class PaymentReconciler:
+    """Фоновая сверка ожидающих платежей"""
+
+    def __init__(self, min_age: int, max_age_hours: int, concurrency: int, rate: float):
+        self.min_age = min_age
+        self.max_age_hours = max_age_hours
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._rate_limiter = TokenBucket(rate)
+        # Счетчики для /health
+        self.checked = 0
+        self.confirmed = 0
+        self.failed = 0
+        self.expired = 0
+        self.unmatched = 0
+
+    async def _pending_payments(self, order_ids: Optional[Sequence[int]] = None) -> List[Payment]:
+        now = datetime.now()
+        stmt = (
+            select(Payment)
+            .where(
+                Payment.status == "PENDING",
+                Payment.payment_method.in_(list(_PROVIDERS)),
+                Payment.payment_id.is_not(None),
+            )
+            .limit(_BATCH_SIZE)
+        )
+        if order_ids is not None:
+            stmt = stmt.where(Payment.order_id.in_(order_ids)).order_by(Payment.id)
+        else:
+            stmt = stmt.where(
+                Payment.created_at <= now - timedelta(seconds=self.min_age),
+                or_(Payment.next_check_at.is_(None), Payment.next_check_at <= now)
+            ).order_by(Payment.next_check_at.nulls_first(), Payment.id)
+        async with async_session_maker() as session:
+            result = await session.execute(stmt)
+            return list(result.scalars().all())
+
+    async def _check(self, payment: Payment, bot: Optional[Bot]) -> str:
+        """Запросить статус платежа и провести его, если он подтвержден"""
+        get_status, parse_state = _PROVIDERS[payment.payment_method]
+        async with self._semaphore:
+            await self._rate_limiter.acquire()
+            data = await get_status(payment.payment_id)
+        self.checked += 1
+        state = parse_state(data) if data else PENDING
+
+        async with async_session_maker() as session:
+            if state == CONFIRMED:
+                if payment.order_id:
+                    settlement = await settle_order(
+                        session, payment.order_id, payment.payment_method, payment.payment_id
+                    )
+                    reason = unmatched_payment_reason(settlement, payment.order_id)
+                    if reason is not None:
+                        await close_unmatched_payment(
+                            session, bot, payment.payment_method, payment.payment_id, payment.amount, reason
+                        )
+                        self.unmatched += 1
+                        return UNMATCHED
+                    if not settlement.ok:
+                        logger.error(
+                            f"Payment {payment.payment_method}/{payment.payment_id} is paid, "
+                            f"but order {payment.order_id} cannot be settled: {settlement.status}"
+                        )
+                        return PENDING
+                else:
+                    if not await settle_balance_topup(
+                        session, payment.user_id, payment.amount, payment.payment_id, payment.payment_method
+                    ):
+                        return PENDING
+                self.confirmed += 1
+                logger.info(f"Payment {payment.payment_method}/{payment.payment_id} confirmed by reconciliation")
+            elif state == FAILED:
+                await self._close(session, payment, "FAILED")
+                self.failed += 1
+            elif payment.created_at < datetime.now() - timedelta(hours=self.max_age_hours):
+                # Платеж так и не был подтвержден - больше не проверяем
+                # (если webhook все же придет, платеж будет проведен)
+                await self._close(session, payment, "EXPIRED")
+                self.expired += 1
+                logger.info(f"Payment {payment.payment_method}/{payment.payment_id} expired without confirmation")
+                return EXPIRED
+        return state
+
+    async def _close(self, session: AsyncSession, payment: Payment, status: str):
+        await session.execute(
+            update(Payment)
+            .where(Payment.id == payment.id, Payment.status == "PENDING")
+            .values(status=status)
+        )
+        await session.commit()
+
+    async def _postpone(self, payments: List[Payment]):
+        """Отложить следующую проверку платежей с экспоненциальной задержкой"""
+        if not payments:
+            return
+        now = datetime.now()
+        async with async_session_maker() as session:
+            for payment in payments:
+                attempts = payment.check_attempts + 1
+                delay = min(_MIN_CHECK_INTERVAL * 2 ** (attempts - 1), _MAX_CHECK_INTERVAL)
+                await session.execute(
+                    update(Payment)
+                    .where(Payment.id == payment.id, Payment.status == "PENDING")
+                    .values(check_attempts=attempts, next_check_at=now + timedelta(seconds=delay))
+                )
+            await session.commit()
+
+    async def reconcile(self, order_ids: Optional[Sequence[int]] = None, bot: Optional[Bot] = None) -> int:
+        """Сверить ожидающие платежи (или только платежи указанных заказов)
+
+        bot - для уведомления администраторов о непроведенных платежах.
+
+        Возвращает количество подтвержденных платежей.
+        """
+        payments = await self._pending_payments(order_ids)
+        if not payments:
+            return 0
+        results = await asyncio.gather(*(self._check(payment, bot) for payment in payments), return_exceptions=True)
+        for payment, result in zip(payments, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error reconciling payment {payment.id}: {result}")
+        await self._postpone([
+            payment for payment, result in zip(payments, results)
+            if isinstance(result, Exception) or result == PENDING
+        ])
+        return sum(1 for result in results if result == CONFIRMED)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика сверки"""
+        return {
+            "checked": self.checked,
+            "confirmed": self.confirmed,
+            "failed": self.failed,
+            "expired": self.expired,
+            "unmatched": self.unmatched,
+        }
+
+
+payment_reconciler = PaymentReconciler(
+    min_age=settings.PAYMENT_RECONCILE_MIN_AGE,
+    max_age_hours=settings.PAYMENT_RECONCILE_MAX_AGE_HOURS,
+    concurrency=settings.PAYMENT_RECONCILE_CONCURRENCY,
+    rate=settings.PAYMENT_RECONCILE_RPS
+)
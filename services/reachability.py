@@ -0,0 +1,64 @@
+"""Доступность пользователей для сообщений бота
+
+Если Telegram окончательно отказывает в доставке (пользователь заблокировал
+бота, удалил аккаунт, чат не найден), пользователь отмечается недоступным
+(User.is_reachable = False) и исключается из рассылок и уведомлений о
+поступлении товара - на него больше не тратится лимит отправки.
+
+Флаг снимается, когда пользователь снова пишет боту
+(middlewares/reachability.py).
+"""
+from typing import Iterable
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from sqlalchemy import update
+from database.database import async_session_maker
+from database.models import User
+from services.user_access import invalidate_user_access
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ошибки 400, после которых повтор отправки этому чату бесполезен
+_UNREACHABLE_BAD_REQUESTS = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated")
+
+
+def is_unreachable_error(error: Exception) -> bool:
+    """Постоянная ли это ошибка доставки пользователю"""
+    if isinstance(error, TelegramForbiddenError):
+        # bot was blocked by the user, user is deactivated, bot can't initiate conversation
+        return True
+    if isinstance(error, TelegramBadRequest):
+        message = str(error).lower()
+        return any(text in message for text in _UNREACHABLE_BAD_REQUESTS)
+    return False
+
+
+async def mark_unreachable(telegram_ids: Iterable[int]):
+    """Отметить пользователей недоступными (одним запросом)"""
+    telegram_ids = list(set(telegram_ids))
+    if not telegram_ids:
+        return
+    async with async_session_maker() as session:
+        result = await session.execute(
+            update(User)
+            .where(User.telegram_id.in_(telegram_ids), User.is_reachable == True)
+            .values(is_reachable=False)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    invalidate_user_access(*telegram_ids)
+    if result.rowcount:
+        logger.info(f"Marked {result.rowcount} users as unreachable")
+
+
+async def mark_reachable(telegram_id: int):
+    """Снять отметку недоступности (пользователь снова написал боту)"""
+    async with async_session_maker() as session:
+        await session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.is_reachable == False)
+            .values(is_reachable=True)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    invalidate_user_access(telegram_id)
@@ -0,0 +1,447 @@
+"""Проведение оплаты заказа
+
+Единая точка для всех способов оплаты (webhook ЮКасса/Heleket, Telegram
+Stars, баланс, тестовая оплата). Оплата проводится одной транзакцией из
+нескольких set-based запросов:
+
+1. UPDATE orders ... WHERE status = 'ОЖИДАЕТ ОПЛАТЫ' RETURNING - заказ
+   блокируется один раз, повторная или параллельная оплата условие не пройдет;
+2. UPDATE users (списание с баланса с проверкой остатка) или SELECT
+   покупателя - telegram_id и реферер;
+3. DELETE accounts WHERE order_id RETURNING - выдача зарезервированного товара;
+4. запись платежа и реферальное начисление (только при наличии реферера);
+5. файл с товаром и уведомление администраторов - в outbox той же транзакцией.
+
+settle_orders_batch() проводит так же оплату нескольких заказов с баланса:
+число запросов и сообщений не зависит от количества заказов.
+
+settle_balance_topup() - зачисление пополнения баланса через платежную систему.
+"""
+from datetime import datetime
+from typing import Any, List, Optional
+from sqlalchemy import select, update, delete, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import mark_recent_write, insert_ignore_duplicates
+from database.models import Order, User, Account, Payment, ReferralTransaction
+from services.account_service import reserve_accounts
+from services.delivery_outbox import enqueue_order_delivery, enqueue_batch_delivery, delivery_outbox
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATUS = "ОЖИДАЕТ ОПЛАТЫ"
+COMPLETED_STATUS = "ВЫПОЛНЕНО"
+
+
+class SettlementResult:
+    """Результат проведения оплаты (дескриптор выдачи)"""
+
+    SETTLED = "settled"  # Оплата проведена, товар поставлен в очередь выдачи
+    ALREADY_SETTLED = "already_settled"  # Заказ уже оплачен (повторная доставка платежа)
+    NOT_FOUND = "not_found"  # Заказ не найден или отменен
+    INSUFFICIENT_FUNDS = "insufficient_funds"  # Недостаточно средств на балансе
+    NO_STOCK = "no_stock"  # Товар для выдачи не найден
+    ERROR = "error"  # Ошибка БД, транзакция откачена
+
+    __slots__ = ("status", "order", "orders", "accounts", "telegram_id")
+
+    def __init__(
+        self,
+        status: str,
+        order: Any = None,
+        accounts: Optional[List[Any]] = None,
+        telegram_id: Optional[int] = None,
+        orders: Optional[List[Any]] = None
+    ):
+        self.status = status
+        self.order = order
+        self.orders = orders if orders is not None else ([order] if order is not None else [])
+        self.accounts = accounts or []
+        self.telegram_id = telegram_id
+
+    @property
+    def ok(self) -> bool:
+        """Оплата проведена сейчас или была проведена ранее"""
+        return self.status in (self.SETTLED, self.ALREADY_SETTLED)
+
+    @property
+    def settled(self) -> bool:
+        """Оплата проведена этим вызовом"""
+        return self.status == self.SETTLED
+
+
+async def _order_state(session: AsyncSession, order_id: int) -> str:
+    """Причина, по которой заказ не удалось перевести в оплаченный"""
+    result = await session.execute(select(Order.status).where(Order.id == order_id))
+    status = result.scalar_one_or_none()
+    if status in ("ОПЛАЧЕНО", COMPLETED_STATUS):
+        return SettlementResult.ALREADY_SETTLED
+    return SettlementResult.NOT_FOUND
+
+
+async def _record_payment(session: AsyncSession, order, payment_method: str, payment_id: Optional[str], now: datetime):
+    """Записать успешный платеж (запись, созданная при выдаче ссылки, обновляется)"""
+    if payment_id:
+        result = await session.execute(
+            update(Payment)
+            .where(Payment.payment_method == payment_method, Payment.payment_id == payment_id)
+            .values(status="SUCCESS", order_id=order.id, completed_at=now)
+            .returning(Payment.id)
+            .execution_options(synchronize_session=False)
+        )
+        if result.scalar_one_or_none() is not None:
+            return
+    await session.execute(
+        insert(Payment).values(
+            user_id=order.user_id,
+            amount=order.total_amount,
+            payment_method=payment_method,
+            payment_id=payment_id,
+            status="SUCCESS",
+            order_id=order.id,
+            completed_at=now
+        )
+    )
+
+
+async def _record_late_payment(
+    session: AsyncSession,
+    order_id: int,
+    payment_method: str,
+    payment_id: str,
+    now: datetime
+):
+    """Отметить успешным ожидающий платеж уже оплаченного заказа
+
+    Деньги по платежу получены, поэтому запись не должна оставаться PENDING.
+    Если заказ был оплачен другим платежом, это повторная оплата - она
+    попадает в лог для возврата.
+    """
+    result = await session.execute(
+        update(Payment)
+        .where(
+            Payment.payment_method == payment_method,
+            Payment.payment_id == payment_id,
+            Payment.status != "SUCCESS"
+        )
+        .values(status="SUCCESS", completed_at=now)
+        .returning(Payment.id)
+        .execution_options(synchronize_session=False)
+    )
+    if result.scalar_one_or_none() is not None:
+        logger.warning(f"Payment {payment_method}/{payment_id} received for already paid order {order_id}")
+    await session.commit()
+
+
+def _complete_orders(payment_method: str, payment_id: Optional[str], now: datetime):
+    """UPDATE ожидающих оплаты заказов в выполненные (условия WHERE добавляет вызывающий код)"""
+    return (
+        update(Order)
+        .where(Order.status == PENDING_STATUS)
+        .values(
+            status=COMPLETED_STATUS,
+            payment_method=payment_method,
+            payment_id=payment_id,
+            paid_at=now,
+            completed_at=now,
+            reserved_until=None
+        )
+        .returning(
+            Order.id, Order.user_id, Order.product_id, Order.quantity,
+            Order.total_amount, Order.payment_method
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def _load_buyer(session: AsyncSession, user_id: int, payment_method: str, amount: float):
+    """telegram_id и реферер покупателя; при оплате с баланса - со списанием суммы
+
+    Списание - один условный UPDATE: None, если средств недостаточно.
+    """
+    if payment_method == "balance":
+        result_user = await session.execute(
+            update(User)
+            .where(User.id == user_id, User.balance >= amount)
+            .values(balance=User.balance - amount)
+            .returning(User.telegram_id, User.referred_by)
+            .execution_options(synchronize_session=False)
+        )
+    else:
+        result_user = await session.execute(
+            select(User.telegram_id, User.referred_by).where(User.id == user_id)
+        )
+    return result_user.first()
+
+
+async def _take_accounts(session: AsyncSession, orders) -> Optional[List[Any]]:
+    """Удалить (выдать) аккаунты заказов одним DELETE ... RETURNING
+
+    Для заказов, резерв которых был снят (например, заказ восстановлен вручную),
+    товар резервируется заново. None - товара для выдачи не хватает.
+    """
+    result_accounts = await session.execute(
+        delete(Account)
+        .where(Account.order_id.in_([order.id for order in orders]))
+        .returning(Account.order_id, Account.id, Account.account_data)
+        .execution_options(synchronize_session=False)
+    )
+    accounts = result_accounts.all()
+
+    with_accounts = {account.order_id for account in accounts}
+    for order in orders:
+        if order.id in with_accounts:
+            continue
+        try:
+            reserved = await reserve_accounts(session, order.product_id, order.quantity, order.id)
+        except ValueError as e:
+            logger.error(f"No accounts available for order {order.id}: {e}")
+            return None
+        result_accounts = await session.execute(
+            delete(Account)
+            .where(Account.id.in_([account.id for account in reserved]))
+            .returning(Account.order_id, Account.id, Account.account_data)
+            .execution_options(synchronize_session=False)
+        )
+        accounts.extend(result_accounts.all())
+    return accounts
+
+
+async def _credit_referrer(session: AsyncSession, referrer_id: Optional[int], orders) -> Optional[int]:
+    """Начислить реферальную комиссию за заказы (telegram_id реферера или None)"""
+    if not referrer_id:
+        return None
+    rate = settings.REFERRAL_COMMISSION / 100
+    result_referrer = await session.execute(
+        update(User)
+        .where(User.id == referrer_id)
+        .values(balance=User.balance + sum(order.total_amount * rate for order in orders))
+        .returning(User.telegram_id)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        insert(ReferralTransaction),
+        [
+            {
+                "referrer_id": referrer_id,
+                "referred_id": order.user_id,
+                "order_id": order.id,
+                "amount": order.total_amount,
+                "commission": order.total_amount * rate,
+            }
+            for order in orders
+        ]
+    )
+    return result_referrer.scalar_one_or_none()
+
+
+async def settle_order(
+    session: AsyncSession,
+    order_id: int,
+    payment_method: str,
+    payment_id: Optional[str] = None,
+    user_id: Optional[int] = None,
+    caption: Optional[str] = None
+) -> SettlementResult:
+    """Провести оплату заказа и поставить товар в очередь выдачи
+
+    user_id - проверка, что заказ принадлежит пользователю (для оплаты из бота).
+    При payment_method == "balance" сумма списывается с баланса покупателя.
+    Транзакция фиксируется (или откатывается) внутри функции, исключения
+    не пробрасываются (статус ERROR).
+    """
+    now = datetime.now()
+    try:
+        stmt = _complete_orders(payment_method, payment_id, now).where(Order.id == order_id)
+        if user_id is not None:
+            stmt = stmt.where(Order.user_id == user_id)
+        order = (await session.execute(stmt)).first()
+        if order is None:
+            state = await _order_state(session, order_id)
+            await session.rollback()
+            if state == SettlementResult.ALREADY_SETTLED:
+                logger.info(f"Order {order_id} already processed")
+                if payment_id:
+                    await _record_late_payment(session, order_id, payment_method, payment_id, now)
+            return SettlementResult(state)
+
+        # Покупатель (при оплате с баланса - со списанием суммы)
+        buyer = await _load_buyer(session, order.user_id, payment_method, order.total_amount)
+        if buyer is None:
+            await session.rollback()
+            if payment_method == "balance":
+                return SettlementResult(SettlementResult.INSUFFICIENT_FUNDS, order)
+            return SettlementResult(SettlementResult.NOT_FOUND, order)
+
+        # Выдаем зарезервированный товар
+        accounts = await _take_accounts(session, [order])
+        if accounts is None:
+            await session.rollback()
+            return SettlementResult(SettlementResult.NO_STOCK, order)
+
+        await _record_payment(session, order, payment_method, payment_id, now)
+
+        # Реферальное начисление
+        referrer_telegram_id = await _credit_referrer(session, buyer.referred_by, [order])
+
+        await enqueue_order_delivery(session, order, accounts, buyer.telegram_id, caption)
+
+        await session.commit()
+    except Exception as e:
+        logger.error(f"Error settling order {order_id}: {e}", exc_info=True)
+        await session.rollback()
+        return SettlementResult(SettlementResult.ERROR)
+
+    delivery_outbox.notify()
+    mark_recent_write(buyer.telegram_id)
+    if referrer_telegram_id is not None:
+        mark_recent_write(referrer_telegram_id)
+    logger.info(f"Order {order_id} settled: {payment_method}, payment {payment_id}, {len(accounts)} accounts")
+    return SettlementResult(SettlementResult.SETTLED, order, accounts, buyer.telegram_id)
+
+
+async def settle_orders_batch(session: AsyncSession, order_ids: List[int], user_id: int) -> SettlementResult:
+    """Оплатить с баланса несколько заказов пользователя одной транзакцией
+
+    Одно списание с баланса на общую сумму, один файл со всем товаром и одно
+    уведомление администраторов. Заказы, которые уже не ожидают оплаты,
+    пропускаются; оплаченные заказы - в result.orders.
+    """
+    now = datetime.now()
+    try:
+        result_orders = await session.execute(
+            _complete_orders("balance", None, now).where(Order.id.in_(order_ids), Order.user_id == user_id)
+        )
+        orders = sorted(result_orders.all(), key=lambda order: order.id)
+        if not orders:
+            await session.rollback()
+            return SettlementResult(SettlementResult.NOT_FOUND)
+
+        total_amount = sum(order.total_amount for order in orders)
+        buyer = await _load_buyer(session, user_id, "balance", total_amount)
+        if buyer is None:
+            await session.rollback()
+            return SettlementResult(SettlementResult.INSUFFICIENT_FUNDS, orders=orders)
+
+        accounts = await _take_accounts(session, orders)
+        if accounts is None:
+            await session.rollback()
+            return SettlementResult(SettlementResult.NO_STOCK, orders=orders)
+
+        await session.execute(
+            insert(Payment),
+            [
+                {
+                    "user_id": user_id,
+                    "amount": order.total_amount,
+                    "payment_method": "balance",
+                    "status": "SUCCESS",
+                    "order_id": order.id,
+                    "completed_at": now,
+                }
+                for order in orders
+            ]
+        )
+
+        referrer_telegram_id = await _credit_referrer(session, buyer.referred_by, orders)
+
+        await enqueue_batch_delivery(session, orders, accounts, buyer.telegram_id)
+
+        await session.commit()
+    except Exception as e:
+        logger.error(f"Error settling orders {order_ids}: {e}", exc_info=True)
+        await session.rollback()
+        return SettlementResult(SettlementResult.ERROR)
+
+    delivery_outbox.notify()
+    mark_recent_write(buyer.telegram_id)
+    if referrer_telegram_id is not None:
+        mark_recent_write(referrer_telegram_id)
+    logger.info(f"Orders {[order.id for order in orders]} settled in batch: {total_amount:.2f}, {len(accounts)} accounts")
+    return SettlementResult(SettlementResult.SETTLED, accounts=accounts, telegram_id=buyer.telegram_id, orders=orders)
+
+
+async def settle_balance_topup(
+    session: AsyncSession,
+    user_id: int,
+    amount: float,
+    payment_id: str,
+    payment_method: str
+) -> bool:
+    """Зачислить пополнение баланса
+    
+    Идемпотентно при параллельной доставке одного платежа: запись платежа
+    переводится в SUCCESS одним условным UPDATE (или вставляется с
+    ON CONFLICT DO NOTHING по уникальному индексу), и баланс пополняет
+    только тот запрос, который это сделал.
+    """
+    try:
+        # Получаем пользователя
+        result_user = await session.execute(select(User.telegram_id).where(User.id == user_id))
+        telegram_id = result_user.scalar_one_or_none()
+        
+        if telegram_id is None:
+            logger.error(f"User {user_id} not found")
+            return False
+        
+        now = datetime.now()
+        
+        # Платеж, созданный при выдаче ссылки на оплату (status PENDING)
+        result = await session.execute(
+            update(Payment)
+            .where(
+                Payment.payment_method == payment_method,
+                Payment.payment_id == payment_id,
+                Payment.status != "SUCCESS"
+            )
+            .values(status="SUCCESS", completed_at=now)
+            .returning(Payment.id)
+            .execution_options(synchronize_session=False)
+        )
+        claimed = result.scalar_one_or_none() is not None
+        
+        if not claimed:
+            # Записи нет (или она уже SUCCESS) - пытаемся вставить
+            values = dict(
+                user_id=user_id,
+                amount=amount,
+                payment_method=payment_method,
+                payment_id=payment_id,
+                status="SUCCESS",
+                completed_at=now
+            )
+            stmt = insert_ignore_duplicates(Payment, ["payment_method", "payment_id"])
+            if stmt is not None:
+                result = await session.execute(stmt.values(**values).returning(Payment.id))
+                claimed = result.scalar_one_or_none() is not None
+            else:
+                try:
+                    async with session.begin_nested():
+                        await session.execute(insert(Payment).values(**values))
+                    claimed = True
+                except IntegrityError:
+                    claimed = False
+        
+        if not claimed:
+            await session.rollback()
+            logger.info(f"Payment {payment_id} already processed")
+            return True
+        
+        # Пополняем баланс
+        await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(balance=User.balance + amount)
+        )
+        
+        await session.commit()
+        mark_recent_write(telegram_id)
+        logger.info(f"Balance topup successful: user {user_id}, amount {amount}, payment {payment_id}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error processing balance topup: {e}", exc_info=True)
+        await session.rollback()
+        return False
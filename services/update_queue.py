@@ -0,0 +1,170 @@
+"""Очередь обновлений Telegram для webhook режима
+
+Webhook Telegram только кладет обновление в очередь и сразу отвечает 200,
+поэтому Telegram не ждет работы с БД и исходящих запросов к API, а один
+медленный обработчик не задерживает доставку остальных обновлений.
+
+Обновления обрабатываются пулом из TELEGRAM_UPDATE_WORKERS воркеров.
+Обновления одного пользователя (или чата, если пользователя нет) выполняются
+строго по очереди: пока обновление пользователя обрабатывается, следующие
+ждут в его собственной очереди (на этом держатся FSM сценарии). Разные
+пользователи обрабатываются параллельно.
+
+Повторная доставка того же update_id отбрасывается. Если в очереди уже
+TELEGRAM_UPDATE_QUEUE_SIZE обновлений, webhook отвечает 503 и Telegram
+повторит доставку позже.
+"""
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних update_id помнить для отбрасывания повторов
+_DEDUP_SIZE = 10000
+
+
+def _ordering_key(update: Update) -> int:
+    """Ключ, в пределах которого сохраняется порядок обработки"""
+    try:
+        event = update.event
+    except Exception:
+        return -update.update_id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    # Обновление без пользователя и чата - порядок не важен
+    return -update.update_id
+
+
+class UpdateQueue:
+    """Очередь обновлений с упорядочиванием по пользователю"""
+
+    def __init__(self, workers: int, max_size: int):
+        self.workers = workers
+        self.max_size = max_size
+        # Очереди обновлений по ключам; ключ присутствует, пока его обновления
+        # ждут или обрабатываются
+        self._pending: Dict[int, Deque[Update]] = {}
+        # Ключи, обновления которых можно брать в работу
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._tasks: List[asyncio.Task] = []
+        self._depth = 0
+        self._in_progress = 0
+        # Счетчики для /health
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def put(self, update: Update) -> bool:
+        """Поставить обновление в очередь
+
+        Возвращает False, если очередь переполнена (повтор того же update_id
+        считается принятым).
+        """
+        if update.update_id in self._seen:
+            self.duplicates += 1
+            return True
+        if self._depth >= self.max_size:
+            self.rejected += 1
+            logger.warning(f"Telegram update queue is full ({self._depth}), update {update.update_id} rejected")
+            return False
+
+        self._seen[update.update_id] = None
+        if len(self._seen) > _DEDUP_SIZE:
+            self._seen.popitem(last=False)
+
+        self._depth += 1
+        key = _ordering_key(update)
+        queue = self._pending.get(key)
+        if queue is None:
+            self._pending[key] = deque([update])
+            self._ready.put_nowait(key)
+        else:
+            # Ключ уже в работе или в очереди - обновление дождется своей очереди
+            queue.append(update)
+        return True
+
+    async def _process(self, bot: Bot, dispatcher: Dispatcher, update: Update):
+        try:
+            await dispatcher.feed_update(bot, update)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error processing Telegram update {update.update_id}: {e}", exc_info=True)
+        finally:
+            self.processed += 1
+
+    async def _run_worker(self, bot: Bot, dispatcher: Dispatcher):
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            update = queue.popleft()
+            self._in_progress += 1
+            try:
+                await self._process(bot, dispatcher, update)
+            finally:
+                self._in_progress -= 1
+                self._depth -= 1
+                if queue:
+                    # Следующее обновление ключа - в конец общей очереди,
+                    # чтобы один активный пользователь не занимал воркер
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    def start(self, bot: Bot, dispatcher: Dispatcher):
+        """Запустить воркеры в фоне"""
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._run_worker(bot, dispatcher))
+            for _ in range(self.workers)
+        ]
+
+    async def stop(self, timeout: float = 10):
+        """Дождаться обработки очереди (не дольше timeout) и остановить воркеры"""
+        if not self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._depth and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self._depth:
+            logger.warning(f"Stopping Telegram update queue with {self._depth} unprocessed updates")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика очереди обновлений"""
+        return {
+            "workers": len(self._tasks),
+            "depth": self._depth,
+            "in_progress": self._in_progress,
+            "chats": len(self._pending),
+            "max_size": self.max_size,
+            "processed": self.processed,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+update_queue = UpdateQueue(
+    workers=settings.TELEGRAM_UPDATE_WORKERS,
+    max_size=settings.TELEGRAM_UPDATE_QUEUE_SIZE
+)
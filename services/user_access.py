@@ -0,0 +1,70 @@
+"""Кеш прав доступа пользователей (блокировка, роль и доступность)
+
+Проверки блокировки и роли выполняются на каждое сообщение и нажатие кнопки,
+поэтому результат хранится в памяти процесса. Любое изменение is_blocked или
+role должно сопровождаться вызовом invalidate_user_access.
+"""
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database.models import User
+from utils.cache import TTLCache
+from config import settings
+
+
+class UserAccess:
+    """Снимок прав пользователя"""
+
+    __slots__ = ("is_blocked", "role", "is_reachable")
+
+    def __init__(self, is_blocked: bool, role: Optional[str], is_reachable: bool = True):
+        self.is_blocked = bool(is_blocked)
+        self.role = role or "user"
+        self.is_reachable = bool(is_reachable)
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role in ("admin", "developer")
+
+    @property
+    def is_developer(self) -> bool:
+        return self.role == "developer"
+
+
+# Маркер незарегистрированного пользователя (кешируется так же, как и найденный)
+_NOT_REGISTERED = object()
+
+_cache = TTLCache(maxsize=settings.USER_ACCESS_CACHE_SIZE, ttl=settings.USER_ACCESS_CACHE_TTL)
+
+
+def remember_user_access(telegram_id: int, user: Optional[User]):
+    """Сохранить права уже загруженного пользователя в кеш"""
+    if user is None:
+        _cache.set(telegram_id, _NOT_REGISTERED)
+    else:
+        _cache.set(telegram_id, UserAccess(user.is_blocked, user.role, user.is_reachable))
+
+
+def invalidate_user_access(*telegram_ids: int):
+    """Сбросить кеш для указанных пользователей"""
+    for telegram_id in telegram_ids:
+        _cache.pop(telegram_id)
+
+
+async def get_user_access(session: AsyncSession, telegram_id: int) -> Optional[UserAccess]:
+    """Получить права пользователя (None, если пользователь не зарегистрирован)"""
+    cached = _cache.get(telegram_id)
+    if cached is not None:
+        return None if cached is _NOT_REGISTERED else cached
+
+    stmt = select(User.is_blocked, User.role, User.is_reachable).where(User.telegram_id == telegram_id)
+    result = await session.execute(stmt)
+    row = result.first()
+
+    if row is None:
+        _cache.set(telegram_id, _NOT_REGISTERED)
+        return None
+
+    access = UserAccess(row.is_blocked, row.role, row.is_reachable)
+    _cache.set(telegram_id, access)
+    return access
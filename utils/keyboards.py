@@ -1,6 +1,7 @@
 """Клавиатуры"""
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from typing import List, Optional
+from functools import lru_cache
+from typing import Dict, Hashable, List, Optional
 
 
 def get_back_keyboard(callback_data: str = "back_to_menu") -> InlineKeyboardMarkup:
@@ -38,7 +39,17 @@ def get_categories_keyboard(categories: List) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def get_products_keyboard(products: List, category_id: int) -> InlineKeyboardMarkup:
+def get_page_nav_buttons(page, callback_prefix: str) -> List[InlineKeyboardButton]:
+    """Кнопки навигации для страницы keyset-пагинации (utils.pagination.Page)"""
+    nav_buttons = []
+    if page.has_prev and page.items:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"{callback_prefix}_p_{page.first_id}"))
+    if page.has_next and page.items:
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"{callback_prefix}_n_{page.last_id}"))
+    return nav_buttons
+
+
+def get_products_keyboard(products: List, category_id: int, nav_buttons: Optional[List] = None) -> InlineKeyboardMarkup:
     """Клавиатура товаров"""
     buttons = []
     for product in products:
@@ -47,12 +58,15 @@ def get_products_keyboard(products: List, category_id: int) -> InlineKeyboardMar
             text=f"{product.name} - {product.price:.2f} ₽ {status}",
             callback_data=f"product_{product.id}"
         )])
+    if nav_buttons:
+        buttons.append(nav_buttons)
     buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_catalog")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+@lru_cache(maxsize=2048)
 def get_product_detail_keyboard(product_id: int, has_stock: bool, category_id: int) -> InlineKeyboardMarkup:
-    """Клавиатура деталей товара"""
+    """Клавиатура деталей товара (кешируется: зависит только от аргументов)"""
     buttons = []
     if has_stock:
         buttons.append([InlineKeyboardButton(text="💳 Купить", callback_data=f"buy_{product_id}")])
@@ -66,6 +80,69 @@ def get_product_detail_keyboard(product_id: int, has_stock: bool, category_id: i
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+# Готовые клавиатуры каталога. Ключ: (экран, ID, страница); кеш очищается при смене
+# display_version снимка каталога (перезагрузка или изменение наличия товаров).
+_CATALOG_KEYBOARDS_MAXSIZE = 1000
+_catalog_keyboards: Dict[Hashable, InlineKeyboardMarkup] = {}
+_catalog_keyboards_version: Optional[int] = None
+
+
+def _get_catalog_keyboard(catalog, key: tuple, build) -> InlineKeyboardMarkup:
+    global _catalog_keyboards_version
+    if _catalog_keyboards_version != catalog.display_version:
+        _catalog_keyboards.clear()
+        _catalog_keyboards_version = catalog.display_version
+
+    markup = _catalog_keyboards.get(key)
+    if markup is None:
+        markup = build()
+        if len(_catalog_keyboards) >= _CATALOG_KEYBOARDS_MAXSIZE:
+            _catalog_keyboards.clear()
+        _catalog_keyboards[key] = markup
+    return markup
+
+
+def get_catalog_categories_keyboard(catalog) -> InlineKeyboardMarkup:
+    """Клавиатура активных категорий из снимка каталога (с кешированием)"""
+    return _get_catalog_keyboard(
+        catalog,
+        ("categories",),
+        lambda: get_categories_keyboard(catalog.active_categories())
+    )
+
+
+def get_catalog_products_keyboard(
+    catalog,
+    category_id: int,
+    anchor_id: Optional[int] = None,
+    direction: str = "n"
+) -> InlineKeyboardMarkup:
+    """Страница товаров категории из снимка каталога (с кешированием)
+
+    Товары в наличии идут первыми, затем по названию. Кнопка товара зависит
+    от остатка только через признак "есть в наличии", поэтому изменение
+    количества не сбрасывает кеш, пока товар не закончится или не появится
+    (display_version снимка каталога).
+    """
+    from config import settings
+    from utils.pagination import slice_keyset_page
+
+    def build() -> InlineKeyboardMarkup:
+        products = catalog.sorted_products(category_id)
+        page = slice_keyset_page(products, anchor_id, direction, settings.CATALOG_PAGE_SIZE)
+        return get_products_keyboard(
+            page.items,
+            category_id,
+            get_page_nav_buttons(page, f"catpage_{category_id}")
+        )
+
+    return _get_catalog_keyboard(
+        catalog,
+        ("products", category_id, anchor_id, direction),
+        build
+    )
+
+
 def get_payment_methods_keyboard(order_id: int) -> InlineKeyboardMarkup:
     """Способы оплаты"""
     from config import settings
@@ -0,0 +1,153 @@
+"""Keyset-пагинация списков
+
+Страница определяется не номером, а "якорем" - ID первого или последнего
+элемента соседней страницы. Следующая страница выбирается условием
+(ключ сортировки) > (ключ якоря), поэтому запрос идет по индексу и не
+зависит от глубины листания (в отличие от OFFSET).
+
+Формат callback_data кнопок навигации: {prefix}_n_{ID} / {prefix}_p_{ID}
+(n - следующая страница после ID, p - предыдущая страница до ID).
+
+iter_keyset_chunks() по тому же принципу обходит большие выборки (например,
+получателей рассылки) пачками без загрузки всей выборки в память.
+"""
+from typing import Any, AsyncIterator, List, Optional, Sequence, Tuple
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+NEXT = "n"
+PREV = "p"
+
+
+class Page:
+    """Страница списка"""
+
+    def __init__(self, items: List[Any], has_prev: bool, has_next: bool):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+
+    @property
+    def first_id(self) -> Optional[int]:
+        return self.items[0].id if self.items else None
+
+    @property
+    def last_id(self) -> Optional[int]:
+        return self.items[-1].id if self.items else None
+
+
+def parse_page_callback(data: str, prefix: str) -> Tuple[str, Optional[int]]:
+    """Разобрать callback_data навигации: (направление, ID якоря)"""
+    parts = data[len(prefix):].strip("_").split("_")
+    if len(parts) == 2 and parts[0] in (NEXT, PREV) and parts[1].isdigit():
+        return parts[0], int(parts[1])
+    return NEXT, None
+
+
+async def fetch_keyset_page(
+    session: AsyncSession,
+    stmt,
+    sort_columns: Sequence,
+    id_column,
+    anchor_id: Optional[int] = None,
+    direction: str = NEXT,
+    page_size: int = 10
+) -> Page:
+    """Получить страницу из БД
+
+    stmt - запрос с фильтрами (без ORDER BY и LIMIT). sort_columns - ключ
+    сортировки по возрастанию; последним должен идти уникальный столбец (ID).
+    """
+    anchor = None
+    if anchor_id is not None:
+        result_anchor = await session.execute(select(*sort_columns).where(id_column == anchor_id))
+        anchor = result_anchor.first()
+
+    if anchor is None:
+        # Первая страница (или якорь был удален)
+        result = await session.execute(stmt.order_by(*sort_columns).limit(page_size + 1))
+        rows = list(result.scalars().all())
+        return Page(rows[:page_size], has_prev=False, has_next=len(rows) > page_size)
+
+    key = tuple_(*sort_columns)
+    anchor_key = tuple_(*anchor)
+
+    if direction == PREV:
+        result = await session.execute(
+            stmt.where(key < anchor_key)
+            .order_by(*[column.desc() for column in sort_columns])
+            .limit(page_size + 1)
+        )
+        rows = list(result.scalars().all())
+        if len(rows) <= page_size:
+            # Дошли до начала списка - показываем полную первую страницу
+            return await fetch_keyset_page(session, stmt, sort_columns, id_column, page_size=page_size)
+        return Page(list(reversed(rows[:page_size])), has_prev=True, has_next=True)
+
+    result = await session.execute(
+        stmt.where(key > anchor_key)
+        .order_by(*sort_columns)
+        .limit(page_size + 1)
+    )
+    rows = list(result.scalars().all())
+    return Page(rows[:page_size], has_prev=True, has_next=len(rows) > page_size)
+
+
+def slice_keyset_page(
+    items: Sequence[Any],
+    anchor_id: Optional[int] = None,
+    direction: str = NEXT,
+    page_size: int = 10
+) -> Page:
+    """Получить страницу из уже отсортированного списка в памяти (те же правила, что и в БД)"""
+    position = None
+    if anchor_id is not None:
+        position = next((i for i, item in enumerate(items) if item.id == anchor_id), None)
+
+    if position is None:
+        return Page(list(items[:page_size]), has_prev=False, has_next=len(items) > page_size)
+
+    if direction == PREV:
+        start = position - page_size
+        if start <= 0:
+            return Page(list(items[:page_size]), has_prev=False, has_next=len(items) > page_size)
+        return Page(list(items[start:position]), has_prev=True, has_next=True)
+
+    start = position + 1
+    end = start + page_size
+    return Page(list(items[start:end]), has_prev=True, has_next=len(items) > end)
+
+
+async def iter_keyset_chunks(
+    session_maker,
+    stmt,
+    key_columns: Sequence,
+    chunk_size: int,
+    after: Optional[Sequence[Any]] = None
+) -> AsyncIterator[List[Any]]:
+    """Обойти выборку пачками строк по возрастанию ключа
+
+    stmt - запрос столбцов (например, select(User.id, User.telegram_id)) с
+    фильтрами, без ORDER BY и LIMIT; key_columns должны входить в выбираемые
+    столбцы, последним должен идти уникальный столбец. after - значение
+    ключа, после которого начать (например, сохраненный курсор).
+
+    Каждая пачка читается в отдельной короткой сессии: соединение с БД не
+    удерживается, пока вызывающий код обрабатывает пачку, и память не
+    растет с размером выборки.
+    """
+    single = len(key_columns) == 1
+    key = key_columns[0] if single else tuple_(*key_columns)
+    while True:
+        chunk_stmt = stmt.order_by(*key_columns).limit(chunk_size)
+        if after is not None:
+            chunk_stmt = chunk_stmt.where(key > (after[0] if single else tuple_(*after)))
+        async with session_maker() as session:
+            result = await session.execute(chunk_stmt)
+            rows = result.all()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        after = tuple(rows[-1]._mapping[column] for column in key_columns)
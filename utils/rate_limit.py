@@ -0,0 +1,44 @@
+"""Ограничение частоты запросов к внешним API"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket: в среднем rate операций в секунду, всплеск до capacity
+
+    Ожидающие получают токены в порядке очереди. pause() останавливает выдачу
+    токенов всем ожидающим (например, на retry_after из ответа 429).
+    rate <= 0 - без ограничения частоты (pause по-прежнему действует).
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (без накопления за время паузы)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        """Дождаться токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self.rate <= 0:
+                    return
+
+                self._tokens = min(self.capacity, self._tokens + max(now - self._updated, 0) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)